@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+
+from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtGui import QIcon, QPixmap, QCursor
+
+ASSETS_DIR = 'assets'
+
+
+class AssetManager:
+    """
+    Load icons and cursors from the assets folder once, on first use, and hand out the cached objects after that.
+    """
+    def __init__(self, assets_dir=ASSETS_DIR, cursor_size=20):
+        self.assets_dir = assets_dir
+        self.cursor_size = cursor_size
+        self.icons = {}
+        self.pixmaps = {}
+        self.cursors = {}
+        self.current_cursor = None
+
+    def path(self, name):
+        """
+        Get the path of an asset file.
+        """
+        return os.path.join(self.assets_dir, name)
+
+    def icon(self, name):
+        """
+        Get the icon for an asset file such as 'draw.png'.
+        """
+        if name not in self.icons:
+            self.icons[name] = QIcon(self.path(name))
+        return self.icons[name]
+
+    def pixmap(self, name, size):
+        """
+        Get an asset decoded and scaled to size (width, height).
+        """
+        key = (name, size)
+        if key not in self.pixmaps:
+            self.pixmaps[key] = QPixmap(self.path(name)).scaled(QSize(*size))
+        return self.pixmaps[key]
+
+    def cursor(self, name):
+        """
+        Get the tool cursor drawn from an asset, with its hot spot at the bottom left tip.
+        """
+        if name not in self.cursors:
+            size = self.cursor_size
+            self.cursors[name] = QCursor(self.pixmap(f'{name}.png', (size, size)), 0, size)
+        return self.cursors[name]
+
+    def setCursor(self, app, cursor):
+        """
+        Show a tool cursor by asset name, or a Qt cursor shape, replacing the application override cursor.
+        Nothing is done when it is already showing, so this is cheap to call on every mouse move.
+        """
+        if cursor == self.current_cursor:
+            return
+        self.current_cursor = cursor
+        shape = self.cursor(cursor) if isinstance(cursor, str) else cursor
+        if app.overrideCursor() is None:
+            app.setOverrideCursor(shape)
+        else:
+            app.changeOverrideCursor(shape)
+
+
+def benchmark(moves=2000):
+    """
+    Time a cold start of PyPaint, from import to first paint, and the per-move cursor cost
+    of decoding the cursor asset on every move against the cached cursor.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    results = {}
+    start = time.perf_counter()
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    results['qapplication_ms'] = (time.perf_counter() - start) * 1e3
+
+    start = time.perf_counter()
+    from main import Core
+    results['import_ms'] = (time.perf_counter() - start) * 1e3
+
+    start = time.perf_counter()
+    core = Core(app=app, width=1200, height=720, title='PyPaint')
+    core.show()
+    app.processEvents()
+    results['window_ms'] = (time.perf_counter() - start) * 1e3
+    results['startup_ms'] = results['qapplication_ms'] + results['import_ms'] + results['window_ms']
+
+    app.setOverrideCursor(Qt.ArrowCursor)
+    start = time.perf_counter()
+    for _ in range(moves):
+        # What mouseMoveEvent used to do: decode, scale and push a new override cursor on every move
+        curs = QPixmap(os.path.join(ASSETS_DIR, 'draw.png'))
+        app.setOverrideCursor(QCursor(curs.scaled(20, 20), 0, 20))
+        app.restoreOverrideCursor()
+    results['cursor_reload_us'] = (time.perf_counter() - start) / moves * 1e6
+
+    assets = AssetManager()
+    start = time.perf_counter()
+    for _ in range(moves):
+        assets.setCursor(app, 'draw')
+    results['cursor_cached_us'] = (time.perf_counter() - start) / moves * 1e6
+    core.close()
+    return results
+
+
+if __name__ == '__main__':
+    moves = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    result = benchmark(moves)
+    print(f"startup {result['startup_ms']:.1f} ms: QApplication {result['qapplication_ms']:.1f} ms, "
+          f"imports {result['import_ms']:.1f} ms, window {result['window_ms']:.1f} ms")
+    print(f"cursor per move: reloaded {result['cursor_reload_us']:.1f} us, cached {result['cursor_cached_us']:.2f} us")
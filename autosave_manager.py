@@ -0,0 +1,302 @@
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+AUTOSAVE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.pypaint', 'autosave')
+
+
+def processAlive(pid):
+    """
+    Check if a process is still running, so the autosave of another open window is not taken for a crashed session.
+    Systems without signals are assumed to run one window at a time.
+    """
+    if os.name != 'posix':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AutosaveManager:
+    """
+    Periodic autosave of the layer stack on a background thread, for recovering the canvas after a crash.
+    Each save writes only the tiles changed since the one before as a compressed delta, on top of a full keyframe
+    written first and again once the deltas have grown as large as it, so the I/O follows the amount edited.
+    Tiles are never written once committed, so the calling thread only copies the tile dictionaries.
+    """
+    def __init__(self, directory=AUTOSAVE_DIRECTORY, interval=30, level=1):
+        self.root = directory
+        # Every window saves to its own folder, named for the session so a reused process id never shares one.
+        # The manifest records the process id as a hint of whether the session is still running
+        self.directory = os.path.join(directory, uuid.uuid4().hex)
+        self.interval = interval
+        self.level = level
+        self.pool = None
+        self.future = None
+        self.version = None
+        # Worker thread state: tile snapshots by layer uid as last saved and the files since the last keyframe
+        self.previous = None
+        self.chain = []
+        self.keyframe_bytes = 0
+        self.delta_bytes = 0
+        self.count = 0
+
+    def save(self, stack, version):
+        """
+        Start saving the committed pixels of a layer stack, unless its version is the one saved last
+        or the last save is still running. Returns whether a save was started.
+        """
+        if version == self.version or self.busy():
+            return False
+        layers = [(layer.uid, {'name': layer.name, 'opacity': layer.opacity, 'visible': layer.visible,
+                               'blend': layer.blend}, layer.tiles.snapshot()) for layer in stack.layers]
+        self.version = version
+        self.submit(self.write, layers, stack.active)
+        return True
+
+    def busy(self):
+        """
+        Check if a save or cleanup is still running.
+        """
+        return self.future is not None and not self.future.done()
+
+    def submit(self, function, *args):
+        """
+        Run a job on the autosave thread, after the ones before it.
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='autosave')
+        self.future = self.pool.submit(function, *args)
+
+    def write(self, layers, active):
+        """
+        Write one keyframe or delta file and add it to the manifest. Runs on the autosave thread.
+        """
+        keyframe = self.previous is None or self.delta_bytes >= self.keyframe_bytes
+        self.count += 1
+        name = f"{self.count:06d}.{'key' if keyframe else 'delta'}"
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            meta = {'active': active, 'layers': []}
+            # Entry name per tile written, so tiles shared between keys or layers, such as blank ones, are stored once
+            written = {}
+            with zipfile.ZipFile(path + '.part', 'w', zipfile.ZIP_DEFLATED, compresslevel=self.level) as archive:
+                for uid, settings, tiles in layers:
+                    before = None if keyframe else self.previous.get(uid)
+                    entries = {}
+                    for key in tiles.changedKeys(before):
+                        tile = tiles.tiles[key]
+                        if id(tile) not in written:
+                            written[id(tile)] = str(len(written))
+                            archive.writestr(written[id(tile)], np.ascontiguousarray(tile).tobytes())
+                        entries[f'{key[0]},{key[1]}'] = written[id(tile)]
+                    meta['layers'].append(dict(settings, uid=uid, shape=list(tiles.shape),
+                                               tile_size=tiles.tile_size, tiles=entries))
+                archive.writestr('meta.json', json.dumps(meta))
+            os.replace(path + '.part', path)
+        except OSError:
+            # Start over from a keyframe on the next save
+            self.previous = None
+            self.version = None
+            return
+        size = os.path.getsize(path)
+        old = []
+        if keyframe:
+            old, self.chain = self.chain, [name]
+            self.keyframe_bytes, self.delta_bytes = size, 0
+        else:
+            self.chain.append(name)
+            self.delta_bytes += size
+        self.writeManifest()
+        # Files before the new keyframe are only removed once the manifest no longer needs them
+        for name in old:
+            self.remove(os.path.join(self.directory, name))
+        self.previous = {uid: tiles for uid, _, tiles in layers}
+
+    def writeManifest(self):
+        """
+        Replace the manifest listing the files to replay, atomically so a crash leaves the old one or the new one.
+        """
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(path + '.part', 'w') as file:
+            json.dump({'chain': self.chain, 'time': time.time(), 'pid': os.getpid()}, file)
+        os.replace(path + '.part', path)
+
+    def remove(self, path):
+        """
+        Delete an autosave file, leaving it when the system refuses.
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def reset(self):
+        """
+        Start a new chain for a new document, removing the files of the old one once the running save is done.
+        """
+        self.version = None
+        if self.pool is not None:
+            self.submit(self.clear)
+
+    def clear(self):
+        """
+        Forget the saved chain and delete its folder. Runs on the autosave thread.
+        """
+        self.previous = None
+        self.chain = []
+        self.keyframe_bytes = self.delta_bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def wait(self):
+        """
+        Block until the running save is finished.
+        """
+        if self.future is not None:
+            self.future.result()
+
+    def close(self):
+        """
+        Finish the running save and delete this window's autosave, as the session ended cleanly.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        self.clear()
+
+    def sessions(self):
+        """
+        Get the folders of sessions that ended without closing, newest first.
+        A folder of another session recording this process id was left by a crashed process whose id was reused.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            manifest = os.path.join(path, 'manifest.json')
+            if path == self.directory or not os.path.exists(manifest):
+                continue
+            try:
+                with open(manifest) as file:
+                    pid = json.load(file).get('pid')
+            except (OSError, ValueError):
+                continue
+            if pid is None or pid == os.getpid() or not processAlive(pid):
+                found.append((os.path.getmtime(manifest), path))
+        return [path for _, path in sorted(found, reverse=True)]
+
+    def recover(self, allocate=None):
+        """
+        Rebuild the layers of the newest crashed session by replaying its keyframe and deltas.
+        allocate gets an uninitialized image for a shape. Returns the layers, bottom first, as dicts of their
+        settings and image, and the active index, or None when there is no session.
+        """
+        allocate = allocate or (lambda shape: np.empty(shape, dtype=np.uint8))
+        sessions = self.sessions()
+        if not sessions:
+            return None
+        with open(os.path.join(sessions[0], 'manifest.json')) as file:
+            manifest = json.load(file)
+        images = {}
+        meta = None
+        for name in manifest['chain']:
+            with zipfile.ZipFile(os.path.join(sessions[0], name)) as archive:
+                meta = json.loads(archive.read('meta.json'))
+                current = {}
+                for layer in meta['layers']:
+                    shape = tuple(layer['shape'])
+                    image = images.get(layer['uid'])
+                    if image is None or image.shape != shape:
+                        # Layers new to a delta, or reshaped, hold all of their tiles in it
+                        image = allocate(shape)
+                    size = layer['tile_size']
+                    for key, entry in layer['tiles'].items():
+                        row, column = (int(value) for value in key.split(','))
+                        x0, y0 = column * size, row * size
+                        x1, y1 = min(x0 + size, shape[1]), min(y0 + size, shape[0])
+                        image[y0:y1, x0:x1] = np.frombuffer(archive.read(entry), dtype=np.uint8).reshape(
+                            (y1 - y0, x1 - x0) + shape[2:])
+                    current[layer['uid']] = image
+                images = current
+        if meta is None:
+            return None
+        layers = [{'name': layer['name'], 'opacity': layer['opacity'], 'visible': layer['visible'],
+                   'blend': layer['blend'], 'image': images[layer['uid']]} for layer in meta['layers']]
+        return layers, meta['active']
+
+    def discard(self):
+        """
+        Delete the autosaves of every crashed session.
+        """
+        for path in self.sessions():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def diskUsage(self):
+        """
+        Get the bytes of this window's autosave files.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+
+def benchmark(sizes=(2000, 8000), strokes=20, rounds=5):
+    """
+    Autosave square canvases of several sizes: a keyframe, then rounds of strokes in one corner each followed
+    by a delta. Returns, by size, the keyframe seconds and MB, and the mean delta seconds and KB and milliseconds
+    spent on the calling thread. Deltas should stay flat as the canvas grows.
+    """
+    import tempfile
+    from layer_manager import LayerManager
+    results = {}
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix='pypaint-autosave-')
+        autosave = AutosaveManager(directory)
+        stack = LayerManager()
+        stack.reset(np.full((size, size, 3), 255, dtype=np.uint8))
+        stack.addLayer()
+        version = 0
+        start = time.perf_counter()
+        autosave.save(stack, version)
+        autosave.wait()
+        keyframe = (time.perf_counter() - start, autosave.diskUsage() / 1e6)
+        rng = np.random.default_rng(0)
+        delta_s = calling_ms = delta_kb = 0
+        for _ in range(rounds):
+            layer = stack.activeLayer()
+            for _ in range(strokes):
+                x, y = (int(v) for v in rng.integers(0, 1500, 2))
+                cv2.line(layer.image, (x, y), (x + 200, y + 50), (0, 0, 255, 255), 8)
+                layer.tiles.commit(layer.image, (max(x - 8, 0), max(y - 8, 0), x + 209, y + 59))
+            version += 1
+            used = autosave.diskUsage()
+            start = time.perf_counter()
+            autosave.save(stack, version)
+            calling_ms += (time.perf_counter() - start) * 1e3
+            autosave.wait()
+            delta_s += time.perf_counter() - start
+            delta_kb += (autosave.diskUsage() - used) / 1e3
+        results[size] = keyframe + (delta_s / rounds, delta_kb / rounds, calling_ms / rounds)
+        autosave.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    sizes = tuple(int(arg) for arg in sys.argv[1:]) or (2000, 8000)
+    for size, (key_s, key_mb, delta_s, delta_kb, calling_ms) in benchmark(sizes).items():
+        print(f'{size:>5}px: keyframe {key_s:.2f} s {key_mb:.1f} MB, '
+              f'delta {delta_s * 1e3:.0f} ms {delta_kb:.0f} KB, calling thread {calling_ms:.2f} ms')
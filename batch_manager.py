@@ -0,0 +1,194 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import cv2
+
+from cv_manager import CVManager
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# One CVManager per worker process, created on first use
+worker_cv = None
+
+
+def processJob(job):
+    """
+    Load one image, run the operation chain on it and save the result. Runs inside a worker process.
+    """
+    global worker_cv
+    if worker_cv is None:
+        # The pool already keeps every core busy, so each worker filters serially
+        worker_cv = CVManager(filter_workers=1)
+    source, target, ops = job
+    start = time.perf_counter()
+    try:
+        image = worker_cv.loadImage(source)
+        if image is None:
+            raise ValueError('unreadable image')
+        for name, arg in ops:
+            image = BatchManager.applyOp(worker_cv, image, name, arg)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if not worker_cv.saveImage(target, image, True):
+            raise ValueError('could not write output')
+        return source, 'done', image.shape[0] * image.shape[1], os.path.getsize(source), \
+            time.perf_counter() - start, None
+    except Exception as error:
+        return source, 'failed', 0, 0, time.perf_counter() - start, str(error)
+
+
+class BatchManager:
+    """
+    Apply a chain of CVManager operations to many images on a process pool.
+    """
+    def __init__(self, inputs, output, ops, workers=None, extension=None, force=False):
+        self.inputs = inputs
+        self.output = output
+        self.ops = ops
+        self.workers = workers or os.cpu_count() or 1
+        self.extension = extension
+        self.force = force
+
+    @staticmethod
+    def parseOp(text):
+        """
+        Parse an operation such as 'effect:sketch', 'effect:grey|blur_2', 'rotate:left', 'flip:h', 'resize:800x600'
+        or 'crop:x0,y0,x1,y1' into a (name, argument) pair.
+        """
+        name, _, arg = text.partition(':')
+        if name == 'effect':
+            return name, arg.replace('_', ' ')
+        elif name == 'rotate' and arg in ('left', 'right'):
+            return name, arg
+        elif name == 'flip' and arg in ('v', 'h'):
+            return name, arg
+        elif name == 'resize':
+            width, height = arg.lower().split('x')
+            return name, (int(width), int(height))
+        elif name == 'crop':
+            x0, y0, x1, y1 = (int(value) for value in arg.split(','))
+            return name, (x0, y0, x1, y1)
+        raise argparse.ArgumentTypeError(f'unknown operation: {text}')
+
+    @staticmethod
+    def applyOp(cv, image, name, arg):
+        """
+        Run one operation through CVManager, keeping the image in BGR order between operations.
+        """
+        if name == 'effect':
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            image = cv.apply_filter(image, arg)
+            # apply_filter hands back RGB for display, convert back for chaining and saving
+            return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        elif name == 'rotate':
+            return cv.rotateImage(image, arg)
+        elif name == 'flip':
+            return cv.flipImage(image, arg)
+        elif name == 'resize':
+            return cv.resizeImage(image, arg)
+        elif name == 'crop':
+            # cropImage insets the selection by 3 pixels to drop the dashed outline
+            x0, y0, x1, y1 = arg
+            return cv.cropImage(image, (x0 - 3, y0 - 3), (x1 + 3, y1 + 3))
+
+    def listInputs(self):
+        """
+        Yield input image paths from directories and glob patterns, lazily.
+        """
+        for pattern in self.inputs:
+            if os.path.isdir(pattern):
+                pattern = os.path.join(pattern, '*')
+            for path in sorted(glob.iglob(pattern)):
+                if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                    yield path
+
+    def targetPath(self, source):
+        """
+        Get the output path for an input image.
+        """
+        base, extension = os.path.splitext(os.path.basename(source))
+        return os.path.join(self.output, base + (self.extension or extension))
+
+    def isUpToDate(self, source, target):
+        """
+        Check whether an output exists and is newer than its input.
+        """
+        return not self.force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+    def jobs(self, stats):
+        """
+        Yield the jobs still to run, counting skipped files.
+        """
+        for source in self.listInputs():
+            target = self.targetPath(source)
+            if self.isUpToDate(source, target):
+                stats['skipped'] += 1
+                continue
+            yield source, target, self.ops
+
+    def run(self, report=print):
+        """
+        Process every input, keeping at most two jobs per worker in flight so memory stays bounded.
+        """
+        stats = {'done': 0, 'skipped': 0, 'failed': 0, 'pixels': 0, 'bytes': 0}
+        start = time.perf_counter()
+        pending = set()
+        jobs = self.jobs(stats)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for job in jobs:
+                pending.add(pool.submit(processJob, job))
+                if len(pending) >= self.workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.collect(finished, stats, report)
+            finished, _ = wait(pending)
+            self.collect(finished, stats, report)
+        stats['seconds'] = time.perf_counter() - start
+        report(self.summary(stats))
+        return stats
+
+    def collect(self, futures, stats, report):
+        """
+        Add finished jobs to the statistics.
+        """
+        for future in futures:
+            source, status, pixels, size, seconds, error = future.result()
+            stats[status] += 1
+            stats['pixels'] += pixels
+            stats['bytes'] += size
+            if error:
+                report(f'failed {source}: {error}')
+
+    def summary(self, stats):
+        """
+        Format the throughput report.
+        """
+        seconds = max(stats['seconds'], 1e-9)
+        return (f"{stats['done']} done, {stats['skipped']} skipped, {stats['failed']} failed "
+                f"in {stats['seconds']:.2f}s with {self.workers} workers: "
+                f"{stats['done'] / seconds:.2f} files/s, {stats['pixels'] / seconds / 1e6:.2f} MP/s written, "
+                f"{stats['bytes'] / seconds / 1e6:.2f} MB/s read")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m batch_manager',
+                                     description='Apply PyPaint operations to many images without opening a window.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('--op', dest='ops', action='append', type=BatchManager.parseOp, default=[],
+                        help="operation to apply, in order: effect:sketch, effect:grey|blur_3, rotate:left, flip:h, "
+                             "resize:800x600, crop:x0,y0,x1,y1")
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--format', choices=['png', 'jpg'], default=None, help='output format (default: keep)')
+    parser.add_argument('--force', action='store_true', help='reprocess outputs that are already up to date')
+    args = parser.parse_args(argv)
+    extension = f'.{args.format}' if args.format else None
+    stats = BatchManager(args.inputs, args.output, args.ops, args.workers, extension, args.force).run()
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import cv2
+
+from cv_manager import CVManager, FAST_BLUR_TOLERANCE, FAST_SKETCH_TOLERANCE
+
+EFFECTS = [None, 'grey', 'invert', 'cartoon', 'blur 1', 'blur 2', 'blur 3', 'blur 4', 'sketch']
+SHAPES = ['drawElipse', 'drawTriangle', 'drawRectangle', 'drawPentagon', 'drawHexagon', 'drawDiamond']
+SIZES = [512, 1024, 2048, 4096, 8192]
+# Kernel sizes of blur 2, blur 3, blur 4 and sketch, which fast blur mode approximates
+FAST_KERNELS = [41, 61, 81, 211]
+# Effects users get approximated in fast blur mode, with the tolerance each is held to
+FAST_EFFECTS = {'blur 2': FAST_BLUR_TOLERANCE, 'blur 3': FAST_BLUR_TOLERANCE, 'blur 4': FAST_BLUR_TOLERANCE,
+                'sketch': FAST_SKETCH_TOLERANCE}
+
+
+class BenchmarkManager:
+    """
+    Time every CVManager operation on synthetic square canvases and compare the results with a stored baseline.
+    """
+    def __init__(self, sizes=None, repeat=5, max_seconds=2.0, workers=None, only=None):
+        self.sizes = sizes or SIZES
+        self.repeat = repeat
+        self.max_seconds = max_seconds
+        self.workers = workers or os.cpu_count() or 1
+        self.only = only
+        self.CV = CVManager(filter_workers=1)
+        self.fast_cv = CVManager(filter_workers=1)
+        self.fast_cv.fast_blur = True
+
+    @staticmethod
+    def syntheticImage(size, seed=0):
+        """
+        Build a size x size BGR canvas with smooth gradients, noise and a few shapes, so filters see real edges.
+        """
+        rng = np.random.default_rng(seed)
+        ramp = np.linspace(0, 255, size, dtype=np.float32)
+        image = np.empty((size, size, 3), np.uint8)
+        image[..., 0] = ramp[None, :]
+        image[..., 1] = ramp[:, None]
+        image[..., 2] = 128
+        image = cv2.add(image, rng.integers(0, 24, image.shape, dtype=np.uint8))
+        for index in range(8):
+            center = tuple(int(v) for v in rng.integers(0, size, 2))
+            cv2.circle(image, center, size // 10, (index * 30, 255 - index * 30, 80), -1)
+        return image
+
+    def cases(self, image):
+        """
+        Yield (name, function) pairs timing one operation each on a canvas.
+        Operations that draw into the canvas get a working copy, leaving the source for the filters.
+        """
+        size = image.shape[0]
+        work = image.copy()
+        display = np.empty((size, size, 4), np.uint8)
+        start, end = (size // 4, size // 4), (size * 3 // 4, size * 3 // 4)
+        cropped = self.CV.cropImage(image, start, end).copy()
+        path = np.stack([np.linspace(size * 0.1, size * 0.9, 100),
+                         size / 2 + size / 4 * np.sin(np.linspace(0, 6 * np.pi, 100))], axis=1)
+        black, white = (0, 0, 0), (255, 255, 255)
+
+        for effect in EFFECTS:
+            yield f'apply_filter[{effect}]', lambda effect=effect: self.CV.apply_filter(image, effect, workers=1)
+            if self.workers > 1 and self.CV.getEffectHalo(effect):
+                yield f'apply_filter[{effect}] x{self.workers}', \
+                    lambda effect=effect: self.CV.apply_filter(image, effect, workers=self.workers)
+            if effect in ('blur 2', 'blur 3', 'blur 4', 'sketch'):
+                yield f'apply_filter[{effect}] fast', lambda effect=effect: self.fast_cv.apply_filter(image, effect)
+        yield 'toQImage', lambda: self.CV.toQImage(image)
+        yield 'toDisplay', lambda: self.CV.toDisplay(image, display)
+        yield 'rotateImage', lambda: self.CV.rotateImage(image, 'left')
+        yield 'flipImage', lambda: self.CV.flipImage(image, 'h')
+        yield 'cropImage', lambda: self.CV.cropImage(image, start, end).copy()
+        yield 'drawImage', lambda: self.CV.drawImage(work, start, end, cropped, (size, size))
+        yield 'moveRect', lambda: self.CV.moveRect(work, start, (start[0] + size // 10, start[1] + size // 10),
+                                                   (start, end), white)
+        yield 'drawDashRect', lambda: self.CV.drawDashRect(work, start, end, black)
+        yield 'drawLine', lambda: self.CV.drawLine(work, start, end, black, 3)
+        yield 'drawPolyline', lambda: self.CV.drawPolyline(work, np.rint(path), black, 3)
+        yield 'drawText', lambda: self.CV.drawText(work, 'PyPaint benchmark', start, 0, size / 256, black, 2)
+        for shape in SHAPES:
+            draw = getattr(self.CV, shape)
+            yield shape, lambda draw=draw: draw(work, start, end, black, 3, white, False)
+            yield f'{shape} filled', lambda draw=draw: draw(work, start, end, black, 3, white, True)
+
+    def measure(self, function):
+        """
+        Run a function up to repeat times, stopping early once max_seconds have passed.
+        Returns the best and median run times in seconds.
+        """
+        samples = []
+        began = time.perf_counter()
+        while len(samples) < self.repeat and (not samples or time.perf_counter() - began < self.max_seconds):
+            start = time.perf_counter()
+            function()
+            samples.append(time.perf_counter() - start)
+        return min(samples), float(np.median(samples)), len(samples)
+
+    def run(self, report=print):
+        """
+        Time every case at every size and return the results with the machine they ran on.
+        """
+        results = []
+        for size in self.sizes:
+            image = self.syntheticImage(size)
+            for name, function in self.cases(image):
+                if self.only and not any(pattern in name for pattern in self.only):
+                    continue
+                best, median, runs = self.measure(function)
+                results.append({'op': name, 'size': size, 'best_ms': best * 1e3, 'median_ms': median * 1e3,
+                                'runs': runs, 'mp_per_s': size * size / best / 1e6})
+                report(f'{name:<28} {size:>5}² {best * 1e3:>10.3f} ms best {median * 1e3:>10.3f} ms median '
+                       f'{size * size / best / 1e6:>9.1f} MP/s')
+        return {'machine': self.machine(), 'results': results}
+
+    def machine(self):
+        """
+        Describe the machine and library versions, which numbers are only comparable within.
+        """
+        return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'opencv_threads': cv2.getNumThreads(),
+                'workers': self.workers}
+
+    def checkAccuracy(self, report=print):
+        """
+        Compare fast blurs with exact ones on synthetic and noisy canvases of every size, failing any kernel
+        whose mean or max difference exceeds FAST_BLUR_TOLERANCE, and any effect of FAST_EFFECTS outside its own.
+        Returns True when every blur and effect is within tolerance.
+        """
+        passed = True
+        for size in self.sizes:
+            noisy = cv2.GaussianBlur(np.random.default_rng(size).integers(0, 256, (size, size, 3), dtype=np.uint8),
+                                     (3, 3), 0)
+            for name, image in (('synthetic', self.syntheticImage(size)), ('noise', noisy)):
+                for kernel in FAST_KERNELS:
+                    difference = np.abs(self.CV.gaussianBlur(image, kernel).astype(np.int16) -
+                                        self.fast_cv.gaussianBlur(image, kernel))
+                    mean, worst = float(difference.mean()), int(difference.max())
+                    ok = mean <= FAST_BLUR_TOLERANCE['mean'] and worst <= FAST_BLUR_TOLERANCE['max']
+                    passed = passed and ok
+                    report(f"{'ok' if ok else 'FAIL':<4} blur {kernel:>3}x{kernel:<3} {name:<9} {size:>5}² "
+                           f"mean {mean:.3f} max {worst}")
+                for effect, tolerance in FAST_EFFECTS.items():
+                    difference = np.abs(self.CV.apply_filter(image, effect).astype(np.int16) -
+                                        self.fast_cv.apply_filter(image, effect))
+                    mean, worst = float(difference.mean()), int(difference.max())
+                    ok = mean <= tolerance['mean'] and worst <= tolerance['max']
+                    passed = passed and ok
+                    report(f"{'ok' if ok else 'FAIL':<4} {effect:<11} {name:<9} {size:>5}² mean {mean:.3f} max {worst}")
+        return passed
+
+    @staticmethod
+    def compare(current, baseline, tolerance=0.15):
+        """
+        Find the cases whose best time got slower than the baseline by more than tolerance.
+        Returns (op, size, baseline ms, current ms) tuples.
+        """
+        previous = {(entry['op'], entry['size']): entry['best_ms'] for entry in baseline['results']}
+        regressions = []
+        for entry in current['results']:
+            key = (entry['op'], entry['size'])
+            if key in previous and entry['best_ms'] > previous[key] * (1 + tolerance):
+                regressions.append((entry['op'], entry['size'], previous[key], entry['best_ms']))
+        return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark_manager',
+                                     description='Time every CVManager operation on synthetic canvases.')
+    parser.add_argument('--sizes', type=lambda text: [int(size) for size in text.split(',')], default=SIZES,
+                        help='comma separated canvas edges in pixels (default: 512,1024,2048,4096,8192)')
+    parser.add_argument('--only', action='append', default=None, help='run only cases whose name contains this')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per case (default: 5)')
+    parser.add_argument('--max-seconds', type=float, default=2.0, help='stop repeating a case after this long')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='threads for the banded apply_filter cases (default: CPU count)')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown against the baseline')
+    parser.add_argument('--accuracy', action='store_true',
+                        help='only check fast blurs and the effects using them against exact ones, failing outside '
+                             'FAST_BLUR_TOLERANCE, or FAST_SKETCH_TOLERANCE for sketch')
+    args = parser.parse_args(argv)
+
+    if args.accuracy:
+        return 0 if BenchmarkManager(args.sizes).checkAccuracy() else 1
+
+    results = BenchmarkManager(args.sizes, args.repeat, args.max_seconds, args.workers, args.only).run()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = BenchmarkManager.compare(results, json.load(file), args.tolerance)
+        for op, size, before, after in regressions:
+            print(f'regression {op} {size}²: {before:.3f} ms -> {after:.3f} ms ({after / before - 1:+.0%})')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
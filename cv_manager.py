@@ -1,9 +1,75 @@
+import os
 import cv2
 import math
 import numpy as np
+from collections import OrderedDict
 from PyQt5.QtGui import *
 
+# Difference allowed between fast and exact blurs, per channel value: mean over all pixels and max
+FAST_BLUR_TOLERANCE = {'mean': 0.3, 'max': 3}
+# Sketch divides by its blur, so a one step blur difference grows several steps where the blur is near white,
+# whatever the downscale factor. Its fast result is held to the same mean but a looser max
+FAST_SKETCH_TOLERANCE = {'mean': 0.3, 'max': 6}
+
+
+class EffectCache:
+    """
+    Bounded LRU cache of filtered images keyed by (version, effect, shape).
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the cached result for a key, or None on a miss.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, image):
+        """
+        Store a result, dropping entries of older document versions and the least recently used ones.
+        """
+        for stale in [k for k in self.entries if k[0] < key[0]]:
+            del self.entries[stale]
+        self.entries[key] = image
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop every cached result.
+        """
+        self.entries.clear()
+
+    def stats(self):
+        """
+        Get hit, miss and size counters of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
 class CVManager:
+    def __init__(self, filter_workers=None):
+        self.effect_cache = EffectCache()
+        self.filter_workers = filter_workers or os.cpu_count() or 1
+        self.filter_pool = None
+        # Images smaller than this are filtered serially, banding them costs more than it saves
+        self.band_threshold = 512 * 512
+        # Expensive effects are previewed at this fraction of full resolution while the mouse is held
+        self.proxy_scale = 0.25
+        # Approximate large blurs on a downsampled copy, within FAST_BLUR_TOLERANCE of the exact result
+        # and sketch within FAST_SKETCH_TOLERANCE
+        self.fast_blur = False
+
     def loadImage(self, image_path):
         """
         Load an image from a given path using OpenCV.
@@ -27,16 +93,40 @@ class CVManager:
     def toQImage(self, image, image_effect=None):
         """
         Convert an OpenCV image to a QImage with optional image effect.
+        The filtered array is released on return, so the QImage owns a copy of its pixels.
         """
         image = self.apply_filter(image, image_effect)
         height, width = image.shape[:2]
-        if image_effect in ('grey','sketch'):
+        if image.ndim == 2:
             bytes_per_line = width
             qimage = QImage(image.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
         else:
             bytes_per_line = width * image.shape[2]
             qimage = QImage(image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        return qimage
+        return qimage.copy()
+
+    def toDisplay(self, image, display, image_effect=None, version=None, rect=None, scale=1.0):
+        """
+        Write an image with optional image effect into a BGRA display buffer in place, converting straight into it.
+        Without a rect the whole image is written, using the effect cache when a document version is given.
+        """
+        height, width = image.shape[:2]
+        x0, y0, x1, y1 = rect if rect is not None else (0, 0, width, height)
+        target = display[y0:y1, x0:x1]
+        if not self.splitEffect(image_effect):
+            cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2BGRA, dst=target)
+            return
+        if rect is not None:
+            filtered = self.filterRegion(image, image_effect, rect, scale)
+        elif version is not None:
+            key = (version, image_effect, image.shape)
+            filtered = self.effect_cache.get(key)
+            if filtered is None:
+                filtered = self.filterStages(image, image_effect, version)
+                self.effect_cache.put(key, filtered)
+        else:
+            filtered = self.apply_filter(image, image_effect)
+        cv2.cvtColor(filtered, cv2.COLOR_GRAY2BGRA if filtered.ndim == 2 else cv2.COLOR_RGB2BGRA, dst=target)
 
     def toIcon(self, image):
         """
@@ -45,10 +135,89 @@ class CVManager:
         image = self.toQImage(image)
         return QIcon(QPixmap(image))
 
-    def apply_filter(self, image, image_effect):
+    def apply_filter(self, image, image_effect, workers=None):
         """
         Apply image effects such as grey, invert, cartoon, blur, or sketch using OpenCV.
+        Large images with neighbourhood effects are split into bands filtered on a thread pool.
+        """
+        workers = self.filter_workers if workers is None else workers
+        if workers > 1 and image.shape[0] * image.shape[1] >= self.band_threshold \
+                and self.getEffectHalo(image_effect):
+            return self.filterBands(image, image_effect, workers)
+        return self.filterImage(image, image_effect)
+
+    def filterStages(self, image, image_effect, version):
+        """
+        Apply a chain of effects such as 'grey|blur 2|invert', caching the output of every stage but the last.
+        Changing a stage only recomputes the stages after it; the earlier outputs come from the cache.
+        """
+        stages = self.splitEffect(image_effect)
+        if len(stages) < 2:
+            return self.apply_filter(image, image_effect)
+        start = 0
+        for end in range(len(stages) - 1, 0, -1):
+            cached = self.effect_cache.get((version, '|'.join(stages[:end]) + '|', image.shape))
+            if cached is not None:
+                image, start = cached, end
+                break
+        for end in range(start + 1, len(stages)):
+            image = self.applyEffect(image, stages[end - 1])
+            self.effect_cache.put((version, '|'.join(stages[:end]) + '|', image.shape), image)
+        return self.apply_filter(image, stages[-1])
+
+    def applyEffect(self, image, image_effect, scale=1.0):
+        """
+        Apply one effect and hand the result back in BGR, ready to feed the next stage of a chain.
+        """
+        image = self.filterImage(image, image_effect, scale)
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    def splitEffect(self, image_effect):
+        """
+        Split an effect string into its stages, dropping empty ones.
+        """
+        if image_effect is None:
+            return []
+        return [stage for stage in image_effect.split('|') if stage and stage.lower() != 'none']
+
+    def filterBands(self, image, image_effect, workers):
+        """
+        Apply an effect to horizontal bands in parallel. Each band reads the effect halo above and below it,
+        and starts on the downscale grid of fast blurs, so the stitched result is identical to filtering
+        the whole image at once.
+        """
+        height = image.shape[0]
+        halo, align = self.getBandHalo(image_effect)
+        count = max(min(workers * 2, height // max(halo * 2, 64)), 1)
+        edges = np.unique(np.append(np.linspace(0, height, count + 1).astype(int) // align * align, height))
+        count = len(edges) - 1
+
+        def filterBand(index):
+            y0, y1 = edges[index], edges[index + 1]
+            py0, py1 = max(0, y0 - halo), min(height, y1 + halo)
+            return self.filterImage(image[py0:py1], image_effect)[y0 - py0:y1 - py0]
+
+        if self.filter_pool is None or self.filter_pool._max_workers != workers:
+            # Imported here so launching does not pay for it until a large image is filtered
+            from concurrent.futures import ThreadPoolExecutor
+            if self.filter_pool is not None:
+                self.filter_pool.shutdown(wait=False)
+            self.filter_pool = ThreadPoolExecutor(max_workers=workers)
+        return np.concatenate(list(self.filter_pool.map(filterBand, range(count))))
+
+    def filterImage(self, image, image_effect, scale=1.0):
         """
+        Apply an image effect to the whole image in a single pass.
+        A scale below 1 shrinks the kernels to match an image downscaled by that factor.
+        """
+        # Chain of effects, each stage reading the output of the one before it
+        if image_effect is not None and '|' in image_effect:
+            stages = self.splitEffect(image_effect)
+            for stage in stages[:-1]:
+                image = self.applyEffect(image, stage, scale)
+            return self.filterImage(image, stages[-1] if stages else None, scale)
         # Grey
         if image_effect == 'grey':
             return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -59,26 +228,171 @@ class CVManager:
         elif image_effect == 'cartoon':
             grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             grey = cv2.medianBlur(grey, 1)
-            outline = cv2.adaptiveThreshold(grey, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
-            color = cv2.bilateralFilter(image, 9, 300, 300)
+            outline = cv2.adaptiveThreshold(grey, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                            max(self.scaleKernel(9, scale), 3), 9)
+            color = cv2.bilateralFilter(image, self.scaleKernel(9, scale), 300, 300)
             cartoon_image = cv2.bitwise_and(color, color, mask=outline)
             return cv2.cvtColor(cartoon_image, cv2.COLOR_BGR2RGB)
         # Blur
         elif image_effect is not None and 'blur' in image_effect:
             blur_size = int(image_effect.split(' ')[1])
             grey = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            return  cv2.GaussianBlur(grey, (blur_size*21-((blur_size-1)*1), blur_size*21-((blur_size-1)*1)), 0)
+            kernel = self.scaleKernel(blur_size*21-((blur_size-1)*1), scale)
+            return self.gaussianBlur(grey, kernel)
         # Sketch
         elif image_effect == 'sketch':
             grey_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             inverted = 255 - grey_image
-            blured = cv2.GaussianBlur(inverted, (211, 211), 0)
+            kernel = self.scaleKernel(211, scale)
+            blured = self.gaussianBlur(inverted, kernel)
             inverted_back = 255 - blured
             return cv2.divide(grey_image, inverted_back, scale=256)
         else:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         return image
 
+    def blurFactor(self, size):
+        """
+        Get the sigma of a size x size Gaussian kernel and the factor gaussianBlur downscales by for it.
+        """
+        sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+        factor = 1
+        while self.fast_blur and sigma / (factor * 2) >= 3:
+            factor *= 2
+        return sigma, factor
+
+    def gaussianBlur(self, image, size):
+        """
+        Blur with a size x size Gaussian kernel. In fast blur mode large kernels run on a copy downscaled
+        by a power of two, keeping at least 3 pixels of sigma, and the result is scaled back up.
+        """
+        sigma, factor = self.blurFactor(size)
+        if factor == 1:
+            return cv2.GaussianBlur(image, (size, size), 0)
+        # Pad by the kernel radius so borders reflect as in the exact blur, and up to a multiple of the factor
+        height, width = image.shape[:2]
+        pad = -(-(size // 2) // factor) * factor + factor
+        padded = cv2.copyMakeBorder(image, pad, pad + (-height) % factor, pad, pad + (-width) % factor,
+                                    cv2.BORDER_REFLECT_101)
+        padded_height, padded_width = padded.shape[:2]
+        small = cv2.resize(padded, (padded_width // factor, padded_height // factor), interpolation=cv2.INTER_AREA)
+        # Area downscaling and linear upscaling already spread the image by about 0.2 * factor² pixels²
+        small = cv2.GaussianBlur(small, (0, 0), math.sqrt(sigma ** 2 - 0.2 * factor ** 2) / factor)
+        blurred = cv2.resize(small, (padded_width, padded_height), interpolation=cv2.INTER_LINEAR)
+        return blurred[pad:pad + height, pad:pad + width]
+
+    def scaleKernel(self, size, scale):
+        """
+        Scale an odd kernel size, keeping it odd.
+        """
+        if scale >= 1:
+            return size
+        return int(size * scale) | 1
+
+    def isExpensive(self, image_effect):
+        """
+        Check whether an effect is too slow to recompute at full resolution on every mouse move.
+        """
+        return 'cartoon' in self.splitEffect(image_effect) or self.getEffectHalo(image_effect) >= 30
+
+    def getEffectHalo(self, image_effect):
+        """
+        Get how many pixels around a region the effect reads to compute it.
+        """
+        if image_effect is not None and '|' in image_effect:
+            return sum(self.getEffectHalo(stage) for stage in self.splitEffect(image_effect))
+        if image_effect == 'cartoon':
+            return 4
+        elif image_effect is not None and 'blur' in image_effect:
+            return int(image_effect.split(' ')[1]) * 10
+        elif image_effect == 'sketch':
+            return 105
+        return 0
+
+    def getBandHalo(self, image_effect):
+        """
+        Get how many pixels a band or region reads around it, and the multiple its edges must fall on.
+        A fast blur reads as far as its kernel reaches on the downscaled copy, plus the rows area downscaling and
+        linear upscaling blend in, and only matches the whole image blur on the grid of its downscale factor.
+        """
+        halo, align = 0, 1
+        for stage in self.splitEffect(image_effect):
+            size = self.blurKernel(stage)
+            sigma, factor = self.blurFactor(size) if size else (0, 1)
+            if factor == 1:
+                halo += self.getEffectHalo(stage)
+                continue
+            small_sigma = math.sqrt(sigma ** 2 - 0.2 * factor ** 2) / factor
+            # OpenCV sizes the kernel of an 8 bit blur at 3 sigma on each side
+            radius = (round(small_sigma * 6 + 1) | 1) // 2
+            halo += (radius + 2) * factor
+            align = max(align, factor)
+        return -(-halo // align) * align, align
+
+    def blurKernel(self, image_effect):
+        """
+        Get the Gaussian kernel size of a blur or sketch effect stage, or None for other effects.
+        """
+        if image_effect is not None and 'blur' in image_effect:
+            blur_size = int(image_effect.split(' ')[1])
+            return blur_size*21-((blur_size-1)*1)
+        elif image_effect == 'sketch':
+            return 211
+        return None
+
+    def filterRegion(self, image, image_effect, rect, scale=1.0):
+        """
+        Apply an image effect to a region only, reading the effect halo around it.
+        The area read is snapped to the downscale grid of fast blurs, so it matches filtering the whole image.
+        With a scale below 1 the region is filtered as a downscaled proxy and scaled back up.
+        """
+        x0, y0, x1, y1 = rect
+        height, width = image.shape[:2]
+        halo, align = self.getBandHalo(image_effect)
+        px0, py0 = max(0, x0 - halo) // align * align, max(0, y0 - halo) // align * align
+        px1, py1 = min(width, -(-(x1 + halo) // align) * align), min(height, -(-(y1 + halo) // align) * align)
+        if scale < 1:
+            size = (max(round((px1 - px0) * scale), 1), max(round((py1 - py0) * scale), 1))
+            proxy = cv2.resize(image[py0:py1, px0:px1], size, interpolation=cv2.INTER_AREA)
+            filtered = self.filterImage(proxy, image_effect, scale)
+            filtered = cv2.resize(filtered, (px1 - px0, py1 - py0), interpolation=cv2.INTER_LINEAR)
+        else:
+            filtered = self.apply_filter(image[py0:py1, px0:px1], image_effect)
+        return filtered[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+    def getRect(self, points, thickness, shape):
+        """
+        Get the clipped bounding rect (x0, y0, x1, y1) of points drawn with a given thickness.
+        """
+        pts = np.array(points, np.int64).reshape(-1, 2)
+        pad = max(int(thickness), 1) // 2 + 2
+        x0 = max(int(pts[:, 0].min()) - pad, 0)
+        y0 = max(int(pts[:, 1].min()) - pad, 0)
+        x1 = min(int(pts[:, 0].max()) + pad + 1, shape[1])
+        y1 = min(int(pts[:, 1].max()) + pad + 1, shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def growRect(self, rect, pad, shape):
+        """
+        Grow a rect by pad pixels on every side, clipped to the image shape.
+        """
+        return (max(rect[0] - pad, 0), max(rect[1] - pad, 0),
+                min(rect[2] + pad, shape[1]), min(rect[3] + pad, shape[0]))
+
+    @staticmethod
+    def unionRect(rect_a, rect_b):
+        """
+        Get the smallest rect containing both rects, either of which may be None.
+        """
+        if rect_a is None:
+            return rect_b
+        if rect_b is None:
+            return rect_a
+        return (min(rect_a[0], rect_b[0]), min(rect_a[1], rect_b[1]),
+                max(rect_a[2], rect_b[2]), max(rect_a[3], rect_b[3]))
+
     def rotateImage(self, image, side):
         """
         Rotate the image clockwise or counterclockwise using OpenCV.
@@ -109,6 +423,16 @@ class CVManager:
         """
         Draw an image onto the canvas at the specified position using OpenCV.
         """
+        x, y, x_gap, y_gap = self.getImageRect(start_pos, current_pos, cropped_image, bounderies)
+
+        # Paste the cropped image onto the canvas
+        image[y:y_gap, x:x_gap] = cropped_image
+        return image
+
+    def getImageRect(self, start_pos, current_pos, cropped_image, bounderies):
+        """
+        Get the rect (x0, y0, x1, y1) drawImage pastes the cropped image into.
+        """
         # Adjust coordinates for out-of-bound positions
         x = 0 if start_pos[0] <= 0 or current_pos[0] <= 0 else min(start_pos[0], current_pos[0]) + 3
         x = bounderies[0] - cropped_image.shape[1] if current_pos[0] >= bounderies[0] or start_pos[0] >= bounderies[0] else x
@@ -116,18 +440,29 @@ class CVManager:
         y = 0 if start_pos[1] <= 0 or current_pos[1] <= 0 else min(start_pos[1], current_pos[1]) + 3
         y = bounderies[1] - cropped_image.shape[0] if current_pos[1] >= bounderies[1] or start_pos[1] >= bounderies[1] else y
         y_gap = y + cropped_image.shape[0] if current_pos[1] >= bounderies[1] or start_pos[1] >= bounderies[1] else y + cropped_image.shape[0]
+        return x, y, x_gap, y_gap
 
-        # Paste the cropped image onto the canvas
-        image[y:y_gap, x:x_gap] = cropped_image
-        return image
-
-    def moveRect(self, image, start_pos, current_pos, rect):
+    def moveRect(self, image, start_pos, current_pos, rect, fill=None):
         """
-        Move a rectangular region within the image.
+        Move a rectangular region within the image by the offset between start_pos and current_pos.
+        The region is clipped to the image bounds, may overlap its destination and, when a fill color is
+        given, the area it leaves behind is painted with it.
         """
-        for y in range(rect[0][1] + 1, rect[1][1] - 1):
-            for x in range(rect[0][0] - 1, rect[1][0] + 1)[::-1]:
-                image[y][x - 2] = image[y][x]
+        dx, dy = current_pos[0] - start_pos[0], current_pos[1] - start_pos[1]
+        height, width = image.shape[:2]
+        x0, x1 = max(min(rect[0][0], rect[1][0]), 0), min(max(rect[0][0], rect[1][0]), width)
+        y0, y1 = max(min(rect[0][1], rect[1][1]), 0), min(max(rect[0][1], rect[1][1]), height)
+        if x0 >= x1 or y0 >= y1:
+            return image
+
+        # Keep only the part of the source whose destination lands on the canvas
+        sx0, sx1 = max(x0, -dx), min(x1, width - dx)
+        sy0, sy1 = max(y0, -dy), min(y1, height - dy)
+        moved = image[sy0:sy1, sx0:sx1].copy() if sx0 < sx1 and sy0 < sy1 else None
+        if fill is not None:
+            image[y0:y1, x0:x1] = fill
+        if moved is not None:
+            image[sy0 + dy:sy1 + dy, sx0 + dx:sx1 + dx] = moved
         return image
 
     def drawLine(self, image, prev_point, dest_point, color, thickness):
@@ -135,6 +470,27 @@ class CVManager:
         Draw a line between two points on the image using OpenCV.
         """
         cv2.line(image, prev_point, dest_point, color, thickness, cv2.LINE_AA)
+        return self.getRect([prev_point, dest_point], thickness, image.shape)
+
+    def drawPolyline(self, image, points, color, thickness):
+        """
+        Draw an open polyline through points with a single OpenCV call, or a dot for a single point.
+        """
+        pts = np.array(points, np.int32).reshape(-1, 1, 2)
+        if len(pts) == 1:
+            cv2.circle(image, (int(pts[0, 0, 0]), int(pts[0, 0, 1])), thickness // 2, color, -1)
+        else:
+            cv2.polylines(image, [pts], False, color, thickness, cv2.LINE_AA)
+        return self.getRect(pts, thickness, image.shape)
+
+    def drawText(self, image, text, pos, font, scale, color, thickness):
+        """
+        Draw text with its baseline starting at pos and return the rect it covers.
+        """
+        cv2.putText(image, text, pos, font, scale, color, thickness)
+        (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+        return self.getRect([(pos[0], pos[1] - height), (pos[0] + width, pos[1] + baseline)], thickness,
+                            image.shape)
 
     def drawDashRect(self, image, start_pos, current_pos, color, from_center=None):
         """
@@ -177,6 +533,8 @@ class CVManager:
         if is_filled:
             cv2.ellipse(image, (x_mid, y_mid), radius, 0, 0, 360, fill_color, -1)
         cv2.ellipse(image, (x_mid, y_mid), radius, 0, 0, 360, color, thickness)
+        return self.getRect([(x_mid - radius[0], y_mid - radius[1]), (x_mid + radius[0], y_mid + radius[1])],
+                            thickness, image.shape)
 
     def drawTriangle(self, image, start_pos, current_pos, color, thickness, fill_color, is_filled=False):
         """
@@ -194,6 +552,7 @@ class CVManager:
         if is_filled:
             cv2.fillPoly(image, [pts], fill_color)
         cv2.polylines(image, [pts], True, color, thickness)
+        return self.getRect(pts, thickness, image.shape)
 
     def drawRectangle(self, image, start_pos, current_pos, color, thickness, fill_color=False, is_filled=False):
         """
@@ -202,6 +561,7 @@ class CVManager:
         if is_filled:
             cv2.rectangle(image, start_pos, current_pos, fill_color, -1, cv2.LINE_AA)
         cv2.rectangle(image, start_pos, current_pos, color, thickness, cv2.LINE_AA)
+        return self.getRect([start_pos, current_pos], thickness, image.shape)
 
     def drawPentagon(self, image, start_pos, current_pos, color, thickness, fill_color, is_filled):
         """
@@ -226,6 +586,7 @@ class CVManager:
         if is_filled:
             cv2.fillPoly(image, [pts], fill_color)
         cv2.polylines(image, [pts], True, color, thickness)
+        return self.getRect(pts, thickness, image.shape)
 
     def drawHexagon(self, image, start_pos, current_pos, color, thickness, fill_color, is_filled):
         """
@@ -246,6 +607,7 @@ class CVManager:
         if is_filled:
             cv2.fillPoly(image, [pts], fill_color)
         cv2.polylines(image, [pts], True, color, thickness)
+        return self.getRect(pts, thickness, image.shape)
 
     def drawDiamond(self, image, start_pos, current_pos, color, thickness, fill_color, is_filled):
         """
@@ -263,6 +625,55 @@ class CVManager:
         if is_filled:
             cv2.fillPoly(image, [pts], fill_color)
         cv2.polylines(image, [pts], True, color, thickness)
+        return self.getRect(pts, thickness, image.shape)
+
+    def floodFill(self, image, seed, color, tolerance=0, contiguous=True, reference=None):
+        """
+        Fill the area connected to seed whose channels are each within tolerance of the seed color,
+        or every such pixel in the image when not contiguous. Returns the rect that changed, or None.
+        When a reference such as the composite of every layer is given, pixels are matched on it and painted on image.
+        """
+        reference = image if reference is None else reference
+        x, y = seed
+        if not (0 <= x < image.shape[1] and 0 <= y < image.shape[0]):
+            return None
+        seed_color = reference[y, x]
+        color = tuple(int(c) for c in color)
+        if contiguous:
+            diff = (tolerance,) * reference.shape[2]
+            if reference is image:
+                if tolerance == 0 and tuple(int(c) for c in seed_color) == color:
+                    return None
+                # OpenCV fills with a stack of row spans, so the fill never revisits a pixel.
+                # Comparing with the seed rather than with neighbours keeps soft gradients from leaking across the image
+                _, _, _, (x0, y0, width, height) = cv2.floodFill(image, None, (int(x), int(y)), color, diff, diff,
+                                                                 4 | cv2.FLOODFILL_FIXED_RANGE)
+            else:
+                mask = np.zeros((image.shape[0] + 2, image.shape[1] + 2), dtype=np.uint8)
+                _, _, _, (x0, y0, width, height) = cv2.floodFill(reference, mask, (int(x), int(y)), 0, diff, diff,
+                                                                 4 | cv2.FLOODFILL_FIXED_RANGE |
+                                                                 cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+                region = image[y0:y0 + height, x0:x0 + width]
+                region[mask[y0 + 1:y0 + 1 + height, x0 + 1:x0 + 1 + width] > 0] = color
+            if width == 0 or height == 0:
+                return None
+            return x0, y0, x0 + width, y0 + height
+
+        lower = np.clip(seed_color.astype(np.int16) - tolerance, 0, 255).astype(np.uint8)
+        upper = np.clip(seed_color.astype(np.int16) + tolerance, 0, 255).astype(np.uint8)
+        # Match and fill a band of rows at a time, so the masks stay small and hot in cache
+        band = 64
+        fill = np.empty((band,) + image.shape[1:], np.uint8)
+        fill[:] = color
+        rect = None
+        for top in range(0, image.shape[0], band):
+            part = image[top:top + band]
+            mask = cv2.inRange(reference[top:top + band], lower, upper)
+            cv2.copyTo(fill[:part.shape[0]], mask, part)
+            x0, y0, width, height = cv2.boundingRect(mask)
+            if width and height:
+                rect = self.unionRect(rect, (x0, top + y0, x0 + width, top + y0 + height))
+        return rect
 
     def getYDirection(self, y1, y2):
         """
@@ -0,0 +1,55 @@
+class EffectStack:
+    """
+    Ordered chain of effect stages, such as grey, blur 2 and invert, applied on top of the document for display.
+    The chain is written as the stage names joined by '|', which is the effect string CVManager understands.
+    """
+    def __init__(self):
+        # None marks a stage that was added but has no effect chosen yet
+        self.stages = []
+
+    def text(self):
+        """
+        Get the effect string of the chain, or None when no stage has an effect.
+        """
+        stages = [stage for stage in self.stages if stage is not None]
+        return '|'.join(stages) if stages else None
+
+    def setStage(self, effect):
+        """
+        Set the effect of the last stage, starting the chain if it is empty.
+        """
+        if effect is not None and effect.lower() == 'none':
+            effect = None
+        if self.stages:
+            self.stages[-1] = effect
+        elif effect is not None:
+            self.stages.append(effect)
+
+    def addStage(self):
+        """
+        Append an empty stage, keeping the effects before it.
+        """
+        if self.stages and self.stages[-1] is None:
+            return
+        self.stages.append(None)
+
+    def removeStage(self):
+        """
+        Drop the last stage.
+        """
+        if self.stages:
+            self.stages.pop()
+
+    def clear(self):
+        """
+        Drop every stage.
+        """
+        self.stages = []
+
+    def describe(self):
+        """
+        Get a readable summary of the chain for the status bar.
+        """
+        if not self.stages:
+            return 'No effects'
+        return ' → '.join(stage or '(new stage)' for stage in self.stages)
@@ -0,0 +1,147 @@
+class RegionEdit:
+    """
+    Edit confined to a rect, storing only the pixels it replaced.
+    """
+    def __init__(self, name, rect, pixels, layer=None):
+        self.name = name
+        self.rect = rect
+        self.pixels = pixels
+        # Layer the pixels belong to, which is made active again before the edit is applied
+        self.layer = layer
+
+    def apply(self, image):
+        """
+        Swap the stored pixels with the image region, turning an undo into its redo and back.
+        """
+        x0, y0, x1, y1 = self.rect
+        current = image[y0:y1, x0:x1].copy()
+        image[y0:y1, x0:x1] = self.pixels
+        self.pixels = current
+        return image, self.rect
+
+    def nbytes(self):
+        return self.pixels.nbytes
+
+
+class TransformEdit:
+    """
+    Invertible whole-image edit, such as a rotate or flip, storing no pixels.
+    """
+    def __init__(self, name, undo, redo):
+        self.name = name
+        self.undo = undo
+        self.redo = redo
+
+    def apply(self, image):
+        """
+        Run the inverse transform, then swap so the next call runs the forward one.
+        """
+        image = self.undo(image)
+        self.undo, self.redo = self.redo, self.undo
+        return image, None
+
+    def nbytes(self):
+        return 0
+
+
+class LayersEdit:
+    """
+    Edit replacing the layer stack, such as adding a layer or a crop, storing the layers it replaced.
+    Layers are shared with the stack, so only the ones that left it are counted against the budget.
+    """
+    def __init__(self, name, stack, layers, active):
+        self.name = name
+        self.stack = stack
+        self.layers = layers
+        self.active = active
+
+    def apply(self, image):
+        """
+        Swap the stored layers with the stack's, returning the pixels of the active layer.
+        """
+        layers, active = self.stack.layers, self.stack.active
+        self.stack.layers, self.stack.active = self.layers, self.active
+        self.layers, self.active = layers, active
+        self.stack.invalidate()
+        return self.stack.activeLayer().image, None
+
+    def nbytes(self):
+        current = {id(layer) for layer in self.stack.layers}
+        return sum(layer.image.nbytes for layer in self.layers if id(layer) not in current)
+
+
+class HistoryManager:
+    """
+    Undo and redo stacks of edits kept under a byte budget, evicting the oldest edits first.
+    """
+    def __init__(self, budget=512 * 1024 * 1024):
+        self.budget = budget
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def push(self, edit):
+        """
+        Record a new edit, dropping the redo stack.
+        """
+        self.undo_stack.append(edit)
+        self.redo_stack = []
+        self.evict()
+
+    def undo(self, image):
+        """
+        Undo the latest edit. Returns the image and the rect that changed (None for the whole image),
+        or None when there is nothing to undo.
+        """
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        result = edit.apply(image)
+        self.redo_stack.append(edit)
+        return result
+
+    def redo(self, image):
+        """
+        Redo the latest undone edit, returning the same as undo.
+        """
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        result = edit.apply(image)
+        self.undo_stack.append(edit)
+        return result
+
+    def peek(self, redo=False):
+        """
+        Get the edit the next undo, or redo, would apply without applying it, or None.
+        """
+        stack = self.redo_stack if redo else self.undo_stack
+        return stack[-1] if stack else None
+
+    def clear(self):
+        """
+        Forget every edit.
+        """
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def setBudget(self, budget):
+        """
+        Set the byte budget and evict edits until it is met.
+        """
+        self.budget = budget
+        self.evict()
+
+    def memoryUsage(self):
+        """
+        Get the bytes held by the undo and redo stacks.
+        """
+        return sum(edit.nbytes() for edit in self.undo_stack + self.redo_stack)
+
+    def evict(self):
+        """
+        Drop the oldest undo edits, then the farthest redo edits, until the budget is met.
+        """
+        usage = self.memoryUsage()
+        while usage > self.budget and (self.undo_stack or self.redo_stack):
+            stack = self.undo_stack if self.undo_stack else self.redo_stack
+            usage -= stack.pop(0).nbytes()
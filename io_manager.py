@@ -0,0 +1,228 @@
+import os
+import struct
+import zlib
+import cv2
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from storage_manager import bandRows
+
+# Files are read and written in chunks of this size so progress and cancellation stay responsive
+CHUNK_SIZE = 1024 * 1024
+
+
+class IOWorker(QThread):
+    """
+    Background thread for file work, reporting progress in percent and stopping early when cancelled.
+    """
+    progress = pyqtSignal(int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Ask the worker to stop at its next checkpoint.
+        """
+        self.cancelled = True
+
+    def run(self):
+        try:
+            result = self.work()
+        except Exception as error:
+            self.failed.emit(str(error))
+            return
+        if self.cancelled:
+            self.failed.emit('cancelled')
+        else:
+            self.done.emit(result)
+
+    def work(self):
+        raise NotImplementedError
+
+
+def writeBands(file, extension, shape, bands):
+    """
+    Write an image given as an iterable of BGR or grey row bands, without ever holding it whole.
+    Supports .npy, and .png compressed as the bands arrive.
+    """
+    if extension == '.npy':
+        np.lib.format.write_array_header_1_0(file, {'descr': '|u1', 'fortran_order': False, 'shape': tuple(shape)})
+        for band in bands:
+            file.write(np.ascontiguousarray(band).data)
+        return
+    if extension != '.png':
+        raise ValueError(f'{extension} images cannot be written in bands')
+
+    def chunk(kind, data):
+        file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    file.write(b'\x89PNG\r\n\x1a\n')
+    chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2 if channels == 3 else 0, 0, 0, 0))
+    compressor = zlib.compressobj(1)
+    for band in bands:
+        band = band.reshape(band.shape[0], width, channels)
+        if channels == 3:
+            band = band[..., ::-1]
+        band = band.reshape(band.shape[0], -1)
+        # Every row uses the Sub filter, storing each byte as the difference from the pixel to its left
+        rows = np.empty((band.shape[0], band.shape[1] + 1), dtype=np.uint8)
+        rows[:, 0] = 1
+        rows[:, 1:channels + 1] = band[:, :channels]
+        np.subtract(band[:, channels:], band[:, :-channels], out=rows[:, channels + 1:])
+        data = compressor.compress(rows.data)
+        if data:
+            chunk(b'IDAT', data)
+    chunk(b'IDAT', compressor.flush())
+    chunk(b'IEND', b'')
+
+
+class LoadWorker(IOWorker):
+    """
+    Read and decode an image file off the UI thread, onto disk when a storage manager has disk backing enabled.
+    """
+    def __init__(self, path, storage=None):
+        super().__init__(path)
+        self.storage = storage
+
+    def work(self):
+        if os.path.splitext(self.path)[1].lower() == '.npy':
+            if self.storage is None:
+                return np.array(np.load(self.path, mmap_mode='r'))
+            return self.storage.load(self.path, lambda done: self.progress.emit(int(done * 100)),
+                                     lambda: self.cancelled)
+        size = max(os.path.getsize(self.path), 1)
+        data = bytearray()
+        with open(self.path, 'rb') as file:
+            while not self.cancelled:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                self.progress.emit(len(data) * 80 // size)
+        if self.cancelled:
+            return None
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f'could not decode {os.path.basename(self.path)}')
+        if self.storage is not None:
+            del data
+            # Decoders need the whole image, but it only stays in memory until it is copied to disk
+            image = self.storage.adopt(image, lambda done: self.progress.emit(80 + int(done * 20)),
+                                       lambda: self.cancelled)
+        self.progress.emit(100)
+        return image
+
+
+class SaveWorker(IOWorker):
+    """
+    Apply the display effect to a tile snapshot, encode it and write it off the UI thread.
+    The file is written beside its target and moved into place once complete, so a cancelled save leaves no partial file.
+    With stream set, .png and .npy files are filtered, encoded and written in row bands instead of as a whole.
+    """
+    def __init__(self, path, snapshot, image_effect, cv_manager, stream=False):
+        super().__init__(path)
+        self.snapshot = snapshot
+        self.image_effect = image_effect
+        self.CV = cv_manager
+        self.stream = stream
+
+    def work(self):
+        extension = os.path.splitext(self.path)[1].lower() or '.png'
+        if extension == '.npy' or (self.stream and extension == '.png'):
+            return self.writeStream(extension)
+        image = self.snapshot.toArray()
+        if self.image_effect is not None:
+            image = self.filterImage(image)
+        if self.cancelled:
+            return None
+        ok, encoded = cv2.imencode(extension, image)
+        if not ok:
+            raise ValueError(f'could not encode {extension} image')
+        self.progress.emit(70)
+        data = encoded.data
+        temp_path = self.path + '.part'
+        try:
+            with open(temp_path, 'wb') as file:
+                for start in range(0, len(data), CHUNK_SIZE):
+                    if self.cancelled:
+                        break
+                    file.write(data[start:start + CHUNK_SIZE])
+                    self.progress.emit(70 + 30 * min(start + CHUNK_SIZE, len(data)) // len(data))
+            if self.cancelled:
+                os.remove(temp_path)
+                return None
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.path
+
+    def writeStream(self, extension):
+        """
+        Write the snapshot band by band, each band filtered with its halo, so the image is never assembled whole.
+        """
+        height, width = self.snapshot.shape[:2]
+        halo, align = self.CV.getBandHalo(self.image_effect)
+        # Bands start on the downscale grid of fast blurs, where they match the whole image blur
+        rows = -(-max(bandRows(self.snapshot.shape), halo * 4, 64) // align) * align
+        grey = self.image_effect is not None and self.CV.filterImage(np.zeros((1, 1, 3), np.uint8),
+                                                                     self.image_effect).ndim == 2
+        shape = (height, width) if grey else (height, width, 3)
+
+        def bands():
+            for y0 in range(0, height, rows):
+                if self.cancelled:
+                    return
+                y1 = min(y0 + rows, height)
+                if self.image_effect is None:
+                    band = self.snapshot.region((0, y0, width, y1))
+                else:
+                    py0, py1 = max(0, y0 - halo), min(height, y1 + halo)
+                    band = self.CV.apply_filter(self.snapshot.region((0, py0, width, py1)),
+                                                self.image_effect)[y0 - py0:y1 - py0]
+                    band = band if band.ndim == 2 else cv2.cvtColor(band, cv2.COLOR_RGB2BGR)
+                self.progress.emit(100 * y1 // height)
+                yield band
+
+        if extension == '.npy' and grey:
+            raise ValueError('grey effects cannot be saved as .npy')
+        temp_path = self.path + '.part'
+        try:
+            with open(temp_path, 'wb') as file:
+                writeBands(file, extension, shape, bands())
+            if self.cancelled:
+                os.remove(temp_path)
+                return None
+            os.replace(temp_path, self.path)
+        except (OSError, ValueError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.path
+
+    def filterImage(self, image):
+        """
+        Apply the effect in bands padded with its halo, reporting progress between bands, and return BGR or grey.
+        """
+        height = image.shape[0]
+        halo, align = self.CV.getBandHalo(self.image_effect)
+        rows = -(-max(height // 16, halo * 4, 64) // align) * align
+        bands = []
+        for y0 in range(0, height, rows):
+            if self.cancelled:
+                return image
+            y1 = min(y0 + rows, height)
+            py0, py1 = max(0, y0 - halo), min(height, y1 + halo)
+            bands.append(self.CV.apply_filter(image[py0:py1], self.image_effect)[y0 - py0:y1 - py0])
+            self.progress.emit(60 * y1 // height)
+        image = np.concatenate(bands)
+        # apply_filter returns RGB for display, imencode expects BGR
+        return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
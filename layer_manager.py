@@ -0,0 +1,409 @@
+import itertools
+import sys
+import time
+import numpy as np
+import cv2
+
+from tile_manager import TileManager
+from cv_manager import CVManager
+from storage_manager import pristine, bandRows
+
+BLEND_MODES = ['normal', 'multiply', 'screen', 'add']
+# Ids telling layers apart for as long as the process runs, even once their list index changes
+LAYER_IDS = itertools.count(1)
+
+
+class Layer:
+    """
+    One layer of the document. The background holds BGR pixels and covers what is below it,
+    layers added on top hold premultiplied BGRA pixels and start transparent. Premultiplied is what OpenCV draws:
+    an anti-aliased edge on a transparent layer scales every channel, colour included, by its coverage.
+    """
+    def __init__(self, name, image):
+        self.uid = next(LAYER_IDS)
+        self.name = name
+        self.opacity = 1.0
+        self.visible = True
+        self.blend = 'normal'
+        self.tiles = TileManager()
+        self.load(image)
+
+    def load(self, image):
+        """
+        Replace the pixels of the layer, such as after a rotate.
+        """
+        self.image = image
+        if image.shape[2] == 4 and not image[..., 3].any():
+            # Rect of everything drawn on the layer, so edits elsewhere can skip it. None while empty
+            self.bounds = None
+            self.tiles.loadBlank(image.shape)
+        else:
+            self.bounds = (0, 0, image.shape[1], image.shape[0])
+            saved = pristine(image)
+            if saved is not None:
+                # Disk backed pixels are still in their file as opened, so the tiles read it instead of copying
+                self.tiles.loadShared(saved)
+            else:
+                self.tiles.load(image)
+
+    def mark(self, rect):
+        """
+        Grow the bounds of the layer by a rect that was drawn on.
+        """
+        if rect is None:
+            return
+        if self.bounds is None:
+            self.bounds = rect
+        else:
+            self.bounds = (min(self.bounds[0], rect[0]), min(self.bounds[1], rect[1]),
+                           max(self.bounds[2], rect[2]), max(self.bounds[3], rect[3]))
+
+    def withImage(self, image):
+        """
+        Get a layer with the same name and settings holding other pixels.
+        """
+        layer = Layer(self.name, image)
+        layer.opacity = self.opacity
+        layer.visible = self.visible
+        layer.blend = self.blend
+        return layer
+
+    def clearColor(self):
+        """
+        Get the color that erases on this layer: white on the background, transparent above it.
+        """
+        return (255, 255, 255) if self.image.shape[2] == 3 else (0, 0, 0, 0)
+
+    def isPlain(self):
+        """
+        Check if the layer shows exactly its own pixels: BGR, visible, fully opaque and blended normally.
+        """
+        return self.image.shape[2] == 3 and self.visible and self.opacity >= 1 and self.blend == 'normal'
+
+
+class LayerManager:
+    """
+    Stack of layers, bottom first, and the cached composite of the visible ones.
+    The composite is only recomputed over the rects that changed, from a cache of the layers below the active one,
+    the active layer and a premultiplied cache of the layers above it, so an edit costs the same however many
+    layers there are. Layers whose bounds miss a rect are skipped.
+    """
+    def __init__(self):
+        self.layers = []
+        self.active = 0
+        self.flat = None
+        self.below = None
+        self.above = None
+        # Rect of everything in the cache above, None while it is empty, and the index of the first layer left out
+        self.above_bounds = None
+        self.above_end = 0
+        self.cache_valid = False
+        self.count = 0
+        # Allocate the composite caches and fill the pixels of new layers, replaced to keep them on disk for large
+        # canvases
+        self.allocate = lambda shape: np.empty(shape, dtype=np.uint8)
+        self.full = lambda shape, color: np.full(shape, color, dtype=np.uint8)
+
+    def reset(self, image):
+        """
+        Start a new stack holding only a background of the image.
+        """
+        self.layers = [Layer('Background', image)]
+        self.active = 0
+        self.count = 0
+        self.invalidate()
+
+    def restore(self, layers, active):
+        """
+        Replace the stack with layers brought back from elsewhere, such as an autosave.
+        """
+        self.layers = list(layers)
+        self.active = max(0, min(active, len(self.layers) - 1))
+        self.count = len(self.layers) - 1
+        self.invalidate()
+
+    def activeLayer(self):
+        return self.layers[self.active]
+
+    def select(self, index):
+        """
+        Make the layer at index the active one.
+        """
+        index = max(0, min(index, len(self.layers) - 1))
+        if index != self.active:
+            self.active = index
+            self.invalidate()
+
+    def addLayer(self):
+        """
+        Add a transparent layer above the active one and make it active.
+        """
+        height, width = self.layers[0].image.shape[:2]
+        self.count += 1
+        self.layers = self.layers[:self.active + 1] + \
+            [Layer(f'Layer {self.count}', self.full((height, width, 4), 0))] + \
+            self.layers[self.active + 1:]
+        self.active += 1
+        self.invalidate()
+
+    def removeLayer(self):
+        """
+        Remove the active layer, keeping at least one.
+        """
+        if len(self.layers) == 1:
+            return False
+        self.layers = self.layers[:self.active] + self.layers[self.active + 1:]
+        self.active = min(self.active, len(self.layers) - 1)
+        self.invalidate()
+        return True
+
+    def moveLayer(self, step):
+        """
+        Move the active layer up or down the stack by step.
+        """
+        index = self.active + step
+        if not 0 <= index < len(self.layers):
+            return False
+        layers = list(self.layers)
+        layers[self.active], layers[index] = layers[index], layers[self.active]
+        self.layers = layers
+        self.active = index
+        self.invalidate()
+        return True
+
+    def invalidate(self):
+        """
+        Mark the caches of the layers below and above the active one as stale, after the stack or their settings
+        changed.
+        """
+        self.cache_valid = False
+
+    def describe(self):
+        """
+        Get a readable summary of the active layer for the status bar.
+        """
+        layer = self.activeLayer()
+        text = f'{layer.name} ({self.active + 1}/{len(self.layers)}) {layer.opacity:.0%} {layer.blend}'
+        return text if layer.visible else text + ' hidden'
+
+    def flatten(self):
+        """
+        Get the composite as last rendered, which is the layer itself when a lone plain layer is all there is.
+        """
+        if len(self.layers) == 1 and self.layers[0].isPlain():
+            return self.layers[0].image
+        if self.flat is None:
+            return self.composite()
+        return self.flat
+
+    def composite(self, rect=None):
+        """
+        Bring the composite up to date over rect, or the whole image, and return it.
+        """
+        if len(self.layers) == 1 and self.layers[0].isPlain():
+            return self.layers[0].image
+        height, width = self.layers[0].image.shape[:2]
+        if self.flat is None or self.flat.shape[:2] != (height, width):
+            self.flat = self.allocate((height, width, 3))
+            self.below = self.allocate((height, width, 3))
+            self.cache_valid = False
+            rect = None
+        if not self.cache_valid:
+            self.below[:] = 255
+            for layer in self.layers[:self.active]:
+                self.blendLayer(self.below, layer, layer.bounds)
+            self.cacheAbove()
+            self.cache_valid = True
+        rect = (0, 0, width, height) if rect is None else rect
+        x0, y0, x1, y1 = rect
+        self.flat[y0:y1, x0:x1] = self.below[y0:y1, x0:x1]
+        # The active layer may be mid stroke, ahead of its bounds
+        self.blendLayer(self.flat, self.activeLayer(), rect)
+        self.blendAbove(self.flat, self.clipRect(rect, self.above_bounds))
+        for layer in self.layers[self.above_end:]:
+            self.blendLayer(self.flat, layer, self.clipRect(rect, layer.bounds))
+        return self.flat
+
+    def cacheAbove(self):
+        """
+        Composite the layers above the active one into a premultiplied BGRA cache, up to the first visible one
+        with a blend mode other than normal, whose result depends on what is below it.
+        """
+        self.above_end = self.active + 1
+        self.above_bounds = None
+        for layer in self.layers[self.active + 1:]:
+            if not layer.visible or layer.opacity <= 0:
+                self.above_end += 1
+                continue
+            if layer.blend != 'normal':
+                break
+            self.above_end += 1
+            self.above_bounds = CVManager.unionRect(self.above_bounds, layer.bounds)
+        if self.above_bounds is None:
+            return
+        if self.above is None or self.above.shape[:2] != self.flat.shape[:2]:
+            self.above = self.allocate(self.flat.shape[:2] + (4,))
+        x0, y0, x1, y1 = self.above_bounds
+        self.above[y0:y1, x0:x1] = 0
+        for layer in self.layers[self.active + 1:self.above_end]:
+            self.blendLayer(self.above, layer, self.clipRect(self.above_bounds, layer.bounds))
+
+    def blendAbove(self, out, rect):
+        """
+        Blend the cache of the layers above the active one onto a BGR image over rect.
+        """
+        if rect is None:
+            return
+        x0, y0, x1, y1 = rect
+        rows = bandRows((y1 - y0, x1 - x0, 16))
+        for top in range(y0, y1, rows):
+            bottom = min(top + rows, y1)
+            self.blendOver(out[top:bottom, x0:x1], self.above[top:bottom, x0:x1], 1)
+
+    def blendLayer(self, out, layer, rect):
+        """
+        Blend a layer onto a BGR image, or the premultiplied BGRA cache above, over rect with its opacity and blend
+        mode. BGRA layers are premultiplied, so a normal blend adds their colour scaled by the opacity only.
+        """
+        if rect is None or not layer.visible or layer.opacity <= 0:
+            return
+        x0, y0, x1, y1 = rect
+        if x0 >= x1 or y0 >= y1:
+            return
+        rows = bandRows((y1 - y0, x1 - x0, 16))
+        if y1 - y0 > rows:
+            # Large rects are blended in row bands, bounding the float temporaries
+            for top in range(y0, y1, rows):
+                self.blendLayer(out, layer, (x0, top, x1, min(top + rows, y1)))
+            return
+        source = layer.image[y0:y1, x0:x1]
+        target = out[y0:y1, x0:x1]
+        if target.shape[2] == 4 or (layer.blend == 'normal' and source.shape[2] == 4):
+            # Only normal layers go into the cache above, where a BGR one covers what is below it
+            if source.shape[2] == 3:
+                source = cv2.cvtColor(source, cv2.COLOR_BGR2BGRA)
+            self.blendOver(target, source, layer.opacity)
+            return
+        if layer.isPlain():
+            target[:] = source
+            return
+        if source.shape[2] == 4:
+            alpha = source[..., 3].astype(np.float32) * (layer.opacity / 255)
+        else:
+            alpha = np.full(target.shape[:2], layer.opacity, dtype=np.float32)
+        top = source[..., :3]
+        if layer.blend != 'normal':
+            top = top.astype(np.float32)
+            if source.shape[2] == 4:
+                # Blend modes combine straight colours, so the coverage is divided back out first
+                coverage = source[..., 3:].astype(np.float32) / 255
+                top = np.minimum(np.divide(top, coverage, out=np.zeros_like(top), where=coverage > 0), 255)
+            base = target.astype(np.float32)
+            if layer.blend == 'multiply':
+                top *= base / 255
+            elif layer.blend == 'screen':
+                top = 255 - (255 - top) * (255 - base) / 255
+            elif layer.blend == 'add':
+                top = np.minimum(top + base, 255)
+            top = (top + 0.5).astype(np.uint8)
+        target[:] = cv2.blendLinear(np.ascontiguousarray(top), target, alpha, 1 - alpha)
+
+    def blendOver(self, target, source, opacity):
+        """
+        Blend premultiplied BGRA pixels scaled by opacity over BGR or premultiplied BGRA ones, in place.
+        """
+        alpha = source[..., 3:].astype(np.float32) * (opacity / 255)
+        result = source[..., :target.shape[2]].astype(np.float32) * opacity + target.astype(np.float32) * (1 - alpha)
+        target[:] = np.minimum(result + 0.5, 255).astype(np.uint8)
+
+    def clipRect(self, rect, bounds):
+        """
+        Get the part of rect inside bounds, or None.
+        """
+        if bounds is None:
+            return None
+        x0, y0 = max(rect[0], bounds[0]), max(rect[1], bounds[1])
+        x1, y1 = min(rect[2], bounds[2]), min(rect[3], bounds[3])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+
+def benchmark(size=(3840, 2160), count=20, strokes=200, rect=64):
+    """
+    Compare painting on a single flat image with painting on the background under count layers, each holding
+    a band of semi-transparent content. Every painted rect is drawn, composited and converted for display,
+    as Core does. Returns mean milliseconds per rect by layer count.
+    """
+    width, height = size
+    cv = CVManager()
+    display = np.empty((height, width, 4), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    results = {}
+    for layers_count in (1, count):
+        stack = LayerManager()
+        stack.reset(np.full((height, width, 3), 255, dtype=np.uint8))
+        for index in range(layers_count - 1):
+            stack.addLayer()
+            layer = stack.activeLayer()
+            band = (0, index * height // count, width, (index + 2) * height // count)
+            layer.image[band[1]:band[3], band[0]:band[2]] = (40 * index % 255, 90, 160, 128)
+            layer.mark(band)
+        stack.select(0)
+        stack.composite()
+        target = stack.activeLayer()
+        points = rng.integers(0, [width - rect, height - rect], (strokes, 2))
+        start = time.perf_counter()
+        for x, y in points:
+            cv2.circle(target.image, (int(x) + rect // 2, int(y) + rect // 2), rect // 3,
+                       (0, 0, 0) + ((255,) if target.image.shape[2] == 4 else ()), -1)
+            painted = (int(x), int(y), int(x) + rect, int(y) + rect)
+            cv.toDisplay(stack.composite(painted), display, rect=painted)
+        results[layers_count] = (time.perf_counter() - start) / strokes * 1e3
+    return results
+
+
+def checkStrokes(count=200, size=96, report=print):
+    """
+    Draw random anti-aliased strokes on an upper layer and directly on the background, and compare the composites.
+    On an opaque upper layer they must match exactly. On a transparent one OpenCV rounds its fixed point blend of
+    edge pixels differently than over the background, a few steps at most and well under one on average.
+    Returns True when every stroke matches.
+    """
+    cv = CVManager()
+    rng = np.random.default_rng(0)
+    worst = {'opaque': 0, 'transparent': 0}
+    total, pixels = 0, 0
+    for _ in range(count):
+        background, paper, color = (tuple(int(v) for v in rng.integers(0, 256, 3)) for _ in range(3))
+        start, end = (tuple(int(v) for v in rng.integers(0, size, 2)) for _ in range(2))
+        thickness = int(rng.integers(1, 12))
+        for kind, fill in (('opaque', paper + (255,)), ('transparent', None)):
+            stack = LayerManager()
+            stack.reset(np.full((size, size, 3), background, dtype=np.uint8))
+            stack.addLayer()
+            layer = stack.activeLayer()
+            if fill is not None:
+                layer.image[:] = fill
+            layer.mark(cv.drawLine(layer.image, start, end, color + (255,), thickness))
+            direct = np.full((size, size, 3), paper if fill is not None else background, dtype=np.uint8)
+            cv.drawLine(direct, start, end, color, thickness)
+            difference = np.abs(stack.composite().astype(np.int16) - direct)
+            worst[kind] = max(worst[kind], int(difference.max()))
+            if fill is None:
+                stroke = layer.image[..., 3] > 0
+                total += int(difference[stroke].sum())
+                pixels += int(stroke.sum()) * 3
+    mean = total / max(pixels, 1)
+    passed = worst['opaque'] == 0 and worst['transparent'] <= 8 and mean <= 0.5
+    report(f"{'ok' if passed else 'FAIL'} {count} strokes: opaque layer max {worst['opaque']}, "
+           f"transparent layer max {worst['transparent']} mean {mean:.3f} over the stroke")
+    return passed
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv[1:]:
+        sys.exit(0 if checkStrokes() else 1)
+    result = benchmark()
+    for layers_count, ms in result.items():
+        print(f'{layers_count:>3} layers: {ms:.3f} ms per painted 64x64 rect')
@@ -1,13 +1,28 @@
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QToolBar, QAction
-from PyQt5.QtWidgets import QLabel, QLineEdit, QFileDialog, QDialog, QColorDialog
-from PyQt5.QtGui import QIcon, QPixmap, QPainter, QPen, QImage, QColor, QCursor, QIntValidator
-from PyQt5.QtCore import Qt, QSize, QDir
+from PyQt5.QtWidgets import QLabel, QLineEdit, QFileDialog, QDialog, QColorDialog, QProgressBar, QInputDialog
+from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtGui import QIcon, QPainter, QPen, QImage, QColor, QIntValidator
+from PyQt5.QtCore import Qt, QSize, QDir, QTimer
 import numpy as np
-import pyperclip
-import cv2
+import sys
+import zipfile
 
 from ui_manager import UIManager
 from cv_manager import CVManager
+from overlay_manager import OverlayManager
+from tile_manager import TileManager
+from history_manager import HistoryManager, RegionEdit, TransformEdit, LayersEdit
+from stroke_manager import StrokeManager
+from io_manager import LoadWorker, SaveWorker
+from effect_manager import EffectStack
+from profile_manager import ProfileManager
+from asset_manager import AssetManager
+from selection_manager import Selection
+from layer_manager import Layer, LayerManager, BLEND_MODES
+from viewport_manager import Viewport
+from storage_manager import StorageManager, pristine
+from autosave_manager import AutosaveManager
+from project_manager import ProjectManager, ProjectLoadWorker, ProjectSaveWorker
 
 
 class Core(QMainWindow):
@@ -23,7 +38,35 @@ class Core(QMainWindow):
 
         # Initialize UI and CV managers
         self.UI = UIManager()
+        self.assets = AssetManager()
         self.CV = CVManager()
+        self.overlay = OverlayManager()
+        self.view = Viewport(self.CV)
+        # Largest canvas, beyond which the document is zoomed out or panned rather than shrunk
+        self.view_limit = (width, height - 75)
+        self.pan_position = None
+        self.storage = StorageManager()
+        self.layers = LayerManager()
+        self.layers.allocate = self.storage.allocate
+        self.layers.full = self.storage.full
+        # Tiles of the active layer, replaced whenever another layer is selected
+        self.tiles = TileManager()
+        self.history = HistoryManager()
+        self.stroke = StrokeManager(self.CV, flush_interval=1 / 120)
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.timeout.connect(self.flushStroke)
+        self.refine_timer = QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.timeout.connect(self.refineRegion)
+        self.io_worker = None
+        self.project = ProjectManager()
+        self.profile = ProfileManager()
+        self.profile_timer = QTimer(self)
+        self.profile_timer.timeout.connect(lambda: self.frame_time.setText(self.profile.summary()))
+        self.autosave = AutosaveManager()
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosaveCanvas)
         self.app = app
 
         # Initialize main container
@@ -42,8 +85,11 @@ class Core(QMainWindow):
         # Initialize variables for image manipulation
         self.canvas = None
         self.image = None
-        self.image_copy = None
+        self.image_version = 0
+        self.stroke_rect = None
+        self.proxy_rect = None
         self.image_effect = None
+        self.effects = EffectStack()
         self.hold = None
         self.start_pos = None
         self.pointer_position = None
@@ -53,6 +99,8 @@ class Core(QMainWindow):
         self.font_data = [0, 0 + (0.05 * 6)]
         self.thickness = 1
         self.shape_state = [None, None]
+        self.fill_state = [None, True]
+        self.fill_tolerance = 32
         self.active_tool = None
         self.text_block = None
         self.text_block_content = ''
@@ -62,8 +110,10 @@ class Core(QMainWindow):
         self.last_key = None
         self.selection = None
         self.selection_move = False
-        self.selection_state = False
-        self.cropped_image = None
+        self.selection_mode = None
+        self.lasso = None
+        self.shapes = ['line', 'circle', 'triangle', 'rectangle', 'pentagon', 'hexagon', 'diamond']
+        self.selectors = ['pointer', 'lasso', 'wand']
 
         # Load menu bar, status bar, and tool bar
         self.loadMenuBar()
@@ -75,6 +125,10 @@ class Core(QMainWindow):
         """
         Handle mouse press events based on active tool and canvas
         """
+        if self.canvas and event.button() == Qt.MouseButton.MiddleButton:
+            # Dragging with the middle button pans the view
+            self.pan_position = (event.pos().x(), event.pos().y())
+            return
         if self.canvas and self.active_tool:
             if self.canvas.underMouse():
                 x, y = self.innerMousePos(event, self.canvas.geometry())
@@ -90,122 +144,113 @@ class Core(QMainWindow):
                     self.active_color = self.secondary_color[1]
 
                 if event.button() == Qt.MouseButton.RightButton or event.button() == Qt.MouseButton.LeftButton:
-                    if self.active_tool[1] == 'pointer':
-                        if self.selection_state:
-                            t_x, t_y = self.getMinMax(self.selection[0], self.selection[1])
-                            if t_x[0] < x < t_x[1] and t_y[0] < y < t_y[1]:
-                                self.selection_move = True
+                    if self.active_tool[1] == 'draw' or self.active_tool[1] == 'eraser':
+                        color = self.paintColor(self.image, self.active_color)
+                        if self.active_tool[1] == 'eraser':
+                            # Erasing whitens the background and clears the layers above it
+                            color = self.layers.activeLayer().clearColor()
+                        self.stroke_rect = None
+                        self.stroke.begin((x, y), color, self.thickness)
+                    elif self.active_tool[1] in self.selectors:
+                        self.selection_mode = self.selectionMode(event.modifiers())
+                        if self.active_tool[1] == 'pointer' and self.selection_mode is None and \
+                                self.selection is not None and self.selection.contains(x, y):
+                            self.selection_move = True
+                            if self.selection.pixels is None:
+                                # Cut the selected pixels out the first time they are moved
+                                rect = self.selection.lift(self.image, self.layers.activeLayer().clearColor())
+                                self.touchImage()
+                                self.commitImage(rect, 'cut')
+                                self.renderRegion(rect)
+                                self.previewSelection()
+                        elif self.active_tool[1] == 'lasso':
+                            self.lasso = [(x, y)]
+                        elif self.active_tool[1] == 'wand':
+                            self.setSelection(Selection.fromColor(self.layers.flatten(), (x, y), self.fill_tolerance,
+                                                                  self.fill_state[1]))
                     elif self.active_tool[1] == 'dropper':
                         if event.button() == event.button() == Qt.MouseButton.RightButton:
-                            self.secondary_color[1] = [int(num) for num in self.image[y][x]]
+                            self.secondary_color[1] = [int(num) for num in self.layers.flatten()[y][x]]
                             square = np.full((20, 20, 3), self.secondary_color[1], dtype=np.uint8)
                             self.secondary_color[0].setIcon(self.CV.toIcon(square))
                             self.active_color = self.secondary_color[1]
                         else:
-                            self.primary_color[1] = [int(num) for num in self.image[y][x]]
+                            self.primary_color[1] = [int(num) for num in self.layers.flatten()[y][x]]
                             square = np.full((20, 20, 3), self.primary_color[1], dtype=np.uint8)
                             self.primary_color[0].setIcon(self.CV.toIcon(square))
                             self.active_color = self.primary_color[1]
+                    elif self.active_tool[1] == 'fill':
+                        # Colors are matched on what is shown and filled into the active layer
+                        rect = self.CV.floodFill(self.image, (x, y), self.paintColor(self.image, self.active_color),
+                                                 self.fill_tolerance, self.fill_state[1],
+                                                 reference=self.layers.flatten())
+                        self.touchImage()
+                        self.commitImage(rect, 'fill')
+                        self.renderRegion(rect)
                     elif self.active_tool[1] == 'text':
                         if self.text_mode:
                             self.text_mode = False
                             self.text_block_content = ''
-                            cv2.putText(self.image, self.text_block.text(), (self.start_pos[0], self.start_pos[1]),
-                                        self.font_data[0],
-                                        self.font_data[1], self.text_color, self.thickness)
+                            self.canvas.updateOverlay(self.overlay.clear())
+                            rect = self.CV.drawText(self.image, self.text_block.text(), self.start_pos,
+                                                    self.font_data[0], self.font_data[1],
+                                                    self.paintColor(self.image, self.text_color), self.thickness)
+                            self.touchImage()
+                            self.commitImage(rect, 'text')
+                            self.renderRegion(rect)
                             self.text_color = None
                         else:
                             self.text_mode = True
                             self.text_block = QLineEdit(self)
                             self.text_color = self.active_color
                             self.text_block.setText('Enter Text')
-                            self.image_copy = self.image.copy()
-                            cv2.putText(self.image, self.text_block.text(), (self.start_pos[0], self.start_pos[1]),
-                                        self.font_data[0], self.font_data[1], self.text_color, self.thickness)
-                            self.renderImage()
-                            self.image = self.image_copy
+                            self.previewText(self.text_color)
 
     # Mouse release event handler
     def mouseReleaseEvent(self, event):
         """
         Handle mouse release events based on active tool and canvas
         """
+        if event.button() == Qt.MouseButton.MiddleButton:
+            self.pan_position = None
+            return
         if self.canvas and self.active_tool:
             if event.button() == Qt.MouseButton.LeftButton or event.button() == Qt.MouseButton.RightButton:
                 x, y = self.innerMousePos(event, self.canvas.geometry())
                 if not self.active_tool[1] == 'text':
-                    self.image_copy = self.image.copy()
                     if self.active_tool[1] == 'pointer':
-                        if self.selection_state:
-                            t_x, t_y = self.getMinMax(self.selection[0], self.selection[1])
-                            if t_x[0] < x < t_x[1] and t_y[0] < y < t_y[1]:
-                                self.CV.drawDashRect(self.image, self.selection[0], self.selection[1], (0, 0, 0))
-                                self.image = self.CV.drawImage(self.image, self.selection[0], self.selection[1],
-                                                               self.cropped_image,
-                                                               (self.canvas.width(), self.canvas.height()))
-                                self.renderImage()
-                                self.image = self.image_copy
-                                self.selection_move = False
-                            else:
-                                self.image = self.CV.drawImage(self.image, self.selection[0], self.selection[1],
-                                                               self.cropped_image,
-                                                               (self.canvas.width(), self.canvas.height()))
-                                self.renderImage()
-                                self.selection = None
-                                self.selection_state = None
-                                self.cropped_image = None
-                            self.hold = False
-                            return
+                        if self.selection_move:
+                            self.selection_move = False
                         else:
-                            self.CV.drawDashRect(self.image, self.start_pos, (x, y), (0, 0, 0))
-                            self.selection = (self.start_pos, (x, y))
-                            self.cropped_image = self.CV.cropImage(self.image, self.selection[0], self.selection[1])
-                            self.renderImage()
-                            self.image = self.image_copy
-                            white_refiller = np.full(self.cropped_image.shape, (255, 255, 255), dtype=np.uint8)
-                            self.image_copy = self.CV.drawImage(self.image, self.selection[0], self.selection[1],
-                                                                white_refiller,
-                                                                (self.canvas.width(), self.canvas.height()))
-                            self.selection_state = True
-                            self.hold = False
-                            return
-                    elif self.active_tool[1] == 'line':
-                        self.CV.drawLine(self.image, self.start_pos, (x, y), self.active_color, self.thickness)
-                    elif self.active_tool[1] == 'circle':
-                        self.CV.drawElipse(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                           self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'triangle':
-                        self.CV.drawTriangle(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                             self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'rectangle':
-                        self.CV.drawRectangle(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                              self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'pentagon':
-                        self.CV.drawPentagon(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                             self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'hexagon':
-                        self.CV.drawHexagon(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                            self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'diamond':
-                        self.CV.drawDiamond(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                            self.secondary_color[1], self.shape_state[1])
-                    elif self.active_tool[1] == 'crop':
-                        if self.selection:
-                            self.image = np.full((self.cropped_image.shape[0], self.cropped_image.shape[1], 3),
-                                                 [255, 255, 255],
-                                                 dtype=np.uint8)
-
-                            self.image[0:self.cropped_image.shape[0],
-                            0:self.cropped_image.shape[1]] = self.cropped_image
-                            self.setNewCanvas(self.canvas.width() * 2, self.canvas.height() * 2, image=self.image)
-
-                    self.renderImage()
+                            self.setSelection(Selection.fromRect(self.start_pos, (x, y), self.image.shape))
+                    elif self.active_tool[1] == 'lasso':
+                        if self.lasso:
+                            self.setSelection(Selection.fromPolygon(self.lasso + [(x, y)], self.image.shape))
+                        self.lasso = None
+                    elif self.active_tool[1] in self.shapes:
+                        self.canvas.updateOverlay(self.overlay.clear())
+                        rect = self.drawShape(self.image, self.start_pos, (x, y))
+                        self.touchImage()
+                        self.commitImage(rect, self.active_tool[1])
+                        self.renderRegion(rect)
+                    elif self.active_tool[1] == 'draw' or self.active_tool[1] == 'eraser':
+                        self.stroke_timer.stop()
+                        self.stroke.addPoint((x, y))
+                        self.flushStroke(end=True)
+                        self.commitImage(self.stroke_rect, 'stroke')
+                        self.stroke_rect = None
                 self.hold = False
+                self.refineRegion()
 
     def mouseMoveEvent(self, event):
         """
         Handle mouse move events based on active tool and canvas
         """
+        if self.canvas and self.pan_position is not None:
+            x, y = event.pos().x(), event.pos().y()
+            self.panView(self.pan_position[0] - x, self.pan_position[1] - y)
+            self.pan_position = (x, y)
+            return
         if self.canvas:
             if self.canvas.underMouse():
                 x, y = self.innerMousePos(event, self.canvas.geometry())
@@ -213,115 +258,79 @@ class Core(QMainWindow):
 
                 # Check if a tool is active and if the mouse is held down
                 if self.hold and self.active_tool:
-                    self.image_copy = self.image.copy()
-
                     # Handle drawing and erasing tools
                     if self.active_tool[1] == 'draw' or self.active_tool[1] == 'eraser':
-                        if self.active_tool[1] == 'eraser':
-                            self.active_color = [255, 255, 255]
-
-                        # Calculate distance between current and previous position for smoother drawing
-                        if self.start_pos:
-                            dist = np.sqrt((x - self.start_pos[0]) ** 2 + (y - self.start_pos[1]) ** 2)
-                            if dist < 5:
-                                cv2.line(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                         cv2.LINE_AA)
-                            else:
-                                num_points = max(int(dist), 1)
-                                xs = np.linspace(self.start_pos[0], x, num_points).astype(int)
-                                ys = np.linspace(self.start_pos[1], y, num_points).astype(int)
-
-                                for i in range(num_points - 1):
-                                    cv2.line(self.image, (xs[i], ys[i]), (xs[i + 1], ys[i + 1]), self.active_color,
-                                             self.thickness,
-                                             cv2.LINE_AA)
-
-                        else:
-                            cv2.circle(self.image, (x, y), self.thickness // 2, self.active_color, -1)
-
+                        # Samples are queued and rasterized in batches by the stroke engine
+                        self.stroke.addPoint((x, y))
+                        self.flushStroke()
                         self.start_pos = (x, y)
-                        self.renderImage()
                         return
 
-                    # Handle other drawing tools
+                    # Handle other drawing tools, previewed on the overlay
                     else:
                         if self.active_tool[1] == 'pointer':
-                            if not self.selection_state:
-                                self.CV.drawDashRect(self.image, self.start_pos, (x, y), (0, 0, 0))
+                            if self.selection_move:
+                                # Only the bounding rects of the old and new position are redrawn
+                                self.selection.move(x - self.start_pos[0], y - self.start_pos[1])
+                                self.start_pos = (x, y)
+                                self.previewSelection()
                             else:
-                                t_x, t_y = self.getMinMax(self.selection[0], self.selection[1])
-                                if t_x[0] < x < t_x[1] and t_y[0] < y < t_y[1]:
-                                    start_pos, current_pos = self.CV.drawDashRect(self.image, self.selection[0],
-                                                                                  self.selection[1], (0, 0, 0),
-                                                                                  (self.start_pos, (x, y)))
-
-                                    self.image = self.CV.drawImage(self.image, start_pos, current_pos,
-                                                                   self.cropped_image,
-                                                                   (self.canvas.width(), self.canvas.height()))
-                                    self.selection = (start_pos, current_pos)
-                                    self.renderImage()
-                                    self.start_pos = (x, y)
-                        elif self.active_tool[1] == 'line':
-                            self.CV.drawLine(self.image, self.start_pos, (x, y), self.active_color, self.thickness)
-                        elif self.active_tool[1] == 'circle':
-                            self.CV.drawElipse(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                               self.secondary_color[1], self.shape_state[1])
-                        elif self.active_tool[1] == 'triangle':
-                            self.CV.drawTriangle(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                                 self.secondary_color[1], self.shape_state[1])
-                        elif self.active_tool[1] == 'rectangle':
-                            self.CV.drawRectangle(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                                  self.secondary_color[1], self.shape_state[1])
-                        elif self.active_tool[1] == 'pentagon':
-                            self.CV.drawPentagon(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                                 self.secondary_color[1], self.shape_state[1])
-                        elif self.active_tool[1] == 'hexagon':
-                            self.CV.drawHexagon(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                                self.secondary_color[1], self.shape_state[1])
-                        elif self.active_tool[1] == 'diamond':
-                            self.CV.drawDiamond(self.image, self.start_pos, (x, y), self.active_color, self.thickness,
-                                                self.secondary_color[1], self.shape_state[1])
-
-                    self.renderImage()
-                    self.image = self.image_copy
+                                cleared = self.overlay.clear()
+                                self.CV.drawDashRect(self.overlay.buffer, self.start_pos, (x, y), (0, 0, 0, 255))
+                                rect = self.CV.getRect([self.start_pos, (x, y)], 1, self.image.shape)
+                                self.refreshOverlay(cleared, self.CV.unionRect(rect, self.drawSelection()))
+                        elif self.active_tool[1] == 'lasso' and self.lasso:
+                            # The path only grows, so each move draws just its newest segment
+                            rect = self.CV.drawLine(self.overlay.buffer, self.lasso[-1], (x, y), (0, 0, 0, 255), 1)
+                            self.lasso.append((x, y))
+                            self.refreshOverlay(None, rect)
+                        elif self.active_tool[1] in self.shapes:
+                            cleared = self.overlay.clear()
+                            self.refreshOverlay(cleared, self.drawShape(self.overlay.buffer, self.start_pos, (x, y)))
 
                 # Set cursor based on active tool
                 if self.active_tool:
                     if self.canvas.underMouse():
-                        if self.active_tool[1] == 'pointer' and self.selection_state:
-                            t_x, t_y = self.getMinMax(self.selection[0], self.selection[1])
-                            if t_x[0] < x < t_x[1] and t_y[0] < y < t_y[1]:
-                                self.app.setOverrideCursor(Qt.SizeAllCursor)
+                        if self.active_tool[1] == 'pointer' and self.selection is not None:
+                            if self.selection.contains(x, y):
+                                self.assets.setCursor(self.app, Qt.SizeAllCursor)
                             else:
-                                self.app.setOverrideCursor(Qt.ArrowCursor)
-                        elif self.active_tool[1] == 'draw':
-                            curs = QPixmap('assets/draw.png')
-                            self.app.setOverrideCursor(QCursor(curs.scaled(20, 20), 0, 20))
-                        elif self.active_tool[1] == 'eraser':
-                            curs = QPixmap('assets/eraser.png')
-                            self.app.setOverrideCursor(QCursor(curs.scaled(20, 20), 0, 20))
-                        elif self.active_tool[1] == 'dropper':
-                            curs = QPixmap('assets/dropper.png')
-                            self.app.setOverrideCursor(QCursor(curs.scaled(20, 20), 0, 20))
-                        elif self.active_tool[1] == 'text':
-                            curs = QPixmap('assets/text.png')
-                            self.app.setOverrideCursor(QCursor(curs.scaled(20, 20), 0, 20))
+                                self.assets.setCursor(self.app, Qt.ArrowCursor)
+                        elif self.active_tool[1] in ('lasso', 'wand'):
+                            self.assets.setCursor(self.app, Qt.CrossCursor)
+                        elif self.active_tool[1] in ('draw', 'eraser', 'dropper', 'fill', 'text'):
+                            # Tool cursors are decoded once and only swapped in when the cursor changes
+                            self.assets.setCursor(self.app, self.active_tool[1])
                         else:
-                            self.app.setOverrideCursor(Qt.ArrowCursor)
+                            self.assets.setCursor(self.app, Qt.ArrowCursor)
+
+    def wheelEvent(self, event):
+        """
+        Zoom around the pointer with Ctrl held, otherwise scroll the view, sideways with Shift held.
+        """
+        if self.canvas is None:
+            return
+        delta = event.angleDelta()
+        if event.modifiers() & Qt.ControlModifier:
+            geometry = self.canvas.geometry()
+            anchor = (event.pos().x() - geometry.x(), event.pos().y() - geometry.y() - 56)
+            # One notch zooms by about 19%, and touchpads sending smaller deltas zoom smoothly in proportion
+            self.zoomView(self.view.zoom * 2 ** (delta.y() / 480), anchor)
+        elif event.modifiers() & Qt.ShiftModifier:
+            self.panView(-delta.y(), 0)
+        else:
+            self.panView(-delta.x(), -delta.y())
 
     def keyPressEvent(self, event):
         """
         Handle key press events, especially for text editing mode
         """
-        if event.key() == Qt.Key_Z and self.last_key == Qt.Key_Control:
-            temp = self.image.copy()
-            self.image = self.image_copy
-            self.image_copy = temp
-            self.renderImage()
-        elif self.text_mode:
+        if self.text_mode:
             if event.key() == Qt.Key_V and self.last_key == Qt.Key_Control:
+                import pyperclip
                 self.text_block_content += pyperclip.paste()
             elif event.key() == Qt.Key_C and self.last_key == Qt.Key_Control:
+                import pyperclip
                 pyperclip.copy(self.text_block_content)
                 return
             elif event.key() == Qt.Key_Backspace:
@@ -329,9 +338,13 @@ class Core(QMainWindow):
             elif event.key() == Qt.Key_Return:
                 self.text_mode = False
                 self.text_block_content = ''
-                cv2.putText(self.image, self.text_block.text(), (self.start_pos[0], self.start_pos[1]),
-                            self.font_data[0],
-                            self.font_data[1], self.active_color, self.thickness)
+                self.canvas.updateOverlay(self.overlay.clear())
+                rect = self.CV.drawText(self.image, self.text_block.text(), self.start_pos, self.font_data[0],
+                                        self.font_data[1], self.paintColor(self.image, self.active_color),
+                                        self.thickness)
+                self.touchImage()
+                self.commitImage(rect, 'text')
+                self.renderRegion(rect)
                 return
             elif event.key() == Qt.Key_CapsLock:
                 self.text_caps = 1 if self.text_caps == 0 else 0
@@ -342,11 +355,7 @@ class Core(QMainWindow):
                 key = event.key() + (32 * self.text_caps)
                 self.text_block_content += chr(key)
             self.text_block.setText(self.text_block_content)
-            self.image_copy = self.image.copy()
-            cv2.putText(self.image, self.text_block.text(), (self.start_pos[0], self.start_pos[1]), self.font_data[0],
-                        self.font_data[1], self.active_color, self.thickness)
-            self.renderImage()
-            self.image = self.image_copy
+            self.previewText(self.active_color)
 
         self.last_key = event.key()
 
@@ -359,13 +368,66 @@ class Core(QMainWindow):
 
         # Add menu items for file operations
         self.UI.MenuItem(menu=file_menu, name="&New", action=lambda: self.setCanvasDialog(), short_key='Ctrl+N',
-                         icon='assets/new.jpg')
+                         icon=self.assets.icon('new.jpg'))
         self.UI.MenuItem(menu=file_menu, name="&Open", action=lambda: self.fileDialog(mode='open'), short_key='Ctrl+O',
-                         icon='assets/open.jpg')
+                         icon=self.assets.icon('open.jpg'))
         self.UI.MenuItem(menu=file_menu, name="&Save", action=lambda: self.fileDialog(mode='save'), short_key='Ctrl+S',
-                         icon='assets/save.jpg')
+                         icon=self.assets.icon('save.jpg'))
+        self.UI.MenuItem(menu=file_menu, name="&Disk Backing", action=lambda: self.toggleStorage())
         self.UI.MenuItem(menu=file_menu, name="&Exit", action=lambda: self.close(), short_key='Ctrl+E',
-                         icon='assets/exit.jpg')
+                         icon=self.assets.icon('exit.jpg'))
+
+        # Add menu items for history operations
+        edit_menu = menu.addMenu('&Edit')
+        self.UI.MenuItem(menu=edit_menu, name="&Undo", action=lambda: self.undo(), short_key='Ctrl+Z')
+        self.UI.MenuItem(menu=edit_menu, name="&Redo", action=lambda: self.redo(), short_key='Ctrl+Y')
+        self.UI.MenuItem(menu=edit_menu, name="Select &All", action=lambda: self.selectAll(), short_key='Ctrl+A')
+        self.UI.MenuItem(menu=edit_menu, name="&Deselect", action=lambda: self.dropSelection(), short_key='Ctrl+D')
+
+        # Add menu items for zooming the view
+        view_menu = menu.addMenu('&View')
+        self.UI.MenuItem(menu=view_menu, name="Zoom &In", action=lambda: self.zoomView(self.view.zoom * 2 ** 0.5),
+                         short_key='Ctrl+=')
+        self.UI.MenuItem(menu=view_menu, name="Zoom &Out", action=lambda: self.zoomView(self.view.zoom / 2 ** 0.5),
+                         short_key='Ctrl+-')
+        self.UI.MenuItem(menu=view_menu, name="&Actual Size", action=lambda: self.zoomView(1.0), short_key='Ctrl+1')
+        self.UI.MenuItem(menu=view_menu, name="&Fit to Window", action=lambda: self.zoomView(self.view.fitZoom()),
+                         short_key='Ctrl+0')
+
+        # Add menu items for the effect stack
+        effects_menu = menu.addMenu('Effe&cts')
+        self.UI.MenuItem(menu=effects_menu, name="&Add Stage", action=lambda: self.editEffects('add'),
+                         short_key='Ctrl+Shift+A')
+        self.UI.MenuItem(menu=effects_menu, name="&Remove Stage", action=lambda: self.editEffects('remove'),
+                         short_key='Ctrl+Shift+R')
+        self.UI.MenuItem(menu=effects_menu, name="&Clear Stages", action=lambda: self.editEffects('clear'))
+        self.UI.MenuItem(menu=effects_menu, name="&Fast Blur", action=lambda: self.toggleFastBlur())
+
+        # Add menu items for the layer stack
+        layers_menu = menu.addMenu('&Layers')
+        self.UI.MenuItem(menu=layers_menu, name="&New Layer", action=lambda: self.editLayers('add'),
+                         short_key='Ctrl+Shift+N')
+        self.UI.MenuItem(menu=layers_menu, name="&Delete Layer", action=lambda: self.editLayers('remove'))
+        self.UI.MenuItem(menu=layers_menu, name="&Raise Layer", action=lambda: self.editLayers('raise'),
+                         short_key='Ctrl+]')
+        self.UI.MenuItem(menu=layers_menu, name="&Lower Layer", action=lambda: self.editLayers('lower'),
+                         short_key='Ctrl+[')
+        self.UI.MenuItem(menu=layers_menu, name="Select &Above", action=lambda: self.changeLayer(1),
+                         short_key='Alt+]')
+        self.UI.MenuItem(menu=layers_menu, name="Select &Below", action=lambda: self.changeLayer(-1),
+                         short_key='Alt+[')
+        self.UI.MenuItem(menu=layers_menu, name="&Toggle Visibility", action=lambda: self.layerDialog('visible'))
+        self.UI.MenuItem(menu=layers_menu, name="&Opacity...", action=lambda: self.layerDialog('opacity'))
+        blend_menu = layers_menu.addMenu('&Blend Mode')
+        for mode in BLEND_MODES:
+            self.UI.MenuItem(menu=blend_menu, name=mode.capitalize(), action=lambda _=None, mode=mode:
+                             self.layerDialog(mode))
+
+        # Add menu items for profiling
+        profile_menu = menu.addMenu('&Profile')
+        self.UI.MenuItem(menu=profile_menu, name="&Frame Times", action=lambda: self.toggleProfile(),
+                         short_key='Ctrl+Shift+P')
+        self.UI.MenuItem(menu=profile_menu, name="&Export Trace", action=lambda: self.exportTrace())
 
     def loadStatusBar(self):
         """
@@ -377,14 +439,37 @@ class Core(QMainWindow):
 
         # Add pointer icon
         pointer_icon = QLabel(self)
-        pointer_icon.setPixmap(QIcon('assets/pointer.png').pixmap(QSize(15, 15)))
+        pointer_icon.setPixmap(self.assets.pixmap('pointer.png', (15, 15)))
 
         # Add pointer position label
         self.pointer_position = QLabel(self)
         self.pointer_position.setText("0 , 0")
 
+        # Add frame time readout, shown while profiling
+        self.frame_time = QLabel(self)
+        self.frame_time.hide()
+
+        # Add zoom label
+        self.zoom_label = QLabel(self)
+
+        # Add active layer label
+        self.layer_label = QLabel(self)
+
         statusbar.addWidget(pointer_icon)
         statusbar.addWidget(self.pointer_position)
+        statusbar.addWidget(self.zoom_label)
+        statusbar.addWidget(self.layer_label)
+        statusbar.addWidget(self.frame_time)
+
+        # Add progress bar and cancel button for background file work
+        self.io_progress = QProgressBar(self)
+        self.io_progress.setFixedWidth(150)
+        self.io_progress.setRange(0, 100)
+        self.io_cancel = self.UI.PushButton('Cancel', lambda: self.io_worker and self.io_worker.cancel())
+        statusbar.addPermanentWidget(self.io_progress)
+        statusbar.addPermanentWidget(self.io_cancel)
+        self.io_progress.hide()
+        self.io_cancel.hide()
 
     def loadToolBar(self):
         """
@@ -400,16 +485,16 @@ class Core(QMainWindow):
         image_tag.setText('Image: ')
         toolbar.addWidget(image_tag)
         # Add rotate left tool
-        self.UI.ToolItem(toolbar, 'rotate left', icon='assets/rotate-left.png', tooltip="rotate 90° left",
+        self.UI.ToolItem(toolbar, 'rotate left', icon=self.assets.icon('rotate-left.png'), tooltip="rotate 90° left",
                          action=lambda: self.rotateImage(side='left'), short_key='CTRL+SHIFT+R')
         # Add rotate right tool
-        self.UI.ToolItem(toolbar, 'rotate right', icon='assets/rotate-right.png', tooltip="rotate 90° right",
+        self.UI.ToolItem(toolbar, 'rotate right', icon=self.assets.icon('rotate-right.png'), tooltip="rotate 90° right",
                          action=lambda: self.rotateImage(side='right'), short_key='CTRL+SHIFT+L')
         # Add flip vertical tool
-        self.UI.ToolItem(toolbar, 'flip vertical', icon='assets/flip_v.png', tooltip="flip vertical",
+        self.UI.ToolItem(toolbar, 'flip vertical', icon=self.assets.icon('flip_v.png'), tooltip="flip vertical",
                          action=lambda: self.flipImage('v'), short_key='CTRL+SHIFT+V')
         # Add flip horizontal tool
-        self.UI.ToolItem(toolbar, 'flip horizontal', icon='assets/flip_h.png', tooltip="flip horizontal",
+        self.UI.ToolItem(toolbar, 'flip horizontal', icon=self.assets.icon('flip_h.png'), tooltip="flip horizontal",
                          action=lambda: self.flipImage('h'), short_key='CTRL+SHIFT+H')
         toolbar.addSeparator()
 
@@ -417,9 +502,9 @@ class Core(QMainWindow):
         tools_tag = QLabel(self)
         tools_tag.setText('Tools: ')
         toolbar.addWidget(tools_tag)
-        tools = ['pointer', 'crop', 'draw', 'eraser', 'dropper', 'text']
+        tools = ['pointer', 'lasso', 'wand', 'crop', 'draw', 'eraser', 'dropper', 'fill', 'text']
         for tool in tools:
-            self.UI.ToolItem(toolbar, tool, icon=f'assets/{tool}.png', tooltip=tool, action=self.setActiveTool,
+            self.UI.ToolItem(toolbar, tool, icon=self.assets.icon(f'{tool}.png'), tooltip=tool, action=self.setActiveTool,
                              editable=True)
         toolbar.addSeparator()
 
@@ -427,9 +512,8 @@ class Core(QMainWindow):
         shapes_tag = QLabel(self)
         shapes_tag.setText('Shapes: ')
         toolbar.addWidget(shapes_tag)
-        shapes = ['line', 'circle', 'triangle', 'rectangle', 'pentagon', 'hexagon', 'diamond']
-        for shape in shapes:
-            self.UI.ToolItem(toolbar, shape, icon=f'assets/{shape}.png', tooltip=f'{shape}',
+        for shape in self.shapes:
+            self.UI.ToolItem(toolbar, shape, icon=self.assets.icon(f'{shape}.png'), tooltip=f'{shape}',
                              action=self.setActiveTool, editable=True)
         toolbar.addSeparator()
 
@@ -441,7 +525,7 @@ class Core(QMainWindow):
                  'hershey script complex', 'hershey script simplex', 'hershey triplex', 'italic']
         fonts_combo = self.UI.ComboItem(toolbar, icon_size=(100, 40), action=self.fontDialog, pass_index=True)
         for font in fonts:
-            fonts_combo.addItem(QIcon(f'assets/{font}.png'), '')
+            fonts_combo.addItem(self.assets.icon(f'{font}.png'), '')
 
         fonts_combo.setFixedHeight(30)
 
@@ -458,7 +542,7 @@ class Core(QMainWindow):
 
         thickness_combo = self.UI.ComboItem(toolbar, icon_size=(100, 40), action=self.thicknessDialog)
         for thickness in line_thickness:
-            thickness_combo.addItem(QIcon(f'assets/{thickness}.png'), thickness)
+            thickness_combo.addItem(self.assets.icon(f'{thickness}.png'), thickness)
 
         self.primary_color[0] = self.UI.ToolItem(toolbar, 'primary',
                                                  icon=self.CV.toIcon(
@@ -468,18 +552,30 @@ class Core(QMainWindow):
                                                    icon=self.CV.toIcon(
                                                        np.full((20, 20, 3), self.secondary_color[1], dtype=np.uint8)),
                                                    tooltip='secondary color', action=self.colorDialog, editable=True)
-        self.shape_state[0] = self.UI.ToolItem(toolbar, 'shape_state', icon='assets/outline.png',
+        self.shape_state[0] = self.UI.ToolItem(toolbar, 'shape_state', icon=self.assets.icon('outline.png'),
                                                tooltip='Outline shape', action=self.shape_stateDialog)
         toolbar.addSeparator()
 
+        # FILL
+        fill_tag = QLabel(self)
+        fill_tag.setText('Fill: ')
+        toolbar.addWidget(fill_tag)
+        fill_spin = self.UI.SpinItem(toolbar, action=self.fillToleranceDialog, num_range=(0, 255), step=8)
+        fill_spin.setValue(self.fill_tolerance)
+        fill_spin.setToolTip('Fill tolerance')
+        fill_spin.setFixedSize(50, 30)
+        self.fill_state[0] = self.UI.ToolItem(toolbar, 'fill_state', icon=self.assets.icon('contiguous.png'),
+                                              tooltip='Fill contiguous area', action=self.fill_stateDialog)
+        toolbar.addSeparator()
+
         # IMAGE EFFECT
         effects_tag = QLabel(self)
         effects_tag.setText('Effects: ')
         toolbar.addWidget(effects_tag)
         effects = ['None', 'grey', 'invert', 'cartoon', 'blur 1', 'blur 2', 'blur 3', 'blur 4', 'sketch']
-        effects_combo = self.UI.ComboItem(toolbar, icon_size=(100, 40), action=self.setImageEffect)
+        self.effects_combo = self.UI.ComboItem(toolbar, icon_size=(100, 40), action=self.setImageEffect)
         for effect in effects:
-            effects_combo.addItem(effect)
+            self.effects_combo.addItem(effect)
 
     def setNewCanvas(self, width, height, dialog=None, image=None):
         """
@@ -492,30 +588,361 @@ class Core(QMainWindow):
         if image is not None:
             self.image = image
         else:
-            self.image = np.full((height, width, 3), [255, 255, 255], dtype=np.uint8)
-        h, w, _ = self.image.shape
-        if w > self.width():
-            w = self.width()
-        if h > self.height():
-            h = self.height() - 75
-        self.image = self.CV.resizeImage(self.image, (w, h))
-        self.canvas = self.UI.createCanvas(self.CV.toQImage(self.image))
+            self.image = self.storage.full((height, width, 3), 255)
+        # The document keeps its resolution, large ones are zoomed out to fit instead
+        self.view.reset(self.image.shape, self.view_limit)
+        self.canvas = self.UI.createCanvas(*self.view.size())
+        self.canvas.view = self.view
+        self.zoom_label.setText(f'{self.view.zoom:.0%}')
         self.canvas.setMouseTracking(True)
         self.layout.addWidget(self.canvas)
+        self.resetOverlay()
+        self.layers.reset(self.image)
+        self.selectLayer(0)
+        self.history.clear()
+        self.autosave.reset()
+        self.touchImage()
         self.renderImage()
         if dialog:
             dialog.close()
 
-        if self.selection_state:
-            self.selection = None
-            self.selection_state = None
-            self.cropped_image = None
+        self.selection = None
 
     def renderImage(self):
         """
         Render the current image on the canvas.
         """
-        self.canvas.setPixmap(QPixmap(self.CV.toQImage(self.image, self.image_effect)))
+        self.refine_timer.stop()
+        self.proxy_rect = None
+        image = self.layers.composite()
+        self.view.update(image)
+        self.view.render(image, self.canvas.display, self.image_effect, self.image_version)
+        self.canvas.updateDisplay()
+
+    def renderView(self):
+        """
+        Render the canvas after the view moved, from the composite as it is.
+        """
+        self.refine_timer.stop()
+        self.proxy_rect = None
+        self.view.render(self.layers.flatten(), self.canvas.display, self.image_effect, self.image_version)
+        self.canvas.updateDisplay()
+
+    def renderRegion(self, rect):
+        """
+        Render only the given rect of the current image on the canvas.
+        """
+        if rect is not None:
+            # Neighbourhood effects spread a change over their halo
+            rect = self.CV.growRect(rect, self.CV.getBandHalo(self.image_effect)[0], self.image.shape)
+            scale = 1.0
+            if self.hold and self.CV.isExpensive(self.image_effect):
+                # Show a low resolution proxy while dragging and refine it once the interaction goes idle
+                scale = self.CV.proxy_scale
+                self.proxy_rect = self.CV.unionRect(self.proxy_rect, rect)
+                self.refine_timer.start(150)
+            # Only the rect of the composite is brought up to date, however many layers there are
+            image = self.layers.composite(rect)
+            self.view.update(image, rect)
+            self.view.render(image, self.canvas.display, self.image_effect, rect=rect, scale=scale)
+            self.canvas.updateDisplay(rect)
+
+    def refineRegion(self):
+        """
+        Replace the proxy preview rendered during a drag with the full resolution effect.
+        """
+        self.refine_timer.stop()
+        rect, self.proxy_rect = self.proxy_rect, None
+        if rect is not None:
+            self.view.render(self.layers.flatten(), self.canvas.display, self.image_effect, rect=rect)
+            self.canvas.updateDisplay(rect)
+
+    def resetOverlay(self):
+        """
+        Allocate an empty overlay matching the current image size.
+        """
+        self.overlay.resize(self.image.shape[1], self.image.shape[0])
+        self.canvas.setOverlay(self.overlay.buffer)
+
+    def refreshOverlay(self, cleared, rect):
+        """
+        Repaint the overlay after its previous preview was cleared and a new one drawn inside rect.
+        """
+        self.overlay.mark(rect)
+        self.canvas.updateOverlay(self.CV.unionRect(cleared, rect))
+
+    def previewText(self, color):
+        """
+        Show the text being typed on the overlay.
+        """
+        cleared = self.overlay.clear()
+        rect = self.CV.drawText(self.overlay.buffer, self.text_block.text(), self.start_pos, self.font_data[0],
+                                self.font_data[1], self.paintColor(self.overlay.buffer, color), self.thickness)
+        self.refreshOverlay(cleared, rect)
+
+    def previewSelection(self):
+        """
+        Show the selection on the overlay in place of the previous preview.
+        """
+        cleared = self.overlay.clear()
+        self.refreshOverlay(cleared, self.drawSelection())
+
+    def drawSelection(self):
+        """
+        Draw the dashed outline of the selection, over its pixels when lifted, and return the rect it covers.
+        """
+        if self.selection is None:
+            return None
+        x0, y0, x1, y1 = self.selection.floatRect()
+        rect = None
+        if self.selection.pixels is not None:
+            rect = self.overlay.paste(self.selection.patch, x0, y0, self.selection.mask)
+        self.selection.drawOutline(self.overlay.buffer, (0, 0, 0, 255))
+        return self.CV.unionRect(rect, self.CV.getRect([(x0, y0), (x1 - 1, y1 - 1)], 1, self.image.shape))
+
+    def selectionMode(self, modifiers):
+        """
+        Get how a new selection combines with the current one from the held keys:
+        Shift adds, Ctrl subtracts and both intersect.
+        """
+        shift, ctrl = bool(modifiers & Qt.ShiftModifier), bool(modifiers & Qt.ControlModifier)
+        if shift and ctrl:
+            return 'intersect'
+        elif shift:
+            return 'add'
+        elif ctrl:
+            return 'subtract'
+        return None
+
+    def setSelection(self, selection):
+        """
+        Replace the selection, or combine the new one with it by the selection mode, and outline the result.
+        """
+        if self.selection is not None:
+            self.dropSelection(deselect=False)
+            if self.selection is not None and self.selection_mode:
+                if selection is not None:
+                    selection = self.selection.combine(selection, self.selection_mode)
+                elif self.selection_mode != 'intersect':
+                    selection = self.selection
+        self.selection = selection
+        self.previewSelection()
+
+    def dropSelection(self, deselect=True):
+        """
+        Paste a lifted selection back into the image where it floats, and deselect it unless told otherwise.
+        """
+        if self.selection is None:
+            return
+        if self.selection.pixels is not None:
+            rect = self.selection.drop(self.image)
+            self.touchImage()
+            self.commitImage(rect, 'paste')
+            self.renderRegion(rect)
+            self.selection = self.selection.settle(self.image.shape)
+        if deselect:
+            self.canvas.updateOverlay(self.overlay.clear())
+            self.selection = None
+
+    def selectAll(self):
+        """
+        Select the whole image.
+        """
+        if self.canvas is None or self.hold:
+            return
+        self.selection_mode = None
+        self.setSelection(Selection.fromRect((0, 0), (self.image.shape[1], self.image.shape[0]), self.image.shape))
+
+    def cropSelection(self):
+        """
+        Crop every layer to the bounding rect of the selection, clearing what is not selected.
+        """
+        self.dropSelection(deselect=False)
+        if self.selection is None:
+            return
+        layers, active = self.layers.layers, self.layers.active
+        self.layers.layers = [layer.withImage(self.selection.crop(layer.image, layer.clearColor()))
+                              for layer in layers]
+        self.layers.invalidate()
+        self.history.push(LayersEdit('crop', self.layers, layers, active))
+        self.selection = None
+        self.selectLayer(active)
+        self.fitCanvas()
+        self.touchImage()
+        self.renderImage()
+
+    def selectLayer(self, index):
+        """
+        Make a layer active, so drawing, history and the tile store all work on its pixels.
+        """
+        self.layers.select(index)
+        layer = self.layers.activeLayer()
+        self.image = layer.image
+        self.tiles = layer.tiles
+        self.layer_label.setText(self.layers.describe())
+
+    def changeLayer(self, step):
+        """
+        Select the layer above or below the active one, dropping a lifted selection into the current one first.
+        """
+        if self.canvas is None or self.hold:
+            return
+        self.dropSelection(deselect=False)
+        self.selectLayer(self.layers.active + step)
+
+    def editLayers(self, action):
+        """
+        Add, remove, raise or lower a layer, recording the previous stack in the history.
+        """
+        if self.canvas is None or self.hold:
+            return
+        self.dropSelection()
+        layers, active = self.layers.layers, self.layers.active
+        if action == 'add':
+            self.layers.addLayer()
+            changed = True
+        elif action == 'remove':
+            changed = self.layers.removeLayer()
+        else:
+            changed = self.layers.moveLayer(1 if action == 'raise' else -1)
+        if changed:
+            self.history.push(LayersEdit(action, self.layers, layers, active))
+            self.selectLayer(self.layers.active)
+            self.touchImage()
+            self.renderImage()
+
+    def layerDialog(self, setting):
+        """
+        Toggle the visibility, ask for the opacity or set the blend mode of the active layer.
+        """
+        if self.canvas is None or self.hold:
+            return
+        layer = self.layers.activeLayer()
+        if setting == 'visible':
+            layer.visible = not layer.visible
+        elif setting == 'opacity':
+            value, ok = QInputDialog.getInt(self, 'Layer Opacity', 'Opacity (%):', round(layer.opacity * 100), 0, 100)
+            if not ok:
+                return
+            layer.opacity = value / 100
+        else:
+            layer.blend = setting
+        self.layers.invalidate()
+        self.selectLayer(self.layers.active)
+        self.touchImage()
+        self.renderImage()
+
+    def transformLayers(self, transform):
+        """
+        Apply a whole-image transform such as a rotate to every layer and return the active layer's new pixels.
+        """
+        for layer in self.layers.layers:
+            layer.load(self.storage.adopt(transform(layer.image)))
+        self.layers.invalidate()
+        self.selectLayer(self.layers.active)
+        return self.image
+
+    def paintColor(self, image, color):
+        """
+        Get a drawing color for an image, adding an opaque alpha channel for BGRA targets.
+        """
+        if image.shape[2] == 4:
+            return tuple(int(c) for c in color[:3]) + (255,)
+        return color
+
+    def drawShape(self, image, start_pos, current_pos):
+        """
+        Draw the active shape tool between two points and return the rect it covers.
+        """
+        color = self.paintColor(image, self.active_color)
+        fill_color = self.paintColor(image, self.secondary_color[1])
+        if self.active_tool[1] == 'line':
+            return self.CV.drawLine(image, start_pos, current_pos, color, self.thickness)
+        elif self.active_tool[1] == 'circle':
+            return self.CV.drawElipse(image, start_pos, current_pos, color, self.thickness,
+                                      fill_color, self.shape_state[1])
+        elif self.active_tool[1] == 'triangle':
+            return self.CV.drawTriangle(image, start_pos, current_pos, color, self.thickness,
+                                        fill_color, self.shape_state[1])
+        elif self.active_tool[1] == 'rectangle':
+            return self.CV.drawRectangle(image, start_pos, current_pos, color, self.thickness,
+                                         fill_color, self.shape_state[1])
+        elif self.active_tool[1] == 'pentagon':
+            return self.CV.drawPentagon(image, start_pos, current_pos, color, self.thickness,
+                                        fill_color, self.shape_state[1])
+        elif self.active_tool[1] == 'hexagon':
+            return self.CV.drawHexagon(image, start_pos, current_pos, color, self.thickness,
+                                       fill_color, self.shape_state[1])
+        elif self.active_tool[1] == 'diamond':
+            return self.CV.drawDiamond(image, start_pos, current_pos, color, self.thickness,
+                                       fill_color, self.shape_state[1])
+
+    def flushStroke(self, end=False):
+        """
+        Rasterize the queued stroke samples and render them, retrying later if they were coalesced.
+        """
+        rect = self.stroke.end(self.image) if end else self.stroke.flush(self.image)
+        if rect is not None:
+            self.stroke_rect = self.CV.unionRect(self.stroke_rect, rect)
+            self.touchImage()
+            self.renderRegion(rect)
+        elif self.stroke.pending and not self.stroke_timer.isActive():
+            self.stroke_timer.start(max(int(self.stroke.flush_interval * 1000), 1))
+
+    def commitImage(self, rect, name):
+        """
+        Record a finished edit of rect in the history and the tile store.
+        The tiles still hold the pixels from before the edit, so only the rect is copied into the history.
+        """
+        if rect is None:
+            return
+        self.history.push(RegionEdit(name, rect, self.tiles.region(rect), self.layers.activeLayer()))
+        self.tiles.commit(self.image, rect)
+        self.layers.activeLayer().mark(rect)
+
+    def undo(self):
+        """
+        Undo the latest edit.
+        """
+        self.stepHistory(redo=False)
+
+    def redo(self):
+        """
+        Redo the latest undone edit.
+        """
+        self.stepHistory(redo=True)
+
+    def stepHistory(self, redo):
+        """
+        Apply an undo or redo step and render what it changed.
+        """
+        if self.canvas is None or self.hold:
+            return
+        if self.selection is not None:
+            self.canvas.updateOverlay(self.overlay.clear())
+            self.selection = None
+        edit = self.history.peek(redo)
+        if edit is None:
+            return
+        if getattr(edit, 'layer', None) in self.layers.layers:
+            # Region edits are applied to the layer they were made on
+            self.selectLayer(self.layers.layers.index(edit.layer))
+        self.image, rect = (self.history.redo if redo else self.history.undo)(self.image)
+        self.touchImage()
+        if rect is None:
+            # Whole-image edits replace or transform the layers themselves, with their tiles
+            self.selectLayer(self.layers.active)
+            self.fitCanvas()
+            self.renderImage()
+        else:
+            self.tiles.commit(self.image, rect)
+            self.renderRegion(rect)
+
+    def touchImage(self):
+        """
+        Bump the document version after the image pixels changed.
+        """
+        self.image_version += 1
 
     def setActiveTool(self, tool, name):
         """
@@ -525,22 +952,13 @@ class Core(QMainWindow):
             self.active_tool[0].setStyleSheet('background-color:none;')
 
         if name == 'crop':
-            if self.selection_state:
-                self.setNewCanvas(self.canvas.width(), self.canvas.height(), image=self.cropped_image)
-                self.selection = None
-                self.selection_state = None
-                self.cropped_image = None
+            if self.selection is not None:
+                self.cropSelection()
             self.active_tool = None
             return
-        elif self.selection_state and self.cropped_image is not None:
-            self.image = self.CV.drawImage(self.image, self.selection[0], self.selection[1],
-                                           self.cropped_image,
-                                           (self.canvas.width(), self.canvas.height()))
-            self.renderImage()
-            self.selection = None
-            self.selection_state = None
-            self.cropped_image = None
-            self.renderImage()
+        elif self.selection is not None and name not in self.selectors:
+            # Selection tools keep the selection, so their selections can be combined
+            self.dropSelection()
 
         self.active_tool = (tool, name)
         tool.setStyleSheet('border:2px solid black;')
@@ -549,20 +967,196 @@ class Core(QMainWindow):
         """
         Open or save file dialog based on mode.
         """
-        image_filter = "Images (*.png *.jpg *.jpeg)"
+        image_filter = "Images (*.png *.jpg *.jpeg *.npy *.pyp)"
         if mode == 'open':
             file_path, _ = QFileDialog.getOpenFileName(self, caption="File Directory",filter=image_filter)
-            if file_path != '':
-                print(file_path)
-                self.image = self.CV.loadImage(file_path)
-                self.setNewCanvas(0, 0, image=self.image)
+            if file_path.lower().endswith('.pyp'):
+                self.startWorker(ProjectLoadWorker(file_path, self.project, self.storage), self.openProject)
+            elif file_path != '':
+                self.startWorker(LoadWorker(file_path, self.storage),
+                                 lambda image: self.setNewCanvas(0, 0, image=image))
         elif mode == 'save':
-            file_path, _ = QFileDialog.getSaveFileName(self, "Save File","PNG(*.png);;JPEG(*.jpg *.jpeg)")
-            if file_path != '' and self.image is not None:
-                self.image = self.CV.apply_filter(self.image, self.image_effect)
-                if self.image_effect is None:
-                    self.CV.saveImage(file_path, self.image,False)
-                self.CV.saveImage(file_path, self.image,True)
+            file_path, _ = QFileDialog.getSaveFileName(self, "Save File", "",
+                                                       "PNG(*.png);;JPEG(*.jpg *.jpeg);;NumPy(*.npy);;"
+                                                       "PyPaint Project(*.pyp)")
+            if file_path.lower().endswith('.pyp') and self.image is not None:
+                self.saveProject(file_path)
+            elif file_path != '' and self.image is not None:
+                # The snapshot shares the current tiles, so edits made while saving do not reach the file
+                flat = self.layers.flatten()
+                if flat is self.image:
+                    snapshot = self.tiles.snapshot()
+                elif self.storage.enabled:
+                    snapshot = TileManager()
+                    snapshot.loadShared(pristine(self.storage.store(flat)))
+                else:
+                    snapshot = TileManager()
+                    snapshot.load(flat)
+                # Disk backed canvases are written in row bands, never assembled in memory
+                self.startWorker(SaveWorker(file_path, snapshot, self.image_effect, self.CV,
+                                            stream=self.storage.enabled),
+                                 lambda path: self.statusBar().showMessage(f'Saved {path}', 3000))
+
+    def saveProject(self, file_path):
+        """
+        Save the layers, effects, view and selection as a project, from snapshots of the layer tiles.
+        """
+        # A lifted selection is pasted first, its pixels are not in the tiles until then
+        self.dropSelection(deselect=False)
+        layers = [({'name': layer.name, 'opacity': layer.opacity, 'visible': layer.visible, 'blend': layer.blend},
+                   layer.tiles.snapshot()) for layer in self.layers.layers]
+        meta = {'active': self.layers.active, 'effects': list(self.effects.stages),
+                'view': {'zoom': self.view.zoom, 'x': self.view.x, 'y': self.view.y}}
+        self.startWorker(ProjectSaveWorker(file_path, self.project, layers, meta, self.selection),
+                         lambda path: self.statusBar().showMessage(f'Saved {path}', 3000))
+
+    def openProject(self, project):
+        """
+        Show a project read by ProjectLoadWorker, with its layers, effects, view and selection.
+        """
+        self.restoreLayers(project['layers'], project['active'])
+        self.effects.stages = list(project['effects'])
+        self.image_effect = self.effects.text()
+        self.syncEffectsCombo()
+        if project['view'] is not None:
+            self.zoomView(project['view']['zoom'])
+            self.view.x, self.view.y = project['view']['x'], project['view']['y']
+            self.view.clampPan()
+        self.selection = project['selection']
+        self.renderImage()
+        if self.selection is not None:
+            self.previewSelection()
+
+    def restoreLayers(self, entries, active):
+        """
+        Start a new canvas from layers read back from a file, given bottom first as dicts of their settings and image.
+        """
+        self.setNewCanvas(0, 0, image=self.storage.adopt(entries[0]['image']))
+        layers = [self.layers.layers[0]] + [Layer(entry['name'], self.storage.adopt(entry['image']))
+                                            for entry in entries[1:]]
+        for layer, entry in zip(layers, entries):
+            layer.name, layer.opacity = entry['name'], entry['opacity']
+            layer.visible, layer.blend = entry['visible'], entry['blend']
+        self.layers.restore(layers, active)
+        self.selectLayer(self.layers.active)
+        self.touchImage()
+        self.renderImage()
+
+    def startWorker(self, worker, on_done):
+        """
+        Run a file worker in the background, showing its progress in the status bar.
+        """
+        if self.io_worker is not None:
+            self.statusBar().showMessage('Still busy with the previous file', 3000)
+            return
+        self.io_worker = worker
+        worker.progress.connect(self.io_progress.setValue)
+        worker.done.connect(on_done)
+        worker.failed.connect(lambda error: self.statusBar().showMessage(f'File operation {error}', 3000))
+        worker.finished.connect(self.finishWorker)
+        self.io_progress.setValue(0)
+        self.io_progress.show()
+        self.io_cancel.show()
+        worker.start()
+
+    def finishWorker(self):
+        """
+        Hide the progress bar once the file worker has stopped.
+        """
+        self.io_progress.hide()
+        self.io_cancel.hide()
+        self.io_worker.deleteLater()
+        self.io_worker = None
+
+    def toggleFastBlur(self):
+        """
+        Switch large blurs between exact and fast approximate computation.
+        """
+        self.CV.fast_blur = not self.CV.fast_blur
+        self.CV.effect_cache.clear()
+        self.statusBar().showMessage(f"Fast blur {'on' if self.CV.fast_blur else 'off'}", 3000)
+        if self.canvas:
+            self.renderImage()
+
+    def toggleStorage(self):
+        """
+        Switch between keeping canvases in memory and in memory-mapped files on disk, for canvases opened or created
+        from now on.
+        """
+        self.storage.enabled = not self.storage.enabled
+        self.statusBar().showMessage(f"Disk backing {'on' if self.storage.enabled else 'off'} "
+                                     f"for new canvases in {self.storage.directory}", 3000)
+
+    def startAutosave(self):
+        """
+        Start autosaving the canvas periodically. Only the interactive window does, so headless cores such as
+        replays and benchmarks leave no autosave behind.
+        """
+        self.autosave_timer.start(self.autosave.interval * 1000)
+
+    def autosaveCanvas(self):
+        """
+        Save the layers changed since the last autosave in the background. Skipped mid stroke, and while nothing
+        changed or the last save is still writing.
+        """
+        if self.canvas is None or self.hold:
+            return
+        self.autosave.save(self.layers, self.image_version)
+
+    def offerRecovery(self):
+        """
+        Offer to bring back the canvas of a session that ended without closing, from its autosave.
+        """
+        if not self.autosave.sessions():
+            return
+        answer = QMessageBox.question(self, 'Recover Canvas',
+                                      'PyPaint did not close properly last time. Recover the unsaved canvas?')
+        if answer == QMessageBox.Yes:
+            try:
+                recovered = self.autosave.recover(self.storage.allocate)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+                recovered = None
+                self.statusBar().showMessage(f'Could not recover the canvas: {error}', 3000)
+            if recovered is not None:
+                # The recovered pixels become the new document, so the autosave starts a fresh chain for them
+                self.restoreLayers(*recovered)
+        self.autosave.discard()
+
+    def toggleProfile(self):
+        """
+        Start or stop timing input events, showing the frame time readout in the status bar.
+        """
+        if self.profile.enabled:
+            self.profile.stop()
+            self.profile_timer.stop()
+            self.frame_time.hide()
+        else:
+            self.profile.start(self)
+            self.frame_time.setText(self.profile.summary())
+            self.frame_time.show()
+            # Refresh a few times a second rather than per event, so the readout does not add to what it measures
+            self.profile_timer.start(250)
+
+    def exportTrace(self):
+        """
+        Save the spans recorded while profiling as a Chrome trace file.
+        """
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "pypaint-trace.json", "Trace(*.json)")
+        if file_path != '':
+            count = self.profile.exportTrace(file_path)
+            self.statusBar().showMessage(f'Exported {count} spans to {file_path}', 3000)
+
+    def closeEvent(self, event):
+        """
+        Stop a running file worker and delete scratch files and the autosave before the window closes.
+        """
+        if self.io_worker is not None:
+            self.io_worker.cancel()
+            self.io_worker.wait()
+        self.autosave_timer.stop()
+        self.autosave.close()
+        self.storage.close()
+        super().closeEvent(event)
 
     def setCanvasDialog(self):
         """
@@ -666,22 +1260,41 @@ class Core(QMainWindow):
         Toggle between filled and outline shape state.
         """
         if not self.shape_state[1]:
-            self.shape_state[0].setIcon(QIcon('assets/filled.png'))
+            self.shape_state[0].setIcon(self.assets.icon('filled.png'))
             self.shape_state[0].setToolTip('Filled shape')
             self.shape_state[1] = True
         else:
-            self.shape_state[0].setIcon(QIcon('assets/outline.png'))
+            self.shape_state[0].setIcon(self.assets.icon('outline.png'))
             self.shape_state[0].setToolTip('Outline shape')
             self.shape_state[1] = False
 
+    def fillToleranceDialog(self, tolerance):
+        """
+        Set how far a color may be from the clicked one and still be filled.
+        """
+        self.fill_tolerance = tolerance
+
+    def fill_stateDialog(self):
+        """
+        Toggle between filling the contiguous area and every matching pixel.
+        """
+        if self.fill_state[1]:
+            self.fill_state[0].setIcon(self.assets.icon('global.png'))
+            self.fill_state[0].setToolTip('Fill all matching pixels')
+            self.fill_state[1] = False
+        else:
+            self.fill_state[0].setIcon(self.assets.icon('contiguous.png'))
+            self.fill_state[0].setToolTip('Fill contiguous area')
+            self.fill_state[1] = True
+
     def innerMousePos(self, event, rect_object):
         """
-        Get mouse position relative to a rectangle.
+        Get the document pixel under the mouse, from its position relative to the canvas rectangle.
         """
         x, y, width, height = rect_object.getRect()
         x = event.x() - x
         y = event.y() - y - 56
-        return x, y
+        return self.view.toDocument(x, y)
 
     def getMinMax(self, pt1, pt2):
         """
@@ -698,18 +1311,66 @@ class Core(QMainWindow):
         Rotate the image clockwise or counterclockwise.
         """
         if self.canvas:
-            self.image = self.CV.rotateImage(self.image, side)
-            self.canvas.setFixedSize(self.image.shape[1], self.image.shape[0])
-            self.setFixedSize(self.image.shape[1] + 200, self.image.shape[0] + 50)
-            self.setMaximumSize(self.local_width, self.local_height)
+            self.dropSelection()
+            self.transformLayers(lambda image: self.CV.rotateImage(image, side))
+            inverse = 'right' if side == 'left' else 'left'
+            self.history.push(TransformEdit(
+                'rotate', lambda _: self.transformLayers(lambda image: self.CV.rotateImage(image, inverse)),
+                lambda _: self.transformLayers(lambda image: self.CV.rotateImage(image, side))))
+            self.fitCanvas()
+            self.touchImage()
             self.renderImage()
 
+    def fitCanvas(self):
+        """
+        Resize the canvas and window to the current image size.
+        """
+        self.view.setShape(self.image.shape)
+        self.resizeCanvas()
+        self.resetOverlay()
+
+    def resizeCanvas(self):
+        """
+        Resize the canvas and window to the zoomed image, up to the largest canvas.
+        """
+        width, height = self.view.size()
+        self.canvas.resizeDisplay(width, height)
+        self.setFixedSize(width + 200, height + 50)
+        self.setMaximumSize(self.local_width, self.local_height)
+
+    def zoomView(self, zoom, anchor=None):
+        """
+        Zoom the view, keeping the document point under anchor, a canvas position, in place.
+        """
+        if self.canvas is None:
+            return
+        size = self.view.size()
+        self.view.setZoom(zoom, anchor)
+        if self.view.size() != size:
+            self.resizeCanvas()
+        self.zoom_label.setText(f'{self.view.zoom:.0%}')
+        self.renderView()
+
+    def panView(self, dx, dy):
+        """
+        Scroll the view by canvas pixels.
+        """
+        x, y = self.view.x, self.view.y
+        self.view.panBy(dx, dy)
+        if (self.view.x, self.view.y) != (x, y):
+            self.renderView()
+
     def flipImage(self, side=None):
         """
         Flip the image vertically or horizontally.
         """
         if self.canvas:
-            self.image = self.CV.flipImage(self.image, side)
+            self.dropSelection()
+            self.transformLayers(lambda image: self.CV.flipImage(image, side))
+            self.history.push(TransformEdit(
+                'flip', lambda _: self.transformLayers(lambda image: self.CV.flipImage(image, side)),
+                lambda _: self.transformLayers(lambda image: self.CV.flipImage(image, side))))
+            self.touchImage()
             self.renderImage()
 
     def setImageEffect(self, effect):
@@ -717,11 +1378,37 @@ class Core(QMainWindow):
         Set image effect based on user selection.
         """
         if self.canvas:
-            if effect == 'none':
-                effect = None
-            self.image_effect = effect
+            # The combo edits the last stage of the effect stack
+            self.effects.setStage(effect)
+            self.image_effect = self.effects.text()
             self.renderImage()
 
+    def syncEffectsCombo(self):
+        """
+        Show the effect of the last stage in the combo without feeding it back into the stack.
+        """
+        last = self.effects.stages[-1] if self.effects.stages else None
+        self.effects_combo.blockSignals(True)
+        self.effects_combo.setCurrentIndex(max(self.effects_combo.findText(last or 'None'), 0))
+        self.effects_combo.blockSignals(False)
+
+    def editEffects(self, action):
+        """
+        Add, remove or clear stages of the effect stack.
+        """
+        if action == 'add':
+            self.effects.addStage()
+        elif action == 'remove':
+            self.effects.removeStage()
+        elif action == 'clear':
+            self.effects.clear()
+        self.syncEffectsCombo()
+        self.statusBar().showMessage(f'Effects: {self.effects.describe()}', 3000)
+        if self.image_effect != self.effects.text():
+            self.image_effect = self.effects.text()
+            if self.canvas:
+                self.renderImage()
+
 if __name__ == '__main__':
     # Initialize the application
     pyPaint = QApplication([])
@@ -730,4 +1417,16 @@ if __name__ == '__main__':
     pyPaint.setWindowIcon(QIcon('assets/logo.png'))
     core = Core(app=pyPaint, width=1200, height=720, title='PyPaint')
     core.show()
+    core.offerRecovery()
+    core.startAutosave()
+
+    # Show frame times from the start when started with --profile
+    if '--profile' in sys.argv[1:]:
+        core.toggleProfile()
+
+    # Record the session for replay_manager when started with --record <file>
+    if '--record' in sys.argv[1:-1]:
+        from replay_manager import SessionRecorder
+        recorder = SessionRecorder(core, sys.argv[sys.argv.index('--record') + 1])
+        pyPaint.aboutToQuit.connect(recorder.close)
     pyPaint.exec_()
@@ -0,0 +1,59 @@
+import numpy as np
+import cv2
+
+
+class OverlayManager:
+    """
+    Transparent BGRA layer holding in-progress previews, composited on top of the canvas at display time.
+    """
+    def __init__(self):
+        self.buffer = None
+        self.rect = None
+
+    def resize(self, width, height):
+        """
+        Allocate an empty overlay matching the canvas size.
+        """
+        self.buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        self.rect = None
+
+    def clear(self):
+        """
+        Erase the current preview and return the rect it covered.
+        """
+        rect = self.rect
+        if rect is not None:
+            self.buffer[rect[1]:rect[3], rect[0]:rect[2]] = 0
+        self.rect = None
+        return rect
+
+    def mark(self, rect):
+        """
+        Record that a preview was drawn inside rect.
+        """
+        if rect is None:
+            return
+        if self.rect is None:
+            self.rect = rect
+        else:
+            self.rect = (min(self.rect[0], rect[0]), min(self.rect[1], rect[1]),
+                         max(self.rect[2], rect[2]), max(self.rect[3], rect[3]))
+
+    def paste(self, image, x, y, mask=None):
+        """
+        Copy a BGR or premultiplied BGRA image into the overlay, only where mask is set when one is given,
+        and return the rect it covers.
+        """
+        height, width = self.buffer.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + image.shape[1], width), min(y + image.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        if mask is not None:
+            source = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+            patch = image[source] if image.shape[2] == 4 else cv2.cvtColor(image[source], cv2.COLOR_BGR2BGRA)
+            cv2.copyTo(patch, mask[source], self.buffer[y0:y1, x0:x1])
+            return x0, y0, x1, y1
+        self.buffer[y0:y1, x0:x1, :3] = image[y0 - y:y1 - y, x0 - x:x1 - x]
+        self.buffer[y0:y1, x0:x1, 3] = 255
+        return x0, y0, x1, y1
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+import numpy as np
+
+from ui_manager import Canvas
+
+# Methods timed while profiling, by the phase they are counted under
+CORE_EVENTS = ['mousePressEvent', 'mouseMoveEvent', 'mouseReleaseEvent', 'keyPressEvent']
+CV_PHASES = {'draw': ['drawLine', 'drawPolyline', 'drawText', 'drawDashRect', 'drawElipse', 'drawTriangle',
+                      'drawRectangle', 'drawPentagon', 'drawHexagon', 'drawDiamond', 'drawImage', 'moveRect',
+                      'cropImage'],
+             'filter': ['apply_filter', 'filterRegion', 'filterStages'],
+             'display': ['toDisplay']}
+
+
+class ProfileManager:
+    """
+    Optional instrumentation timing the phases of every input event, from the handler through drawing, filtering,
+    display conversion and paint. Methods are wrapped only while profiling, so it costs nothing when off.
+    """
+    def __init__(self, max_frames=120, max_events=200000):
+        self.enabled = False
+        self.frames = deque(maxlen=max_frames)
+        self.events = deque(maxlen=max_events)
+        self.wrapped = []
+        self.local = threading.local()
+        self.main_thread = threading.get_ident()
+        self.origin = time.perf_counter()
+
+    def start(self, core):
+        """
+        Wrap the input handlers of Core and the methods they spend their time in.
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        self.frames.clear()
+        self.events.clear()
+        for name in CORE_EVENTS:
+            self.wrap(core, name, 'handler', frame=name[:-5])
+        for phase, names in CV_PHASES.items():
+            for name in names:
+                self.wrap(core.CV, name, phase)
+        for name in ('clear', 'paste'):
+            self.wrap(core.overlay, name, 'overlay')
+        self.wrap(core.layers, 'composite', 'composite')
+        self.wrap(core.view, 'render', 'display')
+        for name in ('region', 'commit'):
+            self.wrap(core.tiles, name, 'history')
+        self.wrap(core.history, 'push', 'history')
+        # The canvas is replaced with every new image, so its paint is wrapped on the class
+        self.wrap(Canvas, 'paintEvent', 'paint')
+
+    def stop(self):
+        """
+        Remove every wrapper, restoring the original methods.
+        """
+        for owner, name, original in reversed(self.wrapped):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self.wrapped = []
+        self.enabled = False
+
+    def wrap(self, owner, name, phase, frame=None):
+        """
+        Replace a method with one timing it under a phase. A frame name starts a new frame per call.
+        """
+        original = getattr(owner, name)
+        profiler = self
+
+        @wraps(original)
+        def timed(*args, **kwargs):
+            with profiler.span(phase, name, frame):
+                result = original(*args, **kwargs)
+                profiler.countArray(result)
+            return result
+
+        # Remember whether the method lived on the owner itself, or came from its class and only needs deleting
+        self.wrapped.append((owner, name, vars(owner).get(name) if isinstance(owner, type) else None))
+        setattr(owner, name, timed)
+
+    def span(self, phase, name, frame=None):
+        """
+        Context timing one call. Time spent in nested spans is counted under their own phases.
+        """
+        return Span(self, phase, name, frame)
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def countArray(self, result):
+        """
+        Count a freshly allocated array returned by a timed call against the current frame.
+        """
+        if isinstance(result, np.ndarray) and result.base is None and self.frames:
+            if threading.get_ident() == self.main_thread:
+                self.frames[-1]['arrays'] += 1
+                self.frames[-1]['bytes'] += result.nbytes
+
+    def record(self, phase, name, frame, start, duration, own):
+        """
+        Store a finished span in the trace and add its own time to the current frame.
+        """
+        thread = threading.get_ident()
+        self.events.append((name, phase, start, duration, thread))
+        if thread != self.main_thread:
+            return
+        if frame is not None:
+            self.frames[-1]['total'] = duration
+        if self.frames:
+            phases = self.frames[-1]['phases']
+            phases[phase] = phases.get(phase, 0.0) + own
+            if phase == 'paint':
+                # Paint runs after the handler returned, but belongs to the frame it shows
+                self.frames[-1]['total'] += duration
+
+    def summary(self):
+        """
+        Get a one line readout of the last frame and the p95 frame time.
+        """
+        if not self.frames:
+            return 'no frames yet'
+        frame = self.frames[-1]
+        totals = [entry['total'] for entry in self.frames]
+        phases = sorted(frame['phases'].items(), key=lambda item: -item[1])[:4]
+        text = f"{frame['kind']} {frame['total'] * 1e3:.1f} ms (p95 {np.percentile(totals, 95) * 1e3:.1f})"
+        text += ''.join(f' · {phase} {seconds * 1e3:.1f}' for phase, seconds in phases)
+        return text + f" · {frame['arrays']} arrays {frame['bytes'] / 1e6:.1f} MB"
+
+    def exportTrace(self, path):
+        """
+        Write the recorded spans as a Chrome trace, viewable in chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        events = [{'name': name, 'cat': phase, 'ph': 'X', 'pid': pid, 'tid': thread,
+                   'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+                  for name, phase, start, duration, thread in list(self.events)]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        return len(events)
+
+
+class Span:
+    """
+    One timed call, tracking the time of the spans nested in it.
+    """
+    def __init__(self, profiler, phase, name, frame):
+        self.profiler = profiler
+        self.phase = phase
+        self.name = name
+        self.frame = frame
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        if self.frame is not None and not stack and threading.get_ident() == self.profiler.main_thread:
+            self.profiler.frames.append({'kind': self.frame, 'total': 0.0, 'phases': {}, 'arrays': 0, 'bytes': 0})
+        stack.append(0.0)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        stack = self.profiler.stack()
+        children = stack.pop()
+        if stack:
+            stack[-1] += duration
+        frame = self.frame if not stack else None
+        self.profiler.record(self.phase, self.name, frame, self.start, duration, duration - children)
+        return False
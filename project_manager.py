@@ -0,0 +1,421 @@
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+from io_manager import IOWorker
+from layer_manager import Layer, LayerManager
+from selection_manager import Selection
+
+PROJECT_MAGIC = b'PYPAINT\x00'
+PROJECT_VERSION = 1
+# The file ends with the offset and length of the index, then this marker
+FOOTER = struct.Struct('<QQ8s')
+FOOTER_MAGIC = b'PYPINDEX'
+THUMBNAIL_SIZE = 256
+# Tiles are compressed and decompressed this many bytes at a time, bounding the memory held by a batch
+BATCH_BYTES = 64 * 1024 * 1024
+
+
+class ProjectManager:
+    """
+    PyPaint project files (.pyp): every layer stored as independently compressed tiles, followed by a thumbnail,
+    the selection mask and a JSON index of where each tile lives, along with layer settings, effects and view.
+    The index sits at the end, so the tiles can be written as they are compressed, and reading a thumbnail or a
+    region only touches the bytes it needs. Tiles are compressed and decompressed on a thread pool.
+    """
+    def __init__(self, workers=None, level=1, batch_bytes=BATCH_BYTES):
+        self.workers = workers or os.cpu_count() or 1
+        self.level = level
+        self.batch_bytes = batch_bytes
+
+    def write(self, file, layers, meta, selection=None, progress=None, cancelled=None):
+        """
+        Write a project to an open binary file. layers are (settings, tiles) pairs, bottom first, where settings
+        holds the name, opacity, visible and blend of the layer and tiles is a snapshot of its tile store.
+        meta is stored in the index as it is.
+        """
+        file.write(PROJECT_MAGIC + struct.pack('<I', PROJECT_VERSION))
+        offset = len(PROJECT_MAGIC) + 4
+        index = dict(meta, version=PROJECT_VERSION, layers=[])
+        # Tiles shared between layers or keys, such as blank ones, are written once
+        unique = {}
+        for settings, tiles in layers:
+            index['layers'].append(dict(settings, shape=list(tiles.shape), tile_size=tiles.tile_size))
+            for tile in tiles.tiles.values():
+                unique.setdefault(id(tile), tile)
+        written = {}
+        total = max(sum(tile.nbytes for tile in unique.values()), 1)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch in self.batches(list(unique.values())):
+                if cancelled is not None and cancelled():
+                    return
+                for tile, blob in zip(batch, pool.map(self.compressTile, batch)):
+                    done += tile.nbytes
+                    if isinstance(blob, list):
+                        written[id(tile)] = [blob]
+                        continue
+                    written[id(tile)] = [offset, len(blob)]
+                    file.write(blob)
+                    offset += len(blob)
+                if progress is not None:
+                    progress(done / total)
+        # Each tile is [row, column, offset, length], or [row, column, color] when it holds a single color
+        for entry, (_, tiles) in zip(index['layers'], layers):
+            entry['tiles'] = [[key[0], key[1]] + written[id(tile)] for key, tile in tiles.tiles.items()]
+        thumbnail = self.makeThumbnail(layers)
+        ok, encoded = cv2.imencode('.png', thumbnail)
+        if ok:
+            file.write(encoded.data)
+            index['thumbnail'] = [offset, len(encoded), thumbnail.shape[1], thumbnail.shape[0]]
+            offset += len(encoded)
+        if selection is not None:
+            blob = zlib.compress(np.ascontiguousarray(selection.mask).data, self.level)
+            file.write(blob)
+            index['selection'] = {'rect': list(selection.rect), 'offset': offset, 'length': len(blob)}
+            offset += len(blob)
+        data = zlib.compress(json.dumps(index).encode('utf-8'))
+        file.write(data)
+        file.write(FOOTER.pack(offset, len(data), FOOTER_MAGIC))
+
+    def compressTile(self, tile):
+        """
+        Compress the pixels of one tile, or get its color when it holds only one, such as blank paper, which is
+        stored without pixels. Runs on the thread pool, which zlib does not hold the GIL for.
+        """
+        first = tile[0, 0]
+        if (tile == first).all():
+            return [int(value) for value in np.atleast_1d(first)]
+        return zlib.compress(np.ascontiguousarray(tile).data, self.level)
+
+    def batches(self, items, size=lambda item: item.nbytes):
+        """
+        Split items into runs of about batch_bytes each.
+        """
+        batch, batch_size = [], 0
+        for item in items:
+            batch.append(item)
+            batch_size += size(item)
+            if batch_size >= self.batch_bytes:
+                yield batch
+                batch, batch_size = [], 0
+        if batch:
+            yield batch
+
+    def makeThumbnail(self, layers):
+        """
+        Composite a thumbnail of the layers from every few pixels of their tiles, never assembling them whole.
+        """
+        height, width = layers[0][1].shape[:2]
+        scale = min(THUMBNAIL_SIZE / max(height, width), 1)
+        # Sampled at four times the thumbnail size, then averaged down, to keep thin strokes visible
+        step = max(int(1 / (scale * 4)), 1)
+        images = [sampleTiles(tiles, step) for _, tiles in layers]
+        flat = flattenLayers(images, [settings for settings, _ in layers])
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        return cv2.resize(flat, size, interpolation=cv2.INTER_AREA)
+
+    def readIndex(self, file):
+        """
+        Read the index of a project from an open binary file.
+        """
+        file.seek(0)
+        if file.read(len(PROJECT_MAGIC)) != PROJECT_MAGIC:
+            raise ValueError('not a PyPaint project')
+        version, = struct.unpack('<I', file.read(4))
+        if version > PROJECT_VERSION:
+            raise ValueError(f'project version {version} is newer than this PyPaint')
+        file.seek(-FOOTER.size, os.SEEK_END)
+        offset, length, marker = FOOTER.unpack(file.read(FOOTER.size))
+        if marker != FOOTER_MAGIC:
+            raise ValueError('project file is incomplete')
+        file.seek(offset)
+        return json.loads(zlib.decompress(file.read(length)))
+
+    def readThumbnail(self, path):
+        """
+        Read the thumbnail of a project as a BGR image, without touching its tiles.
+        """
+        with open(path, 'rb') as file:
+            index = self.readIndex(file)
+            if 'thumbnail' not in index:
+                return None
+            offset, length, _, _ = index['thumbnail']
+            file.seek(offset)
+            return cv2.imdecode(np.frombuffer(file.read(length), np.uint8), cv2.IMREAD_COLOR)
+
+    def readRegion(self, path, rect):
+        """
+        Read the composite of a rect (x0, y0, x1, y1) of a project, decompressing only the tiles it touches.
+        """
+        with open(path, 'rb') as file:
+            index = self.readIndex(file)
+            height, width = index['layers'][0]['shape'][:2]
+            x0, y0 = max(rect[0], 0), max(rect[1], 0)
+            x1, y1 = min(rect[2], width), min(rect[3], height)
+            if x0 >= x1 or y0 >= y1:
+                return None
+            jobs = {}
+            images = []
+            for layer in index['layers']:
+                shape = tuple(layer['shape'])
+                image = np.zeros((y1 - y0, x1 - x0) + shape[2:], dtype=np.uint8)
+                size = layer['tile_size']
+                for row, column, *stored in layer['tiles']:
+                    tx0, ty0 = column * size, row * size
+                    tx1, ty1 = min(tx0 + size, shape[1]), min(ty0 + size, shape[0])
+                    ix0, iy0, ix1, iy1 = max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1)
+                    if ix0 >= ix1 or iy0 >= iy1:
+                        continue
+                    if len(stored) == 1:
+                        fillTile(image, (ix0 - x0, iy0 - y0, ix1 - x0, iy1 - y0), stored[0])
+                    else:
+                        jobs.setdefault((stored[0], stored[1], (ty1 - ty0, tx1 - tx0) + shape[2:]), []).append(
+                            (image, (ix0 - x0, iy0 - y0), (ix0 - tx0, iy0 - ty0, ix1 - tx0, iy1 - ty0)))
+                images.append(image)
+            self.readTiles(file, jobs)
+        return flattenLayers(images, index['layers'])
+
+    def read(self, path, allocate=None, progress=None, cancelled=None):
+        """
+        Read a whole project. allocate gets a zero filled image for a shape.
+        Returns a dict of the layers, bottom first, as dicts of their settings and image, the active index,
+        the effect stages, the view and the selection, or None when cancelled.
+        """
+        allocate = allocate or (lambda shape: np.zeros(shape, dtype=np.uint8))
+        with open(path, 'rb') as file:
+            index = self.readIndex(file)
+            jobs = {}
+            layers = []
+            for layer in index['layers']:
+                shape = tuple(layer['shape'])
+                image = allocate(shape)
+                size = layer['tile_size']
+                for row, column, *stored in layer['tiles']:
+                    x0, y0 = column * size, row * size
+                    x1, y1 = min(x0 + size, shape[1]), min(y0 + size, shape[0])
+                    if len(stored) == 1:
+                        fillTile(image, (x0, y0, x1, y1), stored[0])
+                    else:
+                        jobs.setdefault((stored[0], stored[1], (y1 - y0, x1 - x0) + shape[2:]), []).append(
+                            (image, (x0, y0), (0, 0, x1 - x0, y1 - y0)))
+                layers.append({'name': layer['name'], 'opacity': layer['opacity'], 'visible': layer['visible'],
+                               'blend': layer['blend'], 'image': image})
+            if not self.readTiles(file, jobs, progress, cancelled):
+                return None
+            selection = None
+            if 'selection' in index:
+                x0, y0, x1, y1 = index['selection']['rect']
+                file.seek(index['selection']['offset'])
+                mask = np.frombuffer(zlib.decompress(file.read(index['selection']['length'])), dtype=np.uint8)
+                selection = Selection(mask.reshape(y1 - y0, x1 - x0).copy(), (x0, y0, x1, y1))
+        return {'layers': layers, 'active': index.get('active', 0), 'effects': index.get('effects', []),
+                'view': index.get('view'), 'selection': selection}
+
+    def readTiles(self, file, jobs, progress=None, cancelled=None):
+        """
+        Decompress tiles on the thread pool, reading the file in batches in the order the tiles were written.
+        jobs maps (offset, length, tile shape) to the places the tile goes, each (image, (x, y), tile rect).
+        Returns False when cancelled.
+        """
+        spans = sorted(jobs)
+        if not spans:
+            return True
+        total = max(sum(span[1] for span in spans), 1)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch in self.batches(spans, lambda span: span[1]):
+                if cancelled is not None and cancelled():
+                    return False
+                blobs = {}
+                for run in self.runs(batch):
+                    start = run[0][0]
+                    file.seek(start)
+                    data = memoryview(file.read(run[-1][0] + run[-1][1] - start))
+                    for span in run:
+                        blobs[span] = data[span[0] - start:span[0] - start + span[1]]
+                list(pool.map(lambda span: self.placeTile(blobs[span], span[2], jobs[span]), batch))
+                done += sum(span[1] for span in batch)
+                if progress is not None:
+                    progress(done / total)
+        return True
+
+    def runs(self, spans, gap=64 * 1024):
+        """
+        Split sorted (offset, length, ...) spans where more than gap bytes lie between them, so each run is one read
+        and the tiles a region skips are not read.
+        """
+        run = [spans[0]]
+        for span in spans[1:]:
+            if span[0] - (run[-1][0] + run[-1][1]) > gap:
+                yield run
+                run = []
+            run.append(span)
+        yield run
+
+    def placeTile(self, blob, shape, places):
+        """
+        Decompress one tile and copy it everywhere it goes. Runs on the thread pool.
+        """
+        tile = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(shape)
+        for image, (x, y), (sx0, sy0, sx1, sy1) in places:
+            image[y:y + sy1 - sy0, x:x + sx1 - sx0] = tile[sy0:sy1, sx0:sx1]
+
+
+def fillTile(image, rect, color):
+    """
+    Fill a rect of a zero filled image with a single color tile, leaving it alone when the color is zero, so pages of
+    transparent layers are never touched.
+    """
+    if any(color):
+        # Filled by OpenCV, many times faster than numpy broadcasting a color over the pixels
+        cv2.rectangle(image, rect[:2], (rect[2] - 1, rect[3] - 1), tuple(color), -1)
+
+
+def sampleTiles(tiles, step):
+    """
+    Get every step-th pixel of a tile store along each axis, reading only the pixels kept.
+    """
+    height, width = tiles.shape[:2]
+    out = np.empty((-(-height // step), -(-width // step)) + tuple(tiles.shape[2:]), dtype=np.uint8)
+    for key, tile in tiles.tiles.items():
+        x0, y0, _, _ = tiles.tileRect(key)
+        # First kept row and column inside the tile
+        fy, fx = -y0 % step, -x0 % step
+        part = tile[fy::step, fx::step]
+        if part.size:
+            oy, ox = (y0 + fy) // step, (x0 + fx) // step
+            out[oy:oy + part.shape[0], ox:ox + part.shape[1]] = part
+    return out
+
+
+def flattenLayers(images, settings):
+    """
+    Composite layer images with their settings, bottom first, into a BGR image.
+    """
+    layers = []
+    for image, setting in zip(images, settings):
+        layer = Layer(setting['name'], image)
+        layer.opacity, layer.visible, layer.blend = setting['opacity'], setting['visible'], setting['blend']
+        layers.append(layer)
+    stack = LayerManager()
+    stack.restore(layers, 0)
+    return stack.composite()
+
+
+class ProjectSaveWorker(IOWorker):
+    """
+    Write a project off the UI thread, beside its target until complete like SaveWorker.
+    """
+    def __init__(self, path, project, layers, meta, selection=None):
+        super().__init__(path)
+        self.project = project
+        self.layers = layers
+        self.meta = meta
+        self.selection = selection
+
+    def work(self):
+        temp_path = self.path + '.part'
+        try:
+            with open(temp_path, 'wb') as file:
+                self.project.write(file, self.layers, self.meta, self.selection,
+                                   lambda done: self.progress.emit(int(done * 100)), lambda: self.cancelled)
+            if self.cancelled:
+                os.remove(temp_path)
+                return None
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.path
+
+
+class ProjectLoadWorker(IOWorker):
+    """
+    Read a project off the UI thread, onto disk when a storage manager has disk backing enabled.
+    """
+    def __init__(self, path, project, storage=None):
+        super().__init__(path)
+        self.project = project
+        self.storage = storage
+
+    def work(self):
+        # Scratch files start out zero filled like np.zeros, with no pages written
+        disk = self.storage is not None and self.storage.enabled
+        result = self.project.read(self.path, self.storage.create if disk else None,
+                                   lambda done: self.progress.emit(int(done * 100)), lambda: self.cancelled)
+        if result is not None and disk:
+            # Tiles were decompressed straight into scratch files, which are reopened copy-on-write as opened ones are
+            for layer in result['layers']:
+                layer['image'] = self.storage.open(layer['image'])
+        return result
+
+
+def benchmark(size=8000):
+    """
+    Save and reopen a size x size work in progress, a two layer painting with a noisy photo-like patch,
+    as a project and as a flattened PNG. Returns seconds and MB for each, and milliseconds to read the thumbnail
+    and a 1200x645 region of the project, which should not grow with the canvas.
+    """
+    import tempfile
+    from tile_manager import TileManager
+    rng = np.random.default_rng(0)
+    background = np.full((size, size, 3), 255, dtype=np.uint8)
+    patch = size // 4
+    background[:patch, :patch] = cv2.GaussianBlur(rng.integers(0, 256, (patch, patch, 3), dtype=np.uint8), (5, 5), 0)
+    top = np.zeros((size, size, 4), dtype=np.uint8)
+    for _ in range(400):
+        x, y = (int(v) for v in rng.integers(0, size, 2))
+        cv2.line(top, (x, y), (x + size // 20, y + size // 40), (0, 0, 200, 255), 12)
+    stack = []
+    for name, image in (('Background', background), ('Layer 1', top)):
+        tiles = TileManager()
+        tiles.load(image)
+        stack.append(({'name': name, 'opacity': 1.0, 'visible': True, 'blend': 'normal'}, tiles))
+    directory = tempfile.mkdtemp(prefix='pypaint-project-')
+    path = os.path.join(directory, 'benchmark.pyp')
+    png_path = os.path.join(directory, 'benchmark.png')
+    project = ProjectManager()
+    results = {}
+    start = time.perf_counter()
+    with open(path, 'wb') as file:
+        project.write(file, stack, {'active': 1, 'effects': []})
+    results['project_save_s'] = time.perf_counter() - start
+    results['project_mb'] = os.path.getsize(path) / 1e6
+    start = time.perf_counter()
+    project.read(path)
+    results['project_open_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    project.readThumbnail(path)
+    results['thumbnail_ms'] = (time.perf_counter() - start) * 1e3
+    start = time.perf_counter()
+    project.readRegion(path, (size // 2, size // 2, size // 2 + 1200, size // 2 + 645))
+    results['region_ms'] = (time.perf_counter() - start) * 1e3
+    flat = flattenLayers([background, top], [settings for settings, _ in stack])
+    start = time.perf_counter()
+    cv2.imwrite(png_path, flat)
+    results['png_save_s'] = time.perf_counter() - start
+    results['png_mb'] = os.path.getsize(png_path) / 1e6
+    start = time.perf_counter()
+    cv2.imread(png_path)
+    results['png_open_s'] = time.perf_counter() - start
+    os.remove(path)
+    os.remove(png_path)
+    os.rmdir(directory)
+    return results
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    result = benchmark(size)
+    print(f"{size}x{size}, 2 layers, {os.cpu_count()} threads: project save {result['project_save_s']:.2f} s "
+          f"{result['project_mb']:.1f} MB, open {result['project_open_s']:.2f} s, "
+          f"thumbnail {result['thumbnail_ms']:.1f} ms, region {result['region_ms']:.1f} ms")
+    print(f"flattened PNG: save {result['png_save_s']:.2f} s {result['png_mb']:.1f} MB, open {result['png_open_s']:.2f} s")
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from PyQt5.QtCore import Qt, QObject, QEvent, QPointF
+from PyQt5.QtGui import QMouseEvent, QKeyEvent
+from PyQt5.QtWidgets import QApplication, QToolButton
+
+from stroke_manager import syntheticPath
+
+# Height of the menu bar and toolbar that Core.innerMousePos subtracts from window coordinates
+TOOLBAR_OFFSET = 56
+MOUSE_EVENTS = {QEvent.MouseButtonPress: 'press', QEvent.MouseMove: 'move', QEvent.MouseButtonRelease: 'release'}
+
+
+def coreState(core):
+    """
+    Capture the tool settings a recorded press depends on.
+    """
+    return {'tool': core.active_tool[1] if core.active_tool else None, 'thickness': core.thickness,
+            'primary': [int(c) for c in core.primary_color[1]], 'secondary': [int(c) for c in core.secondary_color[1]],
+            'filled': bool(core.shape_state[1]), 'font': list(core.font_data), 'effect': core.image_effect}
+
+
+class SessionRecorder(QObject):
+    """
+    Event filter writing the mouse and key events Core receives to a JSON lines session file.
+    Positions are stored in image coordinates, so a session replays on any window layout.
+    """
+    def __init__(self, core, path):
+        super().__init__()
+        self.core = core
+        self.file = open(path, 'w')
+        self.start = None
+        core.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        core = self.core
+        if core.canvas is None or (event.type() not in MOUSE_EVENTS and event.type() != QEvent.KeyPress):
+            return False
+        if self.start is None:
+            self.start = time.perf_counter()
+            self.write({'canvas': [core.image.shape[1], core.image.shape[0]]})
+        entry = {'t': round(time.perf_counter() - self.start, 4)}
+        if event.type() == QEvent.KeyPress:
+            entry.update(type='key', key=int(event.key()), text=event.text(), modifiers=int(event.modifiers()))
+        else:
+            x, y = core.innerMousePos(event, core.canvas.geometry())
+            entry.update(type=MOUSE_EVENTS[event.type()], x=x, y=y, button=int(event.button()),
+                         buttons=int(event.buttons()), modifiers=int(event.modifiers()),
+                         inside=core.canvas.underMouse())
+            if event.type() == QEvent.MouseButtonPress:
+                entry['state'] = coreState(core)
+        self.write(entry)
+        return False
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.core.removeEventFilter(self)
+        self.file.close()
+
+
+class ReplayManager:
+    """
+    Feed a recorded session to Core event by event and time how long each one takes, paint included.
+    """
+    def __init__(self, core, app):
+        self.core = core
+        self.app = app
+
+    @staticmethod
+    def load(path):
+        """
+        Read a session file into its canvas size and event list.
+        """
+        with open(path) as file:
+            lines = [json.loads(line) for line in file if line.strip()]
+        return tuple(lines[0]['canvas']), lines[1:]
+
+    @staticmethod
+    def save(path, canvas, events):
+        """
+        Write a session file.
+        """
+        with open(path, 'w') as file:
+            file.write(json.dumps({'canvas': list(canvas)}) + '\n')
+            for entry in events:
+                file.write(json.dumps(entry) + '\n')
+
+    def applyState(self, state):
+        """
+        Restore the tool settings recorded with a press, clicking the toolbar button when the tool changed.
+        """
+        core = self.core
+        if state['tool'] != (core.active_tool[1] if core.active_tool else None) and state['tool']:
+            for button in core.findChildren(QToolButton):
+                if button.toolTip() == state['tool'].title():
+                    button.click()
+                    break
+        core.thickness = state['thickness']
+        core.primary_color[1] = list(state['primary'])
+        core.secondary_color[1] = list(state['secondary'])
+        core.shape_state[1] = state['filled']
+        core.font_data = list(state['font'])
+        if state['effect'] != core.image_effect:
+            core.effects.stages = core.CV.splitEffect(state['effect'])
+            core.image_effect = core.effects.text()
+            core.renderImage()
+
+    def dispatch(self, entry):
+        """
+        Deliver one recorded event to Core and process the paints it caused.
+        """
+        core = self.core
+        if entry['type'] == 'key':
+            event = QKeyEvent(QEvent.KeyPress, entry['key'], Qt.KeyboardModifiers(entry['modifiers']), entry['text'])
+        else:
+            if 'state' in entry:
+                self.applyState(entry['state'])
+            # Offscreen windows have no real pointer, so mark the canvas as hovered the way it was when recorded
+            core.canvas.setAttribute(Qt.WA_UnderMouse, entry['inside'])
+            geometry = core.canvas.geometry()
+            x, y = core.view.toCanvas(entry['x'], entry['y'])
+            position = QPointF(x + geometry.x(), y + geometry.y() + TOOLBAR_OFFSET)
+            kind = {'press': QEvent.MouseButtonPress, 'move': QEvent.MouseMove,
+                    'release': QEvent.MouseButtonRelease}[entry['type']]
+            event = QMouseEvent(kind, position, Qt.MouseButton(entry['button']), Qt.MouseButtons(entry['buttons']),
+                                Qt.KeyboardModifiers(entry.get('modifiers', 0)))
+        QApplication.sendEvent(core, event)
+        self.app.processEvents()
+
+    def replay(self, canvas, events, speed=1.0):
+        """
+        Replay events on a fresh white canvas, keeping their recorded pacing scaled by speed (0 means no waiting).
+        Returns (label, seconds) per event, labelled by tool and event type, and the total wall time.
+        """
+        self.core.setNewCanvas(*canvas)
+        self.app.processEvents()
+        timings = []
+        began = time.perf_counter()
+        for entry in events:
+            if speed > 0:
+                # Let timers such as the stroke flush run while waiting for the next event
+                while time.perf_counter() - began < entry['t'] / speed:
+                    self.app.processEvents()
+            start = time.perf_counter()
+            self.dispatch(entry)
+            tool = self.core.active_tool[1] if self.core.active_tool else 'none'
+            timings.append((f"{tool} {entry['type']}", time.perf_counter() - start))
+        self.app.processEvents()
+        return timings, time.perf_counter() - began
+
+    @staticmethod
+    def summary(timings, wall):
+        """
+        Get p50, p95 and p99 milliseconds per event label and over all events.
+        """
+        groups = {'all': [seconds for _, seconds in timings]}
+        for label, seconds in timings:
+            groups.setdefault(label, []).append(seconds)
+        report = {'wall_s': wall, 'events': len(timings), 'labels': {}}
+        for label, samples in groups.items():
+            p50, p95, p99 = np.percentile(np.array(samples) * 1e3, [50, 95, 99])
+            report['labels'][label] = {'count': len(samples), 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                                       'max_ms': max(samples) * 1e3}
+        return report
+
+
+def syntheticSession(kind, canvas=(800, 600), rate=120, seed=0):
+    """
+    Build a session of strokes, shape drags, a selection move, typed text or all of them, sampled at rate events/s.
+    """
+    width, height = canvas
+    events = []
+    clock = [0.0]
+
+    def state(tool):
+        return {'tool': tool, 'thickness': 5, 'primary': [0, 0, 0], 'secondary': [255, 255, 255], 'filled': False,
+                'font': [0, 0.3], 'effect': None}
+
+    def add(entry):
+        clock[0] += 1 / rate
+        entry['t'] = round(clock[0], 4)
+        events.append(entry)
+
+    def drag(tool, path, modifiers=0):
+        left, held = int(Qt.LeftButton), int(Qt.LeftButton)
+        add({'type': 'press', 'x': int(path[0][0]), 'y': int(path[0][1]), 'button': left, 'buttons': held,
+             'modifiers': modifiers, 'inside': True, 'state': state(tool)})
+        for x, y in path[1:]:
+            add({'type': 'move', 'x': int(x), 'y': int(y), 'button': 0, 'buttons': held, 'inside': True})
+        add({'type': 'release', 'x': int(path[-1][0]), 'y': int(path[-1][1]), 'button': left, 'buttons': 0,
+             'inside': True})
+
+    if kind in ('stroke', 'mixed'):
+        for index in range(3):
+            path = syntheticPath(width - 150, 120, seed + index)
+            path[:, 1] = np.clip(path[:, 1] - 300 + height // 4 * (index + 1), 0, height - 1)
+            drag('draw', path)
+    if kind in ('shapes', 'mixed'):
+        for index, shape in enumerate(['rectangle', 'circle', 'hexagon', 'line']):
+            t = np.linspace(0, 1, 40)[:, None]
+            start = np.array([50 + index * 40, 50 + index * 30])
+            drag(shape, start + t * np.array([width // 2, height // 2]))
+    if kind in ('selection', 'mixed'):
+        t = np.linspace(0, 1, 30)[:, None]
+        drag('pointer', np.array([100, 100]) + t * np.array([200, 150]))
+        drag('pointer', np.array([200, 170]) + t * np.array([150, 100]))
+        add({'type': 'press', 'x': width - 20, 'y': height - 20, 'button': int(Qt.LeftButton),
+             'buttons': int(Qt.LeftButton), 'inside': True, 'state': state('pointer')})
+        add({'type': 'release', 'x': width - 20, 'y': height - 20, 'button': int(Qt.LeftButton), 'buttons': 0,
+             'inside': True})
+        # A lasso, a second lasso and a wand click added to it with Shift, then moving the whole selection
+        angle = np.linspace(0, 2 * np.pi, 60)[:, None]
+        drag('lasso', np.array([width // 3, height // 2]) + np.hstack([np.cos(angle), np.sin(angle)]) * 120)
+        drag('lasso', np.array([width // 2, height // 2]) + np.hstack([np.cos(angle), np.sin(angle)]) * 90,
+             int(Qt.ShiftModifier))
+        drag('wand', np.array([[width - 40, 40]] * 2), int(Qt.ShiftModifier))
+        drag('pointer', np.array([width // 2 + 60, height // 2]) + t * np.array([120, 60]))
+    if kind in ('text', 'mixed'):
+        add({'type': 'press', 'x': 80, 'y': height - 80, 'button': int(Qt.LeftButton),
+             'buttons': int(Qt.LeftButton), 'inside': True, 'state': state('text')})
+        add({'type': 'release', 'x': 80, 'y': height - 80, 'button': int(Qt.LeftButton), 'buttons': 0,
+             'inside': True})
+        for char in 'pypaint replay':
+            key = Qt.Key_Space if char == ' ' else ord(char.upper())
+            add({'type': 'key', 'key': int(key), 'text': char, 'modifiers': 0})
+        add({'type': 'key', 'key': int(Qt.Key_Return), 'text': '\r', 'modifiers': 0})
+    return canvas, events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m replay_manager',
+                                     description='Replay a recorded PyPaint session offscreen and report frame times.')
+    parser.add_argument('session', nargs='?', help='session file recorded with main.py --record')
+    parser.add_argument('--synthetic', choices=['stroke', 'shapes', 'selection', 'text', 'mixed'],
+                        help='replay a generated session instead of a file')
+    parser.add_argument('--save', help='write the generated session to this file')
+    parser.add_argument('--speed', type=float, default=1.0, help='pacing factor, 0 replays as fast as possible')
+    parser.add_argument('--effect', default=None, help="display effect for every press, such as 'sketch'")
+    parser.add_argument('-o', '--output', help='write the report as JSON to this file')
+    args = parser.parse_args(argv)
+    if not args.session and not args.synthetic:
+        parser.error('give a session file or --synthetic')
+
+    # Must be set before the application is created
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from main import Core
+    app = QApplication.instance() or QApplication([])
+    core = Core(app=app, width=1200, height=720, title='PyPaint replay')
+    core.show()
+
+    if args.synthetic:
+        canvas, events = syntheticSession(args.synthetic)
+        if args.save:
+            ReplayManager.save(args.save, canvas, events)
+    else:
+        canvas, events = ReplayManager.load(args.session)
+    if args.effect:
+        for entry in events:
+            if 'state' in entry:
+                entry['state']['effect'] = args.effect
+
+    replay = ReplayManager(core, app)
+    report = replay.summary(*replay.replay(canvas, events, args.speed))
+    print(f"{report['events']} events in {report['wall_s']:.2f}s")
+    for label, stats in report['labels'].items():
+        print(f"{label:<20} {stats['count']:>6} events  p50 {stats['p50_ms']:8.3f} ms  p95 {stats['p95_ms']:8.3f} ms"
+              f"  p99 {stats['p99_ms']:8.3f} ms  max {stats['max_ms']:8.3f} ms")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
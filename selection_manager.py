@@ -0,0 +1,214 @@
+import numpy as np
+import cv2
+
+
+class Selection:
+    """
+    Selected pixels held as a mask over their bounding rect (x0, y0, x1, y1), so storing, combining and moving
+    a selection costs in proportion to its bounding rect rather than the canvas.
+    A lifted selection carries the pixels cut from under it, floating at an offset until it is dropped.
+    """
+    def __init__(self, mask, rect):
+        # 255 where selected, covering only the bounding rect
+        self.mask = mask
+        self.rect = rect
+        self.pixels = None
+        self.patch = None
+        self.offset = (0, 0)
+        self.dashes = None
+
+    @staticmethod
+    def fromMask(mask, x=0, y=0):
+        """
+        Build a selection from a mask whose top left pixel is at (x, y), trimmed to the pixels it selects.
+        Returns None when the mask selects nothing.
+        """
+        x0, y0, width, height = cv2.boundingRect(mask)
+        if width == 0 or height == 0:
+            return None
+        return Selection(mask[y0:y0 + height, x0:x0 + width].copy(),
+                         (x + x0, y + y0, x + x0 + width, y + y0 + height))
+
+    @staticmethod
+    def fromRect(start_pos, current_pos, shape):
+        """
+        Select the rectangle between two corners, clipped to an image shape.
+        """
+        x0, x1 = max(min(start_pos[0], current_pos[0]), 0), min(max(start_pos[0], current_pos[0]), shape[1])
+        y0, y1 = max(min(start_pos[1], current_pos[1]), 0), min(max(start_pos[1], current_pos[1]), shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return Selection(np.full((y1 - y0, x1 - x0), 255, dtype=np.uint8), (x0, y0, x1, y1))
+
+    @staticmethod
+    def fromPolygon(points, shape):
+        """
+        Select the inside of a lasso path, closed from its last point back to the first.
+        """
+        pts = np.array(points, np.int32).reshape(-1, 2)
+        x0, y0 = max(int(pts[:, 0].min()), 0), max(int(pts[:, 1].min()), 0)
+        x1, y1 = min(int(pts[:, 0].max()) + 1, shape[1]), min(int(pts[:, 1].max()) + 1, shape[0])
+        if len(pts) < 3 or x0 >= x1 or y0 >= y1:
+            return None
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.fillPoly(mask, [(pts - (x0, y0)).astype(np.int32)], 255)
+        return Selection.fromMask(mask, x0, y0)
+
+    @staticmethod
+    def fromColor(image, seed, tolerance, contiguous=True):
+        """
+        Magic wand: select the pixels whose channels are each within tolerance of the seed color,
+        only those connected to the seed when contiguous.
+        """
+        x, y = seed
+        if not (0 <= x < image.shape[1] and 0 <= y < image.shape[0]):
+            return None
+        if contiguous:
+            # floodFill needs a mask one pixel larger on every side; it only marks, the image is left untouched
+            mask = np.zeros((image.shape[0] + 2, image.shape[1] + 2), dtype=np.uint8)
+            diff = (tolerance,) * image.shape[2]
+            _, _, _, (x0, y0, width, height) = cv2.floodFill(image, mask, (int(x), int(y)), 0, diff, diff,
+                                                             4 | cv2.FLOODFILL_FIXED_RANGE |
+                                                             cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+            return Selection(mask[y0 + 1:y0 + 1 + height, x0 + 1:x0 + 1 + width].copy(),
+                             (x0, y0, x0 + width, y0 + height))
+        seed_color = image[y, x].astype(np.int16)
+        lower = np.clip(seed_color - tolerance, 0, 255).astype(np.uint8)
+        upper = np.clip(seed_color + tolerance, 0, 255).astype(np.uint8)
+        return Selection.fromMask(cv2.inRange(image, lower, upper))
+
+    def maskIn(self, rect):
+        """
+        Get the mask over another rect, zero wherever this selection does not reach.
+        """
+        out = np.zeros((rect[3] - rect[1], rect[2] - rect[0]), dtype=np.uint8)
+        x0, y0 = max(rect[0], self.rect[0]), max(rect[1], self.rect[1])
+        x1, y1 = min(rect[2], self.rect[2]), min(rect[3], self.rect[3])
+        if x0 < x1 and y0 < y1:
+            out[y0 - rect[1]:y1 - rect[1], x0 - rect[0]:x1 - rect[0]] = \
+                self.mask[y0 - self.rect[1]:y1 - self.rect[1], x0 - self.rect[0]:x1 - self.rect[0]]
+        return out
+
+    def combine(self, other, mode):
+        """
+        Combine with another selection by mode, 'add', 'subtract' or 'intersect'.
+        Only the rect the result can cover is touched. Returns the result, or None when it selects nothing.
+        """
+        if mode == 'intersect':
+            rect = (max(self.rect[0], other.rect[0]), max(self.rect[1], other.rect[1]),
+                    min(self.rect[2], other.rect[2]), min(self.rect[3], other.rect[3]))
+            if rect[0] >= rect[2] or rect[1] >= rect[3]:
+                return None
+        elif mode == 'subtract':
+            rect = self.rect
+        else:
+            rect = (min(self.rect[0], other.rect[0]), min(self.rect[1], other.rect[1]),
+                    max(self.rect[2], other.rect[2]), max(self.rect[3], other.rect[3]))
+        mask = self.maskIn(rect)
+        if mode == 'add':
+            cv2.bitwise_or(mask, other.maskIn(rect), dst=mask)
+        elif mode == 'subtract':
+            # Masks are 0 or 255, so a saturating subtract clears exactly the other selection
+            cv2.subtract(mask, other.maskIn(rect), dst=mask)
+        else:
+            cv2.bitwise_and(mask, other.maskIn(rect), dst=mask)
+        return Selection.fromMask(mask, rect[0], rect[1])
+
+    def floatRect(self):
+        """
+        Get the rect the selection covers at its current offset, which may reach past the image.
+        """
+        dx, dy = self.offset
+        return self.rect[0] + dx, self.rect[1] + dy, self.rect[2] + dx, self.rect[3] + dy
+
+    def visibleRect(self, shape):
+        """
+        Get the part of floatRect inside an image shape, or None.
+        """
+        x0, y0, x1, y1 = self.floatRect()
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, shape[1]), min(y1, shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def contains(self, x, y):
+        """
+        Check if an image position lies on a selected pixel.
+        """
+        x0, y0, _, _ = self.floatRect()
+        x, y = x - x0, y - y0
+        return 0 <= y < self.mask.shape[0] and 0 <= x < self.mask.shape[1] and self.mask[y, x] > 0
+
+    def lift(self, image, fill):
+        """
+        Cut the selected pixels out of the image, leaving fill behind, and return the rect that changed.
+        """
+        x0, y0, x1, y1 = self.rect
+        region = image[y0:y1, x0:x1]
+        self.pixels = region.copy()
+        # Converted for the premultiplied overlay once, not on every move. Layer pixels already are premultiplied
+        if self.pixels.shape[2] == 4:
+            self.patch = self.pixels
+        else:
+            self.patch = cv2.cvtColor(self.pixels, cv2.COLOR_BGR2BGRA)
+        region[self.mask > 0] = fill
+        return self.rect
+
+    def move(self, dx, dy):
+        """
+        Move the selection by an offset.
+        """
+        self.offset = (self.offset[0] + dx, self.offset[1] + dy)
+
+    def drop(self, image):
+        """
+        Paste the lifted pixels into the image where the selection floats and return the rect that changed.
+        """
+        rect = self.visibleRect(image.shape)
+        if rect is None:
+            return None
+        x0, y0, _, _ = self.floatRect()
+        source = (slice(rect[1] - y0, rect[3] - y0), slice(rect[0] - x0, rect[2] - x0))
+        cv2.copyTo(self.pixels[source], self.mask[source], image[rect[1]:rect[3], rect[0]:rect[2]])
+        return rect
+
+    def settle(self, shape):
+        """
+        Get a selection of the same pixels at the place this one floats, clipped to an image shape.
+        """
+        rect = self.visibleRect(shape)
+        if rect is None:
+            return None
+        x0, y0, _, _ = self.floatRect()
+        return Selection.fromMask(self.mask[rect[1] - y0:rect[3] - y0, rect[0] - x0:rect[2] - x0], rect[0], rect[1])
+
+    def crop(self, image, fill):
+        """
+        Get the selected pixels in their bounding rect, with fill where the mask leaves them out.
+        """
+        x0, y0, x1, y1 = self.rect
+        pixels = self.pixels.copy() if self.pixels is not None else image[y0:y1, x0:x1].copy()
+        pixels[self.mask == 0] = fill
+        return pixels
+
+    def outline(self):
+        """
+        Get the (x, y) pixels of a dashed outline along the mask edge, relative to its rect.
+        """
+        if self.dashes is None:
+            contours, _ = cv2.findContours(self.mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+            # Four edge pixels out of every ten are drawn, close to the dashes of drawDashRect
+            dashes = [contour.reshape(-1, 2)[np.arange(len(contour)) % 10 < 4] for contour in contours]
+            self.dashes = np.concatenate(dashes) if dashes else np.empty((0, 2), dtype=np.int32)
+        return self.dashes
+
+    def drawOutline(self, image, color):
+        """
+        Draw the dashed outline on an image at the place the selection floats.
+        """
+        x0, y0, _, _ = self.floatRect()
+        points = self.outline() + (x0, y0)
+        inside = (points[:, 0] >= 0) & (points[:, 0] < image.shape[1]) & \
+                 (points[:, 1] >= 0) & (points[:, 1] < image.shape[0])
+        points = points[inside]
+        image[points[:, 1], points[:, 0]] = color
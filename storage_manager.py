@@ -0,0 +1,209 @@
+import os
+import sys
+import tempfile
+import time
+import weakref
+import numpy as np
+import cv2
+
+# Large images are copied, composited and saved this many bytes of rows at a time
+BAND_BYTES = 64 * 1024 * 1024
+
+
+def bandRows(shape, band_bytes=BAND_BYTES):
+    """
+    Get how many rows of an image shape fit in a band.
+    """
+    row_bytes = int(np.prod(shape[1:])) or 1
+    return max(band_bytes // row_bytes, 1)
+
+
+def pristine(image):
+    """
+    Get a read-only map of the file behind a disk backed image, still holding its pixels from when it was opened,
+    or None when the image is held in memory.
+    """
+    if not isinstance(image, np.memmap) or image.mode != 'c' or image.filename is None:
+        return None
+    return np.memmap(image.filename, dtype=image.dtype, mode='r', shape=image.shape, offset=image.offset)
+
+
+class StorageManager:
+    """
+    Optional disk backing for canvases larger than memory. Images live in raw files in a scratch directory on local
+    disk, mapped copy-on-write, so only the pages that are drawn on, shown or saved become resident, and the file
+    itself keeps the untouched pixels for the tile store to read instead of copying them.
+    """
+    def __init__(self, directory=None, band_bytes=BAND_BYTES):
+        self.directory = directory or tempfile.gettempdir()
+        self.band_bytes = band_bytes
+        self.enabled = False
+        self.paths = set()
+
+    def bands(self, shape):
+        """
+        Get the (y0, y1) row bands of an image shape.
+        """
+        rows = bandRows(shape, self.band_bytes)
+        return [(y0, min(y0 + rows, shape[0])) for y0 in range(0, shape[0], rows)]
+
+    def create(self, shape):
+        """
+        Create a raw scratch file for an image shape, mapped for writing.
+        """
+        descriptor, path = tempfile.mkstemp(prefix='pypaint-', suffix='.raw', dir=self.directory)
+        os.close(descriptor)
+        self.paths.add(path)
+        return np.memmap(path, dtype=np.uint8, mode='w+', shape=tuple(shape))
+
+    def open(self, written):
+        """
+        Reopen a written scratch file copy-on-write: edits stay in memory pages and the file keeps the pixels as written.
+        The file is removed once the image is no longer used.
+        """
+        written.flush()
+        image = np.memmap(written.filename, dtype=np.uint8, mode='c', shape=written.shape)
+        weakref.finalize(image, self.remove, written.filename)
+        return image
+
+    def allocate(self, shape):
+        """
+        Get an uninitialized image for a cache such as the layer composite, disk backed when enabled.
+        Caches are mapped shared rather than copy-on-write, so the pages written to them can be flushed and dropped.
+        """
+        if not self.enabled:
+            return np.empty(shape, dtype=np.uint8)
+        image = self.create(shape)
+        weakref.finalize(image, self.remove, image.filename)
+        return image
+
+    def full(self, shape, color):
+        """
+        Get an image filled with a color, written to disk band by band when enabled.
+        """
+        if not self.enabled:
+            return np.full(shape, color, dtype=np.uint8)
+        out = self.create(shape)
+        # A new scratch file already reads as zeros, such as a transparent layer, without writing it
+        if np.any(color):
+            for y0, y1 in self.bands(shape):
+                out[y0:y1] = color
+        return self.open(out)
+
+    def store(self, image, progress=None, cancelled=None):
+        """
+        Copy an image into a new scratch file band by band and return it disk backed.
+        progress is called with the fraction done and cancelled is polled between bands.
+        """
+        out = self.create(image.shape)
+        for y0, y1 in self.bands(image.shape):
+            if cancelled is not None and cancelled():
+                break
+            out[y0:y1] = image[y0:y1]
+            if progress is not None:
+                progress(y1 / image.shape[0])
+        return self.open(out)
+
+    def adopt(self, image, progress=None, cancelled=None):
+        """
+        Move an image to disk when enabled, unless it already is. Otherwise the image is returned as it is.
+        """
+        if not self.enabled or pristine(image) is not None:
+            return image
+        return self.store(image, progress, cancelled)
+
+    def load(self, path, progress=None, cancelled=None):
+        """
+        Load a .npy file of BGR pixels band by band through a read-only map, so it is never resident as a whole.
+        """
+        image = np.load(path, mmap_mode='r')
+        if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError(f'{os.path.basename(path)} does not hold BGR pixels')
+        if not self.enabled:
+            return np.array(image)
+        return self.store(image, progress, cancelled)
+
+    def remove(self, path):
+        """
+        Delete a scratch file. Systems that cannot delete mapped files keep it until close.
+        """
+        try:
+            os.remove(path)
+            self.paths.discard(path)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Delete every scratch file still on disk.
+        """
+        for path in list(self.paths):
+            self.remove(path)
+
+    def diskUsage(self):
+        """
+        Get the bytes of scratch files on disk.
+        """
+        return sum(os.path.getsize(path) for path in self.paths if os.path.exists(path))
+
+
+def residentBytes():
+    """
+    Get the anonymous resident memory of this process, leaving out mapped file pages the system can drop and read
+    back at any time, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def benchmark(size=20000, strokes=200):
+    """
+    Touch up a size x size canvas held on disk: create it, paint strokes in one corner, bring their tiles into a
+    tile store reading the file, and save it to .npy in bands. Reports seconds per step and resident memory,
+    which should stay far below the canvas size.
+    """
+    from tile_manager import TileManager
+    from io_manager import writeBands
+    storage = StorageManager()
+    storage.enabled = True
+    results = {'canvas_mb': size * size * 3 / 1e6, 'resident_start_mb': (residentBytes() or 0) / 1e6}
+    start = time.perf_counter()
+    image = storage.full((size, size, 3), 255)
+    tiles = TileManager()
+    tiles.loadShared(pristine(image))
+    results['open_s'] = time.perf_counter() - start
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for _ in range(strokes):
+        x, y = (int(v) for v in rng.integers(0, 4000, 2))
+        cv2.line(image, (x, y), (x + 200, y + 50), (0, 0, 255), 8)
+        tiles.commit(image, (max(x - 8, 0), max(y - 8, 0), x + 209, y + 59))
+    results['paint_s'] = time.perf_counter() - start
+    results['resident_paint_mb'] = (residentBytes() or 0) / 1e6
+    path = os.path.join(storage.directory, 'pypaint-benchmark.npy')
+    start = time.perf_counter()
+    snapshot = tiles.snapshot()
+    with open(path, 'wb') as file:
+        writeBands(file, '.npy', (size, size, 3),
+                   (snapshot.region((0, y0, size, y1)) for y0, y1 in storage.bands(image.shape)))
+    results['save_s'] = time.perf_counter() - start
+    results['resident_save_mb'] = (residentBytes() or 0) / 1e6
+    os.remove(path)
+    del image, tiles, snapshot
+    storage.close()
+    return results
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    result = benchmark(size)
+    print(f"{size}x{size} canvas, {result['canvas_mb']:.0f} MB: open {result['open_s']:.1f} s, "
+          f"200 strokes {result['paint_s']:.2f} s, save .npy {result['save_s']:.1f} s")
+    print(f"resident: start {result['resident_start_mb']:.0f} MB, after painting {result['resident_paint_mb']:.0f} MB, "
+          f"after saving {result['resident_save_mb']:.0f} MB")
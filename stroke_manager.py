@@ -0,0 +1,127 @@
+import sys
+import time
+import numpy as np
+import cv2
+
+from cv_manager import CVManager
+
+
+class StrokeManager:
+    """
+    Collect pointer samples of a freehand stroke and rasterize each batch with one polyline call.
+    """
+    def __init__(self, cv_manager, smoothing=0.0, flush_interval=0.0):
+        self.CV = cv_manager
+        self.smoothing = smoothing
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_point = None
+        self.last_flush = 0.0
+        self.color = (0, 0, 0)
+        self.thickness = 1
+
+    def begin(self, point, color, thickness):
+        """
+        Start a stroke at point.
+        """
+        self.color = color
+        self.thickness = thickness
+        self.pending = []
+        self.last_point = None
+        self.last_flush = 0.0
+        self.addPoint(point)
+
+    def addPoint(self, point):
+        """
+        Queue a pointer sample, pulling it towards the previous one when smoothing is set.
+        """
+        point = np.array(point, np.float64)
+        previous = self.pending[-1] if self.pending else self.last_point
+        if previous is not None and self.smoothing:
+            point = previous + (1 - self.smoothing) * (point - previous)
+        self.pending.append(point)
+
+    def flush(self, image, force=False):
+        """
+        Rasterize the queued samples joined to the end of the stroke so far.
+        Returns the dirty rect, or None when nothing was drawn or the flush interval has not passed yet.
+        """
+        if not self.pending:
+            return None
+        now = time.perf_counter()
+        if not force and now - self.last_flush < self.flush_interval:
+            return None
+        points = self.pending if self.last_point is None else [self.last_point] + self.pending
+        rect = self.CV.drawPolyline(image, np.rint(points), self.color, self.thickness)
+        self.last_point = self.pending[-1]
+        self.pending = []
+        self.last_flush = now
+        return rect
+
+    def end(self, image):
+        """
+        Rasterize whatever is still queued and finish the stroke.
+        """
+        rect = self.flush(image, force=True)
+        self.last_point = None
+        return rect
+
+
+def syntheticPath(length, samples, seed=0):
+    """
+    Build a wavy pointer path of a given length in pixels, sampled at a number of events.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, samples)
+    x = 50 + t * length
+    y = 300 + 120 * np.sin(t * 6 * np.pi) + rng.normal(0, 1.5, samples)
+    return np.stack([x, y], axis=1).astype(int)
+
+
+def naiveStroke(image, path, color, thickness):
+    """
+    Rasterize a path the way Core did before, one cv2.line per pixel of travel.
+    """
+    start = path[0]
+    for x, y in path[1:]:
+        dist = np.sqrt((x - start[0]) ** 2 + (y - start[1]) ** 2)
+        num_points = max(int(dist), 1)
+        xs = np.linspace(start[0], x, num_points).astype(int)
+        ys = np.linspace(start[1], y, num_points).astype(int)
+        for i in range(num_points - 1):
+            cv2.line(image, (int(xs[i]), int(ys[i])), (int(xs[i + 1]), int(ys[i + 1])), color, thickness,
+                     cv2.LINE_AA)
+        start = (x, y)
+
+
+def benchmark(length=4000, samples=40, thickness=5, repeat=5):
+    """
+    Time the naive per-pixel stroke against the polyline engine on the same synthetic path.
+    """
+    path = syntheticPath(length, samples)
+    image = np.full((600, length + 100, 3), 255, np.uint8)
+    engine = StrokeManager(CVManager())
+    results = {}
+    for name in ('naive', 'engine'):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if name == 'naive':
+                naiveStroke(image, path, (0, 0, 0), thickness)
+            else:
+                engine.begin(path[0], (0, 0, 0), thickness)
+                for point in path[1:]:
+                    engine.addPoint(point)
+                    engine.flush(image)
+                engine.end(image)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best / (samples - 1)
+    return results
+
+
+if __name__ == '__main__':
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    for samples in (10, 40, 160):
+        result = benchmark(length, samples)
+        print(f"{length}px path, {samples} events: naive {result['naive'] * 1e3:.3f} ms/event, "
+              f"engine {result['engine'] * 1e3:.3f} ms/event")
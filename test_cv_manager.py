@@ -0,0 +1,77 @@
+import numpy as np
+import cv2
+import pytest
+
+from benchmark_manager import BenchmarkManager, EFFECTS, FAST_EFFECTS, FAST_KERNELS
+from cv_manager import CVManager, FAST_BLUR_TOLERANCE
+
+CHAINS = ['grey|blur 2|invert', 'blur 3|sketch']
+
+
+def canvas(height, width=160, seed=0):
+    """
+    Get a noisy BGR canvas with hard edges, where a band edge out of place shows.
+    """
+    image = cv2.GaussianBlur(np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8),
+                             (3, 3), 0)
+    cv2.rectangle(image, (20, height // 3), (width - 20, height // 2), (0, 0, 0), -1)
+    cv2.circle(image, (width // 2, height * 2 // 3), width // 3, (255, 255, 255), -1)
+    return image
+
+
+def bandedManager(workers=4, fast_blur=False):
+    """
+    Get a CVManager that bands every image, however small.
+    """
+    cv = CVManager(filter_workers=workers)
+    cv.band_threshold = 0
+    cv.fast_blur = fast_blur
+    return cv
+
+
+def withinTolerance(exact, fast, tolerance):
+    """
+    Check the mean and max difference between an exact and a fast result against a tolerance.
+    """
+    difference = np.abs(exact.astype(np.int16) - fast)
+    return difference.mean() <= tolerance['mean'] and difference.max() <= tolerance['max']
+
+
+@pytest.mark.parametrize('height', [640, 1001])
+@pytest.mark.parametrize('effect', EFFECTS + CHAINS)
+def test_banded_filter_matches_serial(effect, height):
+    cv = bandedManager()
+    image = canvas(height)
+    assert np.array_equal(cv.apply_filter(image, effect, workers=4), cv.apply_filter(image, effect, workers=1))
+
+
+@pytest.mark.parametrize('image', [BenchmarkManager.syntheticImage(512), canvas(512, 512)], ids=['synthetic', 'noise'])
+@pytest.mark.parametrize('kernel', FAST_KERNELS)
+def test_fast_blur_within_tolerance(kernel, image):
+    exact, fast = bandedManager(1), bandedManager(1, fast_blur=True)
+    assert withinTolerance(exact.gaussianBlur(image, kernel), fast.gaussianBlur(image, kernel), FAST_BLUR_TOLERANCE)
+
+
+@pytest.mark.parametrize('image', [BenchmarkManager.syntheticImage(512), canvas(512, 512)], ids=['synthetic', 'noise'])
+@pytest.mark.parametrize('effect', FAST_EFFECTS)
+def test_fast_effect_within_tolerance(effect, image):
+    exact, fast = bandedManager(1), bandedManager(1, fast_blur=True)
+    assert withinTolerance(exact.apply_filter(image, effect), fast.apply_filter(image, effect), FAST_EFFECTS[effect])
+
+
+@pytest.mark.parametrize('height', [640, 1001])
+@pytest.mark.parametrize('effect', list(FAST_EFFECTS) + CHAINS)
+def test_fast_banded_filter_matches_serial(effect, height):
+    cv = bandedManager(fast_blur=True)
+    image = canvas(height)
+    assert np.array_equal(cv.apply_filter(image, effect, workers=4), cv.apply_filter(image, effect, workers=1))
+
+
+@pytest.mark.parametrize('fast_blur', [False, True], ids=['exact', 'fast'])
+@pytest.mark.parametrize('effect', list(FAST_EFFECTS) + CHAINS)
+def test_region_matches_whole_filter(effect, fast_blur):
+    cv = bandedManager(1, fast_blur)
+    image = canvas(700, 600)
+    whole = cv.filterImage(image, effect)
+    for x0, y0, x1, y1 in [(0, 0, 37, 51), (101, 203, 389, 317), (333, 451, 600, 700), (5, 640, 600, 700)]:
+        assert np.array_equal(cv.filterRegion(image, effect, (x0, y0, x1, y1)), whole[y0:y1, x0:x1])
@@ -0,0 +1,26 @@
+import numpy as np
+import cv2
+import pytest
+
+import io_manager
+from cv_manager import CVManager
+from io_manager import SaveWorker
+from test_cv_manager import CHAINS, canvas
+from tile_manager import TileManager
+
+
+@pytest.mark.parametrize('stream', [False, True], ids=['encoded', 'streamed'])
+@pytest.mark.parametrize('effect', ['blur 2', 'blur 4', 'sketch'] + CHAINS)
+def test_fast_saved_bands_match_whole_filter(effect, stream, tmp_path, monkeypatch):
+    # Stream in the smallest bands the halo allows, so a small canvas is cut into several
+    monkeypatch.setattr(io_manager, 'bandRows', lambda shape: 1)
+    cv = CVManager(filter_workers=1)
+    cv.fast_blur = True
+    image = canvas(1001)
+    tiles = TileManager()
+    tiles.load(image)
+    path = str(tmp_path / 'saved.png')
+    assert SaveWorker(path, tiles, effect, cv, stream).work() == path
+    whole = cv.filterImage(image, effect)
+    whole = whole if whole.ndim == 2 else cv2.cvtColor(whole, cv2.COLOR_RGB2BGR)
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), whole)
@@ -0,0 +1,156 @@
+import numpy as np
+
+from cv_manager import CVManager
+
+
+class TileManager:
+    """
+    Tiled copy of the document whose tiles are shared between snapshots and replaced, never written, on change.
+    The image being edited stays one whole array, so tools and OpenCV work on it unchanged, and the tiles are a
+    second copy of its pixels kept for snapshots. Resident memory is about twice the canvas, except for tiles that
+    are read-only views of a disk backed file or shared blank tiles.
+    """
+    def __init__(self, tile_size=256):
+        self.tile_size = tile_size
+        self.tiles = {}
+        self.shape = None
+
+    def load(self, image):
+        """
+        Split a whole image into fresh tiles.
+        """
+        self.shape = image.shape
+        self.tiles = {}
+        for key in self.tileKeys((0, 0, image.shape[1], image.shape[0])):
+            self.tiles[key] = self.cutTile(image, key)
+
+    def loadShared(self, image):
+        """
+        Fill the store with read-only views of an image that is never written, such as the file behind a disk backed
+        canvas, so no pixels are copied until their tiles are committed.
+        """
+        self.shape = image.shape
+        self.tiles = {}
+        for key in self.tileKeys((0, 0, image.shape[1], image.shape[0])):
+            x0, y0, x1, y1 = self.tileRect(key)
+            tile = image[y0:y1, x0:x1]
+            tile.flags.writeable = False
+            self.tiles[key] = tile
+
+    def loadBlank(self, shape):
+        """
+        Fill the store with zero tiles for an image shape, sharing one read-only tile per tile size.
+        """
+        self.shape = shape
+        self.tiles = {}
+        blanks = {}
+        for key in self.tileKeys((0, 0, shape[1], shape[0])):
+            x0, y0, x1, y1 = self.tileRect(key)
+            if (y1 - y0, x1 - x0) not in blanks:
+                blank = np.zeros((y1 - y0, x1 - x0) + tuple(shape[2:]), dtype=np.uint8)
+                blank.flags.writeable = False
+                blanks[(y1 - y0, x1 - x0)] = blank
+            self.tiles[key] = blanks[(y1 - y0, x1 - x0)]
+
+    def snapshot(self):
+        """
+        Get a copy-on-write snapshot sharing every tile with this store.
+        """
+        snapshot = TileManager(self.tile_size)
+        snapshot.tiles = dict(self.tiles)
+        snapshot.shape = self.shape
+        return snapshot
+
+    def commit(self, image, rect):
+        """
+        Replace the tiles touched by rect with copies of the image, leaving snapshots their old tiles.
+        """
+        if rect is None:
+            return
+        if image.shape != self.shape:
+            self.load(image)
+            return
+        for key in self.tileKeys(rect):
+            self.tiles[key] = self.cutTile(image, key)
+
+    def restore(self, image, snapshot):
+        """
+        Bring the image back to a snapshot, writing only the tiles that differ.
+        Returns the image, which is a new array when the shape changed, and the rect that changed.
+        """
+        if snapshot.shape != image.shape:
+            image = snapshot.toArray()
+            self.tiles = dict(snapshot.tiles)
+            self.shape = snapshot.shape
+            return image, None
+        rect = None
+        for key, tile in snapshot.tiles.items():
+            if self.tiles.get(key) is not tile:
+                x0, y0, x1, y1 = self.tileRect(key)
+                image[y0:y1, x0:x1] = tile
+                self.tiles[key] = tile
+                rect = CVManager.unionRect(rect, (x0, y0, x1, y1))
+        return image, rect
+
+    def region(self, rect):
+        """
+        Assemble the pixels of a rect from the tiles.
+        """
+        x0, y0, x1, y1 = rect
+        out = np.empty((y1 - y0, x1 - x0) + tuple(self.shape[2:]), dtype=np.uint8)
+        for key in self.tileKeys(rect):
+            tx0, ty0, tx1, ty1 = self.tileRect(key)
+            ix0, iy0, ix1, iy1 = max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1)
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.tiles[key][iy0 - ty0:iy1 - ty0, ix0 - tx0:ix1 - tx0]
+        return out
+
+    def toArray(self):
+        """
+        Assemble the whole image from the tiles.
+        """
+        return self.region((0, 0, self.shape[1], self.shape[0]))
+
+    def changedKeys(self, snapshot):
+        """
+        Get the keys of tiles that are not shared with a snapshot.
+        """
+        if snapshot is None or snapshot.shape != self.shape:
+            return list(self.tiles)
+        return [key for key, tile in self.tiles.items() if snapshot.tiles.get(key) is not tile]
+
+    def tileKeys(self, rect):
+        """
+        Get the (row, column) keys of the tiles intersecting a rect.
+        """
+        size = self.tile_size
+        x0, y0 = max(rect[0], 0), max(rect[1], 0)
+        x1, y1 = min(rect[2], self.shape[1]), min(rect[3], self.shape[0])
+        return [(row, column) for row in range(y0 // size, (y1 + size - 1) // size)
+                for column in range(x0 // size, (x1 + size - 1) // size)]
+
+    def tileRect(self, key):
+        """
+        Get the image rect (x0, y0, x1, y1) covered by a tile.
+        """
+        size = self.tile_size
+        return (key[1] * size, key[0] * size,
+                min((key[1] + 1) * size, self.shape[1]), min((key[0] + 1) * size, self.shape[0]))
+
+    def cutTile(self, image, key):
+        """
+        Copy the pixels of one tile out of an image.
+        """
+        x0, y0, x1, y1 = self.tileRect(key)
+        tile = image[y0:y1, x0:x1].copy()
+        tile.flags.writeable = False
+        return tile
+
+    def memoryUsage(self, *snapshots):
+        """
+        Get the bytes held by the tiles of this store and the given snapshots, counting shared tiles once.
+        """
+        seen = {}
+        for store in (self,) + snapshots:
+            for tile in store.tiles.values():
+                seen[id(tile)] = tile.nbytes
+        return sum(seen.values())
@@ -5,6 +5,73 @@ import numpy as np
 import cv2
 
 
+class Canvas(QLabel):
+    """
+    Label painting a persistent BGRA display buffer, which is written in place and repainted only where it changed.
+    The display holds canvas pixels, the overlay document pixels, scaled through the viewport when one is set.
+    """
+    def __init__(self):
+        super().__init__()
+        self.view = None
+        self.display = None
+        self.display_image = None
+        self.overlay = None
+        self.overlay_image = None
+
+    def resizeDisplay(self, width, height):
+        """
+        Allocate the display buffer and the QImage viewing it. The canvas owns the buffer,
+        so the QImage never outlives the memory it points at.
+        """
+        self.display = np.full((height, width, 4), 255, dtype=np.uint8)
+        # RGB32 is stored as B, G, R, 0xFF bytes, the same layout as a BGRA numpy array
+        self.display_image = QImage(self.display.data, width, height, self.display.strides[0], QImage.Format_RGB32)
+        self.setFixedSize(width, height)
+        self.update()
+
+    def updateDisplay(self, rect=None):
+        """
+        Repaint the area of a document rect (x0, y0, x1, y1) after it was written, or the whole canvas.
+        """
+        if rect is None:
+            self.update()
+        else:
+            self.updateOverlay(rect)
+
+    def setOverlay(self, overlay):
+        """
+        Composite a BGRA numpy buffer over the pixmap; the buffer is viewed in place, not copied.
+        """
+        self.overlay = overlay
+        height, width = overlay.shape[:2]
+        self.overlay_image = QImage(overlay.data, width, height, overlay.strides[0],
+                                    QImage.Format_ARGB32_Premultiplied)
+        self.update()
+
+    def updateOverlay(self, rect):
+        """
+        Repaint the area of an overlay rect (x0, y0, x1, y1), in document pixels.
+        """
+        if rect is not None and self.view is not None:
+            rect = self.view.canvasRect(rect)
+        if rect is not None:
+            self.update(QRect(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1]))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        if self.display_image is not None:
+            painter.drawImage(event.rect(), self.display_image, event.rect())
+        if self.overlay_image is not None:
+            if self.view is None or self.view.isIdentity():
+                painter.drawImage(event.rect(), self.overlay_image, event.rect())
+            else:
+                # Only the part of the overlay under the repainted area is scaled
+                rect = event.rect()
+                source = self.view.documentRect((rect.x(), rect.y(), rect.x() + rect.width(), rect.y() + rect.height()))
+                painter.drawImage(QRectF(rect), self.overlay_image, QRectF(*source))
+        painter.end()
+
+
 class UIManager(QWidget):
     def __init__(self):
         super().__init__()
@@ -39,10 +106,9 @@ class UIManager(QWidget):
 
         return button
 
-    def createCanvas(self, image):
-        canvas = QLabel()
-        canvas.setPixmap(QPixmap(image))
-        canvas.setFixedSize(image.size())
+    def createCanvas(self, width, height):
+        canvas = Canvas()
+        canvas.resizeDisplay(width, height)
         return canvas
 
     def MenuItem(self, menu, name, action=None, icon=None, short_key=None, inner_function=None):
@@ -0,0 +1,283 @@
+import math
+import sys
+import time
+import numpy as np
+import cv2
+
+from cv_manager import CVManager
+
+
+class Pyramid:
+    """
+    Mipmap pyramid of an image, each level half the size of the one below it. Levels are built on first use
+    and afterwards only refreshed over the rects that changed, so painting while zoomed out stays cheap.
+    """
+    def __init__(self):
+        self.levels = []
+        # Document rect per level that changed since the level was last refreshed
+        self.dirty = []
+
+    def update(self, image, rect=None):
+        """
+        Note that the image changed over rect, or was replaced or changed everywhere when rect is None.
+        """
+        if rect is None or not self.levels or self.levels[0] is not image:
+            self.levels = [image]
+            self.dirty = [None]
+            return
+        for index in range(1, len(self.levels)):
+            dirty = self.dirty[index]
+            self.dirty[index] = rect if dirty is None else (min(dirty[0], rect[0]), min(dirty[1], rect[1]),
+                                                            max(dirty[2], rect[2]), max(dirty[3], rect[3]))
+
+    def maxLevel(self):
+        """
+        Get the index of the smallest level, which is still at least a pixel on each side.
+        """
+        return max(int(math.log2(max(min(self.levels[0].shape[:2]), 1))), 0)
+
+    def level(self, index):
+        """
+        Get a level, building the levels below it or refreshing their dirty rects first.
+        """
+        for current in range(1, index + 1):
+            source = self.levels[current - 1]
+            height, width = source.shape[0] // 2, source.shape[1] // 2
+            if current == len(self.levels):
+                # Area resampling by exactly two averages each 2x2 block, so a level can be refreshed piecewise
+                self.levels.append(cv2.resize(source[:height * 2, :width * 2], (width, height),
+                                              interpolation=cv2.INTER_AREA))
+                self.dirty.append(None)
+            elif self.dirty[current] is not None:
+                scale = 1 << current
+                x0, y0, x1, y1 = self.dirty[current]
+                x0, y0 = x0 // scale, y0 // scale
+                x1, y1 = min(-(-x1 // scale), width), min(-(-y1 // scale), height)
+                if x0 < x1 and y0 < y1:
+                    self.levels[current][y0:y1, x0:x1] = cv2.resize(source[y0 * 2:y1 * 2, x0 * 2:x1 * 2],
+                                                                    (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+                self.dirty[current] = None
+        return self.levels[index]
+
+
+class Viewport:
+    """
+    Window onto the document at a zoom level and pan offset, mapping between canvas and document positions.
+    Only the visible part of the document is converted for display, read from the pyramid level closest to the zoom,
+    so rendering costs in proportion to the window rather than the image.
+    """
+    def __init__(self, CV, min_zoom=1 / 64, max_zoom=32):
+        self.CV = CV
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.zoom = 1.0
+        # Document position shown at the top left corner of the canvas
+        self.x = 0.0
+        self.y = 0.0
+        self.shape = (1, 1)
+        self.limit = (1, 1)
+        self.pyramid = Pyramid()
+
+    def reset(self, shape, limit):
+        """
+        Show a new document of an image shape, zoomed out to fit a canvas of at most limit (width, height).
+        """
+        self.shape = shape[:2]
+        self.limit = limit
+        self.zoom = min(1.0, self.fitZoom())
+        self.x = self.y = 0.0
+        self.pyramid = Pyramid()
+
+    def setShape(self, shape):
+        """
+        Keep the zoom for a document whose shape changed, such as after a rotate or crop.
+        """
+        self.shape = shape[:2]
+        self.clampPan()
+
+    def fitZoom(self):
+        """
+        Get the zoom showing the whole document in the largest canvas.
+        """
+        return min(self.limit[0] / self.shape[1], self.limit[1] / self.shape[0])
+
+    def size(self):
+        """
+        Get the canvas size (width, height): the zoomed document, up to the limit.
+        """
+        height, width = self.shape
+        return (max(min(math.ceil(width * self.zoom), self.limit[0]), 1),
+                max(min(math.ceil(height * self.zoom), self.limit[1]), 1))
+
+    def isIdentity(self):
+        """
+        Check if canvas pixels are document pixels, so the document can be written to the display as it is.
+        """
+        return self.zoom == 1 and self.x == 0 and self.y == 0 and self.size() == (self.shape[1], self.shape[0])
+
+    def setZoom(self, zoom, anchor=None):
+        """
+        Zoom to a level, keeping the document point under anchor, a canvas position, in place.
+        """
+        zoom = min(max(zoom, self.min_zoom), self.max_zoom)
+        # Snap to actual size, so zooming in and out by steps lands back on the exact pixels
+        zoom = 1.0 if abs(zoom - 1) < 1e-3 else zoom
+        if anchor is None:
+            width, height = self.size()
+            anchor = (width / 2, height / 2)
+        x, y = self.x + anchor[0] / self.zoom, self.y + anchor[1] / self.zoom
+        self.zoom = zoom
+        self.x, self.y = x - anchor[0] / zoom, y - anchor[1] / zoom
+        self.clampPan()
+
+    def panBy(self, dx, dy):
+        """
+        Move the view by canvas pixels.
+        """
+        self.x += dx / self.zoom
+        self.y += dy / self.zoom
+        self.clampPan()
+
+    def clampPan(self):
+        """
+        Keep the view inside the document, on whole canvas pixels so actual size stays pixel exact.
+        """
+        width, height = self.size()
+        self.x = round(self.x * self.zoom) / self.zoom
+        self.y = round(self.y * self.zoom) / self.zoom
+        self.x = min(max(self.x, 0.0), max(self.shape[1] - width / self.zoom, 0.0))
+        self.y = min(max(self.y, 0.0), max(self.shape[0] - height / self.zoom, 0.0))
+
+    def toDocument(self, x, y):
+        """
+        Get the document pixel under a canvas pixel.
+        """
+        return int(math.floor(self.x + (x + 0.5) / self.zoom)), int(math.floor(self.y + (y + 0.5) / self.zoom))
+
+    def toCanvas(self, x, y):
+        """
+        Get the canvas pixel showing the center of a document pixel.
+        """
+        return int(math.floor((x + 0.5 - self.x) * self.zoom)), int(math.floor((y + 0.5 - self.y) * self.zoom))
+
+    def canvasRect(self, rect, pad=2):
+        """
+        Get the canvas rect showing a document rect, grown by pad pixels for resampling, or None when out of view.
+        """
+        width, height = self.size()
+        x0 = max(int(math.floor((rect[0] - self.x) * self.zoom)) - pad, 0)
+        y0 = max(int(math.floor((rect[1] - self.y) * self.zoom)) - pad, 0)
+        x1 = min(int(math.ceil((rect[2] - self.x) * self.zoom)) + pad, width)
+        y1 = min(int(math.ceil((rect[3] - self.y) * self.zoom)) + pad, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def documentRect(self, rect):
+        """
+        Get the document area (x, y, width, height) in floats shown by a canvas rect.
+        """
+        return (self.x + rect[0] / self.zoom, self.y + rect[1] / self.zoom,
+                (rect[2] - rect[0]) / self.zoom, (rect[3] - rect[1]) / self.zoom)
+
+    def levelFor(self, zoom):
+        """
+        Get the pyramid level to read at a zoom: the smallest one still at least as detailed as the canvas.
+        """
+        if zoom >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / zoom))), self.pyramid.maxLevel())
+
+    def update(self, image, rect=None):
+        """
+        Note that the document image changed over rect, or everywhere.
+        """
+        self.pyramid.update(image, rect)
+
+    def render(self, image, display, image_effect=None, version=None, rect=None, scale=1.0):
+        """
+        Write the visible part of a document rect, or of the whole document, into the canvas display buffer.
+        A scale below 1 reads a coarser level, as a quick proxy of expensive effects.
+        """
+        if self.isIdentity() and display.shape[:2] == image.shape[:2]:
+            self.CV.toDisplay(image, display, image_effect, version, rect, scale)
+            return
+        target = self.canvasRect(rect if rect is not None else (0, 0, self.shape[1], self.shape[0]))
+        if target is None:
+            return
+        if not self.pyramid.levels or self.pyramid.levels[0] is not image:
+            self.pyramid.update(image)
+        level = self.levelFor(self.zoom * scale)
+        source = self.pyramid.level(level)
+        factor = 1 << level
+        tx0, ty0, tx1, ty1 = target
+        # Read the level pixels under the target, with a pixel for resampling and the effect halo around them
+        pad = 1 + (-(-self.CV.getEffectHalo(image_effect) // factor) if self.CV.splitEffect(image_effect) else 0)
+        sx0 = max(int(math.floor((self.x + tx0 / self.zoom) / factor)) - pad, 0)
+        sy0 = max(int(math.floor((self.y + ty0 / self.zoom) / factor)) - pad, 0)
+        sx1 = min(int(math.ceil((self.x + tx1 / self.zoom) / factor)) + pad, source.shape[1])
+        sy1 = min(int(math.ceil((self.y + ty1 / self.zoom) / factor)) + pad, source.shape[0])
+        if sx0 >= sx1 or sy0 >= sy1:
+            return
+        region = source[sy0:sy1, sx0:sx1]
+        code = cv2.COLOR_BGR2BGRA
+        if self.CV.splitEffect(image_effect):
+            # Kernels shrink with the level, so a zoomed out effect looks like the full resolution one
+            region = self.CV.filterImage(region, image_effect, 1 / factor)
+            code = cv2.COLOR_GRAY2BGRA if region.ndim == 2 else cv2.COLOR_RGB2BGRA
+        # Map every target pixel center back to the level, relative to the region read
+        step = 1 / (self.zoom * factor)
+        matrix = np.float32([[step, 0, (self.x + (tx0 + 0.5) / self.zoom) / factor - 0.5 - sx0],
+                             [0, step, (self.y + (ty0 + 0.5) / self.zoom) / factor - 0.5 - sy0]])
+        # Magnified pixels stay sharp squares, minified ones are averaged by the level and a linear lookup
+        interpolation = cv2.INTER_NEAREST if step <= 1 else cv2.INTER_LINEAR
+        view = cv2.warpAffine(region, matrix, (tx1 - tx0, ty1 - ty0), flags=interpolation | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
+        cv2.cvtColor(view, code, dst=display[ty0:ty1, tx0:tx1])
+
+
+def benchmark(sizes=(1000, 4000, 8000), canvas=(1200, 645), frames=20, rect=64):
+    """
+    Time a full canvas render at fit zoom, after a pan, and a painted rect, for square documents of several sizes.
+    Returns milliseconds per render by document size; they should stay flat as the document grows.
+    """
+    cv = CVManager()
+    results = {}
+    for size in sizes:
+        image = np.full((size, size, 3), 255, dtype=np.uint8)
+        cv2.circle(image, (size // 2, size // 2), size // 3, (40, 90, 160), -1)
+        view = Viewport(cv)
+        view.reset(image.shape, canvas)
+        view.update(image)
+        width, height = view.size()
+        display = np.empty((height, width, 4), dtype=np.uint8)
+        view.render(image, display)
+        start = time.perf_counter()
+        for _ in range(frames):
+            view.render(image, display)
+        fit = (time.perf_counter() - start) / frames * 1e3
+        view.setZoom(2.0)
+        width, height = view.size()
+        display = np.empty((height, width, 4), dtype=np.uint8)
+        start = time.perf_counter()
+        for index in range(frames):
+            view.panBy(7, 5)
+            view.render(image, display)
+        pan = (time.perf_counter() - start) / frames * 1e3
+        view.setZoom(view.fitZoom())
+        start = time.perf_counter()
+        for index in range(frames):
+            x, y = (index * 97) % (size - rect), (index * 61) % (size - rect)
+            image[y:y + rect, x:x + rect] = 0
+            painted = (x, y, x + rect, y + rect)
+            view.update(image, painted)
+            view.render(image, display, rect=painted)
+        paint = (time.perf_counter() - start) / frames * 1e3
+        results[size] = (fit, pan, paint)
+    return results
+
+
+if __name__ == '__main__':
+    sizes = tuple(int(arg) for arg in sys.argv[1:]) or (1000, 4000, 8000)
+    for size, (fit, pan, paint) in benchmark(sizes).items():
+        print(f'{size:>5}px: fit view {fit:.2f} ms, zoomed pan {pan:.2f} ms, painted 64x64 rect {paint:.3f} ms')